@@ -1,47 +1,513 @@
-from typing import List
-from backend.models import Email, PromptConfig
-from backend.llm_service import LLMService
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from backend.models import Email, PromptConfig, ThreadState
+from backend.llm_errors import RateLimitError, TransientLLMError
+from backend.llm_service import LLMService, estimate_tokens
+from backend.inbox_index import parse_timestamp
+from backend.inbox_store import InboxStore
+from backend.near_duplicate import NearDuplicateIndex, adapted_action_items, group_near_duplicates
+from backend.preclassifier import Preclassifier
+from backend.preprocess import EmailPreprocessor
+from backend.telemetry import get_telemetry
+
+# Categories that never carry action items: a confident local prediction settles the email
+ACTIONLESS_CATEGORIES = ("Newsletter", "Spam")
 
 class EmailAgent:
-    def __init__(self, llm_service: LLMService):
+    def __init__(self, llm_service: LLMService, max_workers: int = 1,
+                 batch_size: int = 1, batch_token_budget: int = 6000, batch_retries: int = 1,
+                 preclassifier: Optional[Preclassifier] = None, preclassifier_threshold: float = 0.95,
+                 actionless_categories: Iterable[str] = ACTIONLESS_CATEGORIES,
+                 preprocessor: Optional[EmailPreprocessor] = None,
+                 thread_store: Optional[InboxStore] = None,
+                 near_duplicates: Optional[NearDuplicateIndex] = None):
         self.llm = llm_service
+        # Upper bound on emails being processed at once (i.e. LLM requests in flight).
+        self.max_workers = max(1, max_workers)
+        # Batched mode: pack up to `batch_size` emails / `batch_token_budget` tokens per request.
+        # Emails a batch response leaves out are re-queued `batch_retries` times, then sent alone.
+        self.batch_size = max(1, batch_size)
+        self.batch_token_budget = batch_token_budget
+        self.batch_retries = batch_retries
+        # email id -> error message for emails that failed during the last run
+        self.last_failures: Dict[str, str] = {}
+        # number of emails the last run skipped because their results were up to date
+        self.last_skipped = 0
+        # Optional local classifier, learns from every LLM categorization. Predictions at or
+        # above `preclassifier_threshold` replace the categorization request.
+        self.preclassifier = preclassifier
+        self.preclassifier_threshold = preclassifier_threshold
+        self.actionless_categories = set(actionless_categories)
+        # emails the last run categorized locally, and the LLM requests that saved
+        self.last_preclassified = 0
+        self.last_llm_calls_saved = 0
+        # Optional cleanup of bodies (quotes, signatures, footers) before they go into any prompt
+        self.preprocessor = preprocessor
+        # Where conversations are looked up and their running summaries kept; needed for
+        # the thread_analysis prompt. Emails the last run analyzed as part of a thread:
+        self.thread_store = thread_store
+        self.last_threaded = 0
+        self._thread_locks: Dict[str, threading.Lock] = {}
+        # Optional index of processed emails: a near-duplicate of one reuses its results.
+        # Emails the last run settled that way:
+        self.near_duplicates = near_duplicates
+        self.last_reused = 0
+        self._stats_lock = threading.Lock()
 
-    def process_emails(self, emails: List[Email], prompts: PromptConfig) -> List[Email]:
+    def process_emails(self, emails: List[Email], prompts: PromptConfig,
+                       max_workers: Optional[int] = None, force: bool = False) -> List[Email]:
         """
         Iterates through emails and applies categorization and action extraction
         if they haven't been processed yet (or if we want to re-process).
+
+        Only stale emails are sent to the LLM: those whose stored fingerprints do
+        not match the current prompts and model (see `prompt_fingerprints`), or
+        all of them with `force=True`.
+
+        Emails are processed concurrently by up to `max_workers` threads and are
+        returned in input order. A failure on one email does not affect the
+        others: the email is returned unchanged and its error is recorded in
+        `last_failures`.
+
+        With a pre-classifier, emails it confidently puts in an actionless
+        category (e.g. newsletters) need no request at all; with separate
+        prompts, other confident predictions skip the categorization request.
+
+        With a thread_analysis prompt, messages of conversations that have more
+        than one message are analyzed oldest first, one request each, from the
+        newest message plus the conversation's running summary (see
+        `_process_thread`). Other emails take the usual path.
+
+        With a near-duplicate index, an email within its distance of an already
+        processed one (templated and bulk mail) takes over that email's category
+        and adapted action items. Near-duplicates within the run are grouped and
+        only the first of each group is sent to the LLM. `force` skips the earlier
+        results in the index, and messages of conversations are never reused.
+        """
+        workers = max(1, max_workers or self.max_workers)
+        self.last_failures = {}
+        fingerprints = self.prompt_fingerprints(prompts)
+        thread_fingerprints = self.prompt_fingerprints(prompts, threaded=True)
+        in_threads = self._thread_message_ids(emails) if thread_fingerprints != fingerprints else set()
+
+        def current(email: Email) -> Tuple[str, str]:
+            return thread_fingerprints if email.id in in_threads else fingerprints
+
+        stale = [email for email in emails if force or self._is_stale(email, current(email))]
+        self.last_skipped = len(emails) - len(stale)
+        self.last_preclassified = self.last_llm_calls_saved = self.last_threaded = self.last_reused = 0
+
+        # Requests an email settled without the LLM would otherwise need (separate prompts: two)
+        calls = 1 if self.llm.supports_structured_output and (prompts.combined_analysis or prompts.batch_analysis) else 2
+        if self.preclassifier is not None:
+            stale = [email for email in stale if not self._settle_locally(email, current(email), calls)]
+
+        followers: Dict[str, List[Email]] = {}
+        if self.near_duplicates is not None:
+            stale, followers = self._reuse_near_duplicates(stale, fingerprints, calls, force)
+
+        self._process_with_llm(stale, prompts, workers, fingerprints, thread_fingerprints, force)
+        if followers:
+            # Copies of an email that failed still get their own request
+            rest = self._follow_leaders(followers, {email.id: email for email in stale}, fingerprints, calls)
+            self._process_with_llm(rest, prompts, workers, fingerprints, thread_fingerprints, force)
+        return list(emails)
+
+    def _process_with_llm(self, emails: List[Email], prompts: PromptConfig, workers: int,
+                          fingerprints: Tuple[str, str], thread_fingerprints: Tuple[str, str], force: bool):
+        if self._threaded(prompts):
+            emails = self._process_threads(emails, prompts, workers, thread_fingerprints)
+
+        if self._use_batches(emails, prompts):
+            self._process_batched(emails, prompts, workers, fingerprints)
+        else:
+            self._map(lambda email: self._process_safely(email, prompts, fingerprints, force), emails, workers)
+
+    def prompt_fingerprints(self, prompts: PromptConfig, threaded: bool = False) -> Tuple[str, str]:
+        """
+        Fingerprints (category, action items) of the prompts, model and body
+        budget that processing would use right now. With separate requests each result only
+        depends on its own prompt; the fused/batched path produces both at once.
+        `threaded` gives the fingerprints of messages of multi-message
+        conversations, which also depend on the thread prompt.
+        """
+        model = getattr(self.llm, "model_name", "")
+        if self.preprocessor is not None:
+            # The body budget decides how much of each email the model sees
+            model += f"|body<={self.preprocessor.max_tokens}"
+        # Conversation messages are analyzed by the thread prompt instead
+        thread = ["thread_analysis"] if threaded and self._threaded(prompts) else []
+        batched = self.batch_size > 1 and self.llm.supports_structured_output and bool(prompts.batch_analysis)
+        if self._fused(prompts) or batched:
+            fields = ["combined_analysis"] + (["batch_analysis"] if batched else [])
+            if batched and not prompts.combined_analysis:
+                # Emails a batch cannot answer fall back to the separate prompts
+                fields += ["categorization", "action_extraction"]
+            fingerprint = prompts.fingerprint(*fields, *thread, model=model)
+            return fingerprint, fingerprint
+        return (
+            prompts.fingerprint("categorization", *thread, model=model),
+            prompts.fingerprint("action_extraction", *thread, model=model),
+        )
+
+    def stale_emails(self, emails: List[Email], prompts: PromptConfig) -> List[Email]:
+        """The emails whose stored results do not match the current prompts and model."""
+        fingerprints = self.prompt_fingerprints(prompts)
+        thread_fingerprints = self.prompt_fingerprints(prompts, threaded=True)
+        in_threads = self._thread_message_ids(emails) if thread_fingerprints != fingerprints else set()
+        return [email for email in emails
+                if self._is_stale(email, thread_fingerprints if email.id in in_threads else fingerprints)]
+
+    def needs_processing(self, email: Email, prompts: PromptConfig) -> bool:
+        return bool(self.stale_emails([email], prompts))
+
+    @staticmethod
+    def _is_stale(email: Email, fingerprints: Tuple[str, str]) -> bool:
+        category_fp, actions_fp = fingerprints
+        return email.category_fingerprint != category_fp or email.actions_fingerprint != actions_fp
+
+    def _fused(self, prompts: PromptConfig) -> bool:
+        return bool(prompts.combined_analysis) and self.llm.supports_structured_output
+
+    def _threaded(self, prompts: PromptConfig) -> bool:
+        return bool(prompts.thread_analysis) and self.llm.supports_structured_output and self.thread_store is not None
+
+    def _local_category(self, email: Email) -> Optional[str]:
+        """The pre-classifier's category if it is confident enough, else None."""
+        if self.preclassifier is None:
+            return None
+        category, confidence = self.preclassifier.predict(email)
+        return category if confidence >= self.preclassifier_threshold else None
+
+    def _settle_locally(self, email: Email, fingerprints: Tuple[str, str], calls: int) -> bool:
+        category = self._local_category(email)
+        if category is None or category not in self.actionless_categories:
+            return False
+        email.category = category
+        email.action_items = []
+        email.category_source = "local"
+        email.category_fingerprint, email.actions_fingerprint = fingerprints
+        self._count_saved(calls)
+        return True
+
+    def _count_saved(self, calls: int):
+        with self._stats_lock:
+            self.last_preclassified += 1
+            self.last_llm_calls_saved += calls
+
+    def _learn(self, email: Email):
+        email.category_source = "llm"
+        if self.preclassifier is not None:
+            self.preclassifier.partial_fit(email)
+        if self.near_duplicates is not None:
+            self.near_duplicates.add(email)
+
+    def _reuse_near_duplicates(self, emails: List[Email], fingerprints: Tuple[str, str],
+                               calls: int, force: bool = False) -> Tuple[List[Email], Dict[str, List[Email]]]:
+        """
+        Settles the emails that have a processed near-duplicate in the index
+        (unless `force`: a full reprocess must not settle emails from earlier
+        results). Groups the rest; returns the first email of every group,
+        which needs the LLM, and the others by the id of their group's first
+        email. Messages of multi-message conversations are left alone, so
+        they reach the thread analysis and its summary.
         """
-        processed_emails = []
+        telemetry = get_telemetry()
+        in_threads = self._thread_message_ids(emails)
+        leaders = [email for email in emails if email.id in in_threads]
+        rest = []
+        for email in emails:
+            if email.id in in_threads:
+                continue
+            match = None if force else self.near_duplicates.match(email, fingerprints)
+            if match is None:
+                rest.append(email)
+                continue
+            self._reuse(email, match.category, match.action_items, fingerprints, calls)
+            telemetry.record_cache("near_duplicate", True)
+
+        followers = {}
+        for group in group_near_duplicates(rest, self.near_duplicates.max_distance, self.near_duplicates.bands):
+            leaders.append(group[0])
+            telemetry.record_cache("near_duplicate", False)
+            if len(group) > 1:
+                followers[group[0].id] = group[1:]
+        return leaders, followers
+
+    def _follow_leaders(self, followers: Dict[str, List[Email]], leaders: Dict[str, Email],
+                        fingerprints: Tuple[str, str], calls: int) -> List[Email]:
+        """Copies the processed group leaders' results to their groups; returns the emails left over."""
+        telemetry = get_telemetry()
+        rest = []
+        for leader_id, group in followers.items():
+            leader = leaders[leader_id]
+            reusable = leader_id not in self.last_failures and not self._is_stale(leader, fingerprints)
+            for email in group:
+                if reusable:
+                    self._reuse(email, leader.category, adapted_action_items(leader, email), fingerprints, calls)
+                else:
+                    rest.append(email)
+                telemetry.record_cache("near_duplicate", reusable)
+        return rest
+
+    def _reuse(self, email: Email, category: str, action_items: List[str],
+               fingerprints: Tuple[str, str], calls: int):
+        email.category = category
+        email.action_items = action_items
+        email.category_source = "duplicate"
+        email.category_fingerprint, email.actions_fingerprint = fingerprints
+        with self._stats_lock:
+            self.last_reused += 1
+            self.last_llm_calls_saved += calls
+
+    def _conversations(self, emails: List[Email]) -> List[List[Email]]:
+        """The emails grouped by conversation, for the conversations with more than one message."""
+        by_thread: Dict[str, List[Email]] = {}
         for email in emails:
-            # Construct a string representation for the LLM
-            email_text = f"Subject: {email.subject}\nBody: {email.body}"
-            
-            # Categorize
-            category = self.llm.categorize_email(
-                email_text, 
-                prompts.categorization.replace("{subject}", email.subject).replace("{body}", email.body)
+            if email.thread_id:
+                by_thread.setdefault(email.thread_id, []).append(email)
+        stored = self.thread_store.thread_sizes(by_thread) if by_thread and self.thread_store is not None else {}
+        # A thread qualifies if this run or the store has more messages than this email alone
+        return [group for thread_id, group in by_thread.items()
+                if len(group) > 1 or stored.get(thread_id, 0) > len(group)]
+
+    def _thread_message_ids(self, emails: List[Email]) -> set:
+        return {email.id for group in self._conversations(emails) for email in group}
+
+    def _process_threads(self, emails: List[Email], prompts: PromptConfig, workers: int,
+                         fingerprints: Tuple[str, str]) -> List[Email]:
+        """Processes the emails that belong to multi-message conversations; returns the others."""
+        threads = self._conversations(emails)
+        self._map(lambda group: self._process_thread(group, prompts, fingerprints), threads, workers)
+        threaded = {email.id for group in threads for email in group}
+        return [email for email in emails if email.id not in threaded]
+
+    def _process_thread(self, emails: List[Email], prompts: PromptConfig, fingerprints: Tuple[str, str]):
+        """
+        Analyzes a conversation's new messages oldest first. Each request only
+        carries one message and the summary so far, and returns the updated
+        summary, so a long thread costs one small request per new message
+        instead of re-reading its history.
+
+        When messages the stored summary already covers are processed again
+        (a forced run, changed prompts), the summary is rebuilt from a fresh
+        seed instead, so they are not folded in twice.
+        """
+        thread_id = emails[0].thread_id
+        emails = sorted(emails, key=lambda email: parse_timestamp(email.timestamp))
+        with self._thread_lock(thread_id):
+            state = self.thread_store.get_thread_state(thread_id)
+            if state is None or any(email.id in state.message_ids for email in emails):
+                state = ThreadState(thread_id=thread_id, summary=self._seed_summary(thread_id, emails))
+            for email in emails:
+                try:
+                    self._process_thread_message(email, state, prompts, fingerprints)
+                except Exception as e:
+                    self.last_failures[email.id] = str(e)
+                    continue
+                # Saved after every message, so an interrupted run resumes from here
+                self.thread_store.save_thread_state(state)
+
+    def _process_thread_message(self, email: Email, state: ThreadState, prompts: PromptConfig,
+                                fingerprints: Tuple[str, str]):
+        email_text = f"From: {email.sender}\nSubject: {email.subject}\nBody: {self._body(email)}"
+        prompt = self._render(prompts.thread_analysis, email).replace(
+            "{summary}", state.summary or "(This is the first message of the conversation.)")
+        result = self.llm.analyze_thread_message(email_text, prompt)
+        email.category = result["category"]
+        email.action_items = result["tasks"]
+        email.category_fingerprint, email.actions_fingerprint = fingerprints
+        self._learn(email)
+        state.summary = result["summary"]
+        state.message_ids.append(email.id)
+        with self._stats_lock:
+            self.last_threaded += 1
+
+    def _seed_summary(self, thread_id: str, emails: List[Email]) -> str:
+        """
+        Starting point for a thread without a summary yet: one line per message
+        older than the first of `emails` (oldest first) that was already
+        processed. Built locally, no request.
+        """
+        new = {email.id for email in emails}
+        start = parse_timestamp(emails[0].timestamp)
+        earlier = [email for email in self.thread_store.get_thread(thread_id)
+                   if email.id not in new and email.category and parse_timestamp(email.timestamp) < start]
+        earlier.sort(key=lambda email: parse_timestamp(email.timestamp))
+        lines = [
+            f"- {email.sender}: {email.subject} ({email.category}; tasks: {'; '.join(email.action_items or []) or 'none'})"
+            for email in earlier[-10:]
+        ]
+        return "Earlier messages:\n" + "\n".join(lines) if lines else ""
+
+    def _thread_lock(self, thread_id: str) -> threading.Lock:
+        # One conversation is processed by one worker at a time, so no summary update is lost
+        with self._stats_lock:
+            return self._thread_locks.setdefault(thread_id, threading.Lock())
+
+    @staticmethod
+    def _map(fn, items: list, workers: int) -> list:
+        if workers == 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+            return list(pool.map(fn, items))
+
+    def _use_batches(self, emails: List[Email], prompts: PromptConfig) -> bool:
+        return (
+            self.batch_size > 1
+            and len(emails) > 1
+            and bool(prompts.batch_analysis)
+            and self.llm.supports_structured_output
+        )
+
+    def _process_batched(self, emails: List[Email], prompts: PromptConfig, workers: int,
+                         fingerprints: Tuple[str, str]):
+        pending = list(emails)
+        for _ in range(self.batch_retries + 1):
+            if not pending:
+                break
+            batches = self._make_batches(pending)
+            results = self._map(lambda batch: self._analyze_batch_safely(batch, prompts), batches, workers)
+
+            pending = []
+            for batch, result in zip(batches, results):
+                if result is None:
+                    # Failed as a whole, already recorded in last_failures
+                    continue
+                for email in batch:
+                    analysis = result.get(email.id)
+                    if analysis is None:
+                        pending.append(email)
+                    else:
+                        email.category = analysis["category"]
+                        email.action_items = analysis["tasks"]
+                        email.category_fingerprint, email.actions_fingerprint = fingerprints
+                        self._learn(email)
+
+        # Whatever the batches could not answer falls back to one request per email
+        self._map(lambda email: self._process_safely(email, prompts, fingerprints, True), pending, workers)
+
+    def _make_batches(self, emails: List[Email]) -> List[List[Email]]:
+        batches, current, current_tokens = [], [], 0
+        for email in emails:
+            tokens = estimate_tokens(self._batch_entry(email))
+            if current and (len(current) >= self.batch_size or current_tokens + tokens > self.batch_token_budget):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(email)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _analyze_batch_safely(self, batch: List[Email], prompts: PromptConfig) -> Optional[Dict[str, Dict]]:
+        """
+        The batch's analyses by email id; None if the provider is rate limiting
+        or unavailable even after the scheduler's retries, in which case the
+        batch's emails are recorded as failed rather than sent one by one.
+        """
+        content = "\n---\n".join(self._batch_entry(email) for email in batch)
+        prompt = prompts.batch_analysis.replace("{emails}", content)
+        try:
+            return self.llm.analyze_batch(content, prompt)
+        except (RateLimitError, TransientLLMError) as e:
+            for email in batch:
+                self.last_failures[email.id] = str(e)
+            return None
+        except Exception:
+            # E.g. a malformed reply: the emails are retried in a later round or individually
+            return {}
+
+    def _batch_entry(self, email: Email) -> str:
+        return f"ID: {email.id}\nSubject: {email.subject}\nBody: {self._body(email)}"
+
+    def _process_safely(self, email: Email, prompts: PromptConfig,
+                        fingerprints: Tuple[str, str], force: bool = False) -> Email:
+        try:
+            return self._process_one(email, prompts, fingerprints, force)
+        except Exception as e:
+            self.last_failures[email.id] = str(e)
+            return email
+
+    def _process_one(self, email: Email, prompts: PromptConfig,
+                     fingerprints: Tuple[str, str], force: bool = False) -> Email:
+        category_fp, actions_fp = fingerprints
+
+        # Construct a string representation for the LLM
+        email_text = f"Subject: {email.subject}\nBody: {self._body(email)}"
+
+        # Fused path: category and actions from a single structured request
+        if self._fused(prompts):
+            result = self.llm.analyze_email(
+                email_text,
+                self._render(prompts.combined_analysis, email)
             )
-            email.category = category
+            email.category = result["category"]
+            email.action_items = result["tasks"]
+            email.category_fingerprint, email.actions_fingerprint = category_fp, actions_fp
+            self._learn(email)
+            return email
 
-            # Extract Actions
+        # Only redo the results whose prompt changed
+        category = email.category
+        source = email.category_source
+        if force or email.category_fingerprint != category_fp:
+            category = self._local_category(email)
+            if category is not None:
+                source = "local"
+                self._count_saved(1)
+            else:
+                category = self.llm.categorize_email(
+                    email_text,
+                    self._render(prompts.categorization, email)
+                )
+                source = "llm"
+
+        actions = email.action_items
+        if force or email.actions_fingerprint != actions_fp:
             actions = self.llm.extract_action_items(
-                email_text, 
-                prompts.action_extraction.replace("{subject}", email.subject).replace("{body}", email.body)
+                email_text,
+                self._render(prompts.action_extraction, email)
             )
-            email.action_items = actions
-            
-            processed_emails.append(email)
-        
-        return processed_emails
+
+        email.category = category
+        email.action_items = actions
+        email.category_fingerprint, email.actions_fingerprint = category_fp, actions_fp
+        if source == "llm":
+            self._learn(email)
+        else:
+            email.category_source = source
+        return email
+
+    def _body(self, email: Email) -> str:
+        """The body as the LLM gets to see it."""
+        return self.preprocessor.body(email) if self.preprocessor is not None else email.body
+
+    def _render(self, template: str, email: Email) -> str:
+        return template.replace("{sender}", email.sender).replace("{subject}", email.subject).replace("{body}", self._body(email))
 
     def generate_draft(self, email: Email, prompts: PromptConfig, instructions: str = "") -> str:
-        email_text = f"Sender: {email.sender}\nSubject: {email.subject}\nBody: {email.body}"
-        prompt = prompts.auto_reply.replace("{sender}", email.sender).replace("{subject}", email.subject).replace("{body}", email.body)
+        return self.llm.generate_reply(*self._draft_request(email, prompts, instructions))
+
+    def generate_draft_stream(self, email: Email, prompts: PromptConfig, instructions: str = "") -> Iterator[str]:
+        """Like `generate_draft`, yielding the draft as it is generated. Close the generator to cancel."""
+        return self.llm.generate_reply_stream(*self._draft_request(email, prompts, instructions))
+
+    def _draft_request(self, email: Email, prompts: PromptConfig, instructions: str) -> Tuple[str, str]:
+        email_text = f"Sender: {email.sender}\nSubject: {email.subject}\nBody: {self._body(email)}"
+        prompt = self._render(prompts.auto_reply, email)
         if instructions:
             prompt += f"\n\nAdditional Instructions: {instructions}"
-        
-        return self.llm.generate_reply(email_text, prompt)
+        return email_text, prompt
 
     def chat_with_email(self, email: Email, user_query: str) -> str:
-        context = f"Sender: {email.sender}\nSubject: {email.subject}\nBody: {email.body}\nCategory: {email.category}\nAction Items: {email.action_items}"
-        return self.llm.chat(context, user_query)
+        return self.llm.chat(self.email_context(email), user_query)
+
+    def chat_with_email_stream(self, email: Email, user_query: str) -> Iterator[str]:
+        """Like `chat_with_email`, yielding the answer as it is generated. Close the generator to cancel."""
+        return self.llm.chat_stream(self.email_context(email), user_query)
+
+    def email_context(self, email: Email) -> str:
+        """What the LLM is told about `email` when chatting about it."""
+        return f"Sender: {email.sender}\nSubject: {email.subject}\nBody: {self._body(email)}\nCategory: {email.category}\nAction Items: {email.action_items}"
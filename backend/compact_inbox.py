@@ -0,0 +1,394 @@
+import itertools
+import json
+import mmap
+import sys
+import tempfile
+import threading
+from array import array
+from collections.abc import MutableMapping
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from backend.models import Email
+
+# Free-text fields packed into string buffers, lists of free text as JSON, integers into a
+# packed array; every other field (senders, categories, labels, prompt fingerprints) repeats
+# a lot and is dictionary-encoded
+STRING_FIELDS = ("subject", "timestamp", "thread_id")
+LIST_FIELDS = ("action_items",)
+INT_FIELDS = ("simhash",)
+# Shared by all inboxes, so a revision never repeats even when the inbox is replaced
+_REVISIONS = itertools.count(1)
+
+
+class StringColumn:
+    """
+    Strings packed into one UTF-8 buffer, addressed by (start, end) offsets per
+    row, with a null flag per row so None and "" stay apart.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._nulls = bytearray()
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, row: int) -> Optional[str]:
+        return self._string(row)
+
+    def __setitem__(self, row: int, value: Optional[str]):
+        if self._string(row) == value:
+            return
+        # Replaced values stay in the buffer unreferenced; rows are rarely rewritten
+        self._starts[row], self._ends[row] = self._pack(value)
+        self._nulls[row] = value is None
+
+    def append(self, value: Optional[str]):
+        start, end = self._pack(value)
+        self._starts.append(start)
+        self._ends.append(end)
+        self._nulls.append(value is None)
+
+    def move(self, source: int, target: int):
+        self._starts[target] = self._starts[source]
+        self._ends[target] = self._ends[source]
+        self._nulls[target] = self._nulls[source]
+
+    def pop(self):
+        self._starts.pop()
+        self._ends.pop()
+        self._nulls.pop()
+
+    def nbytes(self) -> int:
+        return len(self._data) + self._starts.itemsize * len(self._starts) * 2 + len(self._nulls)
+
+    def _string(self, row: int) -> Optional[str]:
+        if self._nulls[row]:
+            return None
+        return self._data[self._starts[row]:self._ends[row]].decode("utf-8")
+
+    def _pack(self, value: Optional[str]):
+        start = len(self._data)
+        self._data += (value or "").encode("utf-8")
+        return start, len(self._data)
+
+
+class ListColumn(StringColumn):
+    """Lists of strings (e.g. action items, mostly unique per email) as JSON in a StringColumn."""
+
+    def __getitem__(self, row: int) -> Optional[List[str]]:
+        value = self._string(row)
+        return None if value is None else json.loads(value)
+
+    def __setitem__(self, row: int, value: Optional[List[str]]):
+        super().__setitem__(row, self._dump(value))
+
+    def append(self, value: Optional[List[str]]):
+        super().append(self._dump(value))
+
+    @staticmethod
+    def _dump(value: Optional[List[str]]) -> Optional[str]:
+        return None if value is None else json.dumps(list(value), ensure_ascii=False)
+
+
+class IntColumn:
+    """Unsigned 64-bit integers (e.g. SimHashes) in a packed array, with a null flag per row."""
+
+    def __init__(self):
+        self._values = array("Q")
+        self._nulls = bytearray()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __getitem__(self, row: int) -> Optional[int]:
+        return None if self._nulls[row] else self._values[row]
+
+    def __setitem__(self, row: int, value: Optional[int]):
+        self._values[row] = value or 0
+        self._nulls[row] = value is None
+
+    def append(self, value: Optional[int]):
+        self._values.append(value or 0)
+        self._nulls.append(value is None)
+
+    def move(self, source: int, target: int):
+        self._values[target] = self._values[source]
+        self._nulls[target] = self._nulls[source]
+
+    def pop(self):
+        self._values.pop()
+        self._nulls.pop()
+
+    def nbytes(self) -> int:
+        return self._values.itemsize * len(self._values) + len(self._nulls)
+
+
+class DictColumn:
+    """Dictionary-encoded column for values that repeat a lot (senders, categories, labels)."""
+
+    def __init__(self):
+        self.values: List = []
+        self._codes: Dict = {}
+        self._rows = array("I")
+        # Memory held by the distinct values themselves
+        self._value_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __getitem__(self, row: int):
+        value = self.values[self._rows[row]]
+        return list(value) if isinstance(value, tuple) else value
+
+    def __setitem__(self, row: int, value):
+        self._rows[row] = self._code(value)
+
+    def append(self, value):
+        self._rows.append(self._code(value))
+
+    def move(self, source: int, target: int):
+        self._rows[target] = self._rows[source]
+
+    def pop(self):
+        self._rows.pop()
+
+    def nbytes(self) -> int:
+        return (self._rows.itemsize * len(self._rows) + sys.getsizeof(self.values)
+                + sys.getsizeof(self._codes) + self._value_bytes)
+
+    def _code(self, value) -> int:
+        # Lists become tuples so they can be dictionary-encoded
+        if isinstance(value, list):
+            value = tuple(value)
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self._codes[value] = code
+            self.values.append(value)
+            self._value_bytes += sys.getsizeof(value) + (
+                sum(map(sys.getsizeof, value)) if isinstance(value, tuple) else 0)
+        return code
+
+
+class BodyStore:
+    """
+    Append-only UTF-8 body file read through a memory map. Callers keep the
+    (offset, length) of each body; bodies are only decoded when asked for.
+    Defaults to an anonymous temporary file that disappears with the process.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._file = open(path, "w+b") if path else tempfile.TemporaryFile()
+        self._size = 0
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def append(self, body: str):
+        data = (body or "").encode("utf-8")
+        with self._lock:
+            offset = self._size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._size += len(data)
+        return offset, len(data)
+
+    def read(self, offset: int, length: int) -> str:
+        if not length:
+            return ""
+        with self._lock:
+            if self._map is None or offset + length > len(self._map):
+                # Grown since it was mapped: flush and map the whole file again
+                self._file.flush()
+                if self._map is not None:
+                    self._map.close()
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[offset:offset + length].decode("utf-8")
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+            self._file.close()
+
+
+class CompactInbox:
+    """
+    Column-oriented inbox: one packed array per Email field instead of one
+    object per email, with bodies in a memory-mapped BodyStore. Emails are
+    materialized as `Email` objects only when read (`get`, iteration,
+    indexing), so callers keep working with the normal model.
+
+    Behaves like a read-only list of emails (len, iteration, int/slice
+    indexing) and supports lookups and updates by id. Every write stamps the
+    row with a new revision (see `revisions`), so derived indexes can tell
+    which emails changed without reading them.
+    """
+
+    def __init__(self, emails: Iterable[Email] = (), body_path: Optional[str] = None):
+        self.ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._fields = [name for name in Email.model_fields if name not in ("id", "body")]
+        self._columns = {
+            name: self._column(name) for name in self._fields
+        }
+        self._body_offsets = array("Q")
+        self._body_lengths = array("I")
+        self._revisions = array("Q")
+        # Latest revision written, or removal: changes with every change to the inbox
+        self.version = next(_REVISIONS)
+        self.bodies = BodyStore(body_path)
+        for email in emails:
+            self.upsert(email)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __bool__(self) -> bool:
+        return bool(self.ids)
+
+    def __contains__(self, email_id) -> bool:
+        return email_id in self._rows
+
+    def __iter__(self) -> Iterator[Email]:
+        for row in range(len(self.ids)):
+            yield self._materialize(row)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._materialize(row) for row in range(len(self.ids))[item]]
+        return self._materialize(range(len(self.ids))[item])
+
+    def get(self, email_id: str) -> Optional[Email]:
+        row = self._rows.get(email_id)
+        return None if row is None else self._materialize(row)
+
+    def field(self, email_id: str, name: str):
+        """A single field without loading the rest of the email (or its body)."""
+        row = self._rows[email_id]
+        if name == "id":
+            return email_id
+        if name == "body":
+            return self._body(row)
+        return self._columns[name][row]
+
+    def revisions(self) -> Iterator:
+        """(email id, revision) for every email; the revision changes whenever the email is written."""
+        return zip(self.ids, self._revisions)
+
+    def upsert(self, email: Email):
+        row = self._rows.get(email.id)
+        if row is not None and self._body(row) == (email.body or ""):
+            # Usually only the processing results change; keep the stored body
+            offset, length = self._body_offsets[row], self._body_lengths[row]
+        else:
+            offset, length = self.bodies.append(email.body)
+        if row is None:
+            self._rows[email.id] = len(self.ids)
+            self.ids.append(email.id)
+            for name in self._fields:
+                self._columns[name].append(getattr(email, name))
+            self._body_offsets.append(offset)
+            self._body_lengths.append(length)
+            self.version = next(_REVISIONS)
+            self._revisions.append(self.version)
+            return
+        for name in self._fields:
+            self._columns[name][row] = getattr(email, name)
+        self._body_offsets[row] = offset
+        self._body_lengths[row] = length
+        self.version = next(_REVISIONS)
+        self._revisions[row] = self.version
+
+    def remove(self, email_id: str):
+        row = self._rows.pop(email_id, None)
+        if row is None:
+            return
+        self.version = next(_REVISIONS)
+        last = len(self.ids) - 1
+        if row != last:
+            # Move the last row into the gap to keep the columns dense
+            moved = self.ids[last]
+            self.ids[row] = moved
+            self._rows[moved] = row
+            for column in self._columns.values():
+                column.move(last, row)
+            self._body_offsets[row] = self._body_offsets[last]
+            self._body_lengths[row] = self._body_lengths[last]
+            self._revisions[row] = self._revisions[last]
+        self.ids.pop()
+        for column in self._columns.values():
+            column.pop()
+        self._body_offsets.pop()
+        self._body_lengths.pop()
+        self._revisions.pop()
+
+    def to_emails(self) -> List[Email]:
+        return list(self)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Approximate bytes held in memory by the ids and the columns, plus the body file size on disk."""
+        return {
+            "ids": sys.getsizeof(self.ids) + sys.getsizeof(self._rows) + sum(map(sys.getsizeof, self.ids)),
+            "columns": sum(column.nbytes() for column in self._columns.values())
+            + self._body_offsets.itemsize * len(self._body_offsets)
+            + self._body_lengths.itemsize * len(self._body_lengths)
+            + self._revisions.itemsize * len(self._revisions),
+            "bodies_on_disk": self.bodies.size,
+        }
+
+    def _body(self, row: int) -> str:
+        return self.bodies.read(self._body_offsets[row], self._body_lengths[row])
+
+    def _materialize(self, row: int) -> Email:
+        values = {name: self._columns[name][row] for name in self._fields}
+        return Email.model_construct(id=self.ids[row], body=self._body(row), **values)
+
+    @staticmethod
+    def _column(name: str):
+        if name in STRING_FIELDS:
+            return StringColumn()
+        if name in LIST_FIELDS:
+            return ListColumn()
+        if name in INT_FIELDS:
+            return IntColumn()
+        return DictColumn()
+
+
+class CompactEmailMapping(MutableMapping):
+    """Dict-like view (email id -> Email) over a CompactInbox, e.g. as InboxIndex storage."""
+
+    def __init__(self, inbox: CompactInbox):
+        self.inbox = inbox
+
+    def __getitem__(self, email_id: str) -> Email:
+        email = self.inbox.get(email_id)
+        if email is None:
+            raise KeyError(email_id)
+        return email
+
+    def __setitem__(self, email_id: str, email: Email):
+        self.inbox.upsert(email)
+
+    def __delitem__(self, email_id: str):
+        if email_id not in self.inbox:
+            raise KeyError(email_id)
+        self.inbox.remove(email_id)
+
+    def __contains__(self, email_id) -> bool:
+        return email_id in self.inbox
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.inbox.ids))
+
+    def __len__(self) -> int:
+        return len(self.inbox)
+
+    def field(self, email_id: str, name: str):
+        return self.inbox.field(email_id, name)
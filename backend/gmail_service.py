@@ -1,30 +1,83 @@
 import os.path
-import base64
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from bs4 import BeautifulSoup
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 from backend.models import Email
+from backend.mime_body import BODY_CHAR_LIMIT, extract_body
+from backend.near_duplicate import simhash
+from backend.inbox_index import parse_timestamp
+from backend.inbox_store import InboxStore
+from backend.storage import DATA_DIR, merge_with_saved
+from backend.telemetry import get_telemetry, instrumented
 from datetime import datetime
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
+# Last synced historyId, see GmailService.sync
+SYNC_STATE_FILE = os.path.join(DATA_DIR, 'gmail_sync_state.json')
+
+# Overrides the Gmail API root URL, e.g. to point at a local fake server
+API_ROOT = os.getenv('GMAIL_API_ROOT')
+
+# Gmail allows up to 100 calls per batch request but recommends at most 50
+BATCH_SIZE = 50
+LIST_PAGE_SIZE = 500
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+# Field masks: only download the parts of a message that we parse
+MESSAGE_FIELDS = {
+    'full': 'id,threadId,labelIds,historyId,snippet,payload(mimeType,headers,body/data,parts)',
+    'metadata': 'id,threadId,labelIds,historyId,snippet,payload/headers',
+}
+
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+
+# The Google client libraries are imported where they are used, so that the
+# mock inbox (and anything else that never talks to Gmail) starts fast.
 
 class GmailService:
-    def __init__(self):
+    def __init__(self, service=None, api_root: Optional[str] = API_ROOT, max_workers: int = 4,
+                 sync_state_file: str = SYNC_STATE_FILE, body_char_limit: int = BODY_CHAR_LIMIT):
         self.creds = None
-        self.service = None
+        # Bodies are cut to this many characters (LLM context limits)
+        self.body_char_limit = body_char_limit
+        self.service = service
+        self.api_root = api_root
+        self.sync_state_file = sync_state_file
+        # Number of batch requests in flight at once
+        self.max_workers = max(1, max_workers)
+        self._local = threading.local()
+        # One instance is shared by all sessions: only the first caller authenticates
+        self._auth_lock = threading.Lock()
 
     def authenticate(self):
         """Shows basic usage of the Gmail API.
         Lists the user's Gmail labels.
         """
+        with self._auth_lock:
+            if not self.service:
+                self._authenticate()
+
+    def _authenticate(self):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from googleapiclient.discovery import build, build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+
+        if self.api_root:
+            # Local stand-in for the API: no OAuth, same discovery document
+            doc = json.loads(get_static_doc('gmail', 'v1'))
+            doc['rootUrl'] = self.api_root.rstrip('/') + '/'
+            self.service = build_from_document(doc, http=self._new_http())
+            return
+
         if os.path.exists(TOKEN_FILE):
             self.creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-        
+
         # If there are no (valid) credentials available, let the user log in.
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
@@ -32,69 +85,242 @@ class GmailService:
             else:
                 if not os.path.exists(CREDENTIALS_FILE):
                     raise FileNotFoundError(f"Could not find {CREDENTIALS_FILE}. Please ensure it exists.")
-                
+
                 flow = InstalledAppFlow.from_client_secrets_file(
                     CREDENTIALS_FILE, SCOPES)
                 self.creds = flow.run_local_server(port=0)
-            
+
             # Save the credentials for the next run
             with open(TOKEN_FILE, 'w') as token:
                 token.write(self.creds.to_json())
 
         self.service = build('gmail', 'v1', credentials=self.creds)
 
-    def fetch_emails(self, max_results=10):
+    def _new_http(self):
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+
+        if self.creds:
+            return AuthorizedHttp(self.creds, http=httplib2.Http(timeout=60))
+        return httplib2.Http(timeout=60)
+
+    def _thread_http(self):
+        # httplib2 connections are not thread-safe: one per worker thread
+        if not hasattr(self._local, 'http'):
+            self._local.http = self._new_http()
+        return self._local.http
+
+    @instrumented("gmail")
+    def fetch_emails(self, max_results=10, format='full', query: Optional[str] = None):
+        """
+        Fetches up to `max_results` of the most recent messages.
+
+        Ids are listed page by page, then messages are downloaded in batch
+        requests (BATCH_SIZE calls each, `max_workers` batches in flight).
+        `format='metadata'` only downloads headers and the snippet.
+        """
+        if not self.service:
+            self.authenticate()
+
+        ids = self.list_message_ids(max_results, query=query)
+        return [self._parse_message(msg) for msg in self.get_messages(ids, format=format)]
+
+    @instrumented("gmail")
+    def list_message_ids(self, max_results=10, query: Optional[str] = None) -> List[str]:
+        if not self.service:
+            self.authenticate()
+
+        ids = []
+        page_token = None
+        while len(ids) < max_results:
+            results = self.service.users().messages().list(
+                userId='me',
+                maxResults=min(LIST_PAGE_SIZE, max_results - len(ids)),
+                pageToken=page_token,
+                q=query,
+                fields='messages/id,nextPageToken',
+            ).execute()
+            ids.extend(m['id'] for m in results.get('messages', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        return ids[:max_results]
+
+    @instrumented("gmail")
+    def get_messages(self, ids: List[str], format='full', retries: int = 3) -> List[Dict]:
+        """Downloads raw message resources in input order; deleted or repeatedly failing ids are skipped."""
+        if not self.service:
+            self.authenticate()
+
+        messages: Dict[str, Dict] = {}
+        pending = list(dict.fromkeys(ids))
+        for attempt in range(retries + 1):
+            if not pending:
+                break
+            if attempt:
+                # Rate-limited or failed parts of a batch: back off, then retry only those
+                time.sleep(min(2 ** (attempt - 1), 16))
+            chunks = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as pool:
+                for chunk_result in pool.map(lambda chunk: self._get_batch(chunk, format), chunks):
+                    messages.update(chunk_result)
+            pending = [i for i in pending if i not in messages]
+
+        return [messages[i] for i in ids if messages.get(i)]
+
+    def _get_batch(self, ids: List[str], format: str) -> Dict[str, Dict]:
+        import httplib2
+        from googleapiclient.errors import HttpError
+
+        results = {}
+
+        def on_response(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                # Deleted since it was listed: recorded as None so it is not retried
+                results[request_id] = None
+            else:
+                status = getattr(getattr(exception, 'resp', None), 'status', None)
+                get_telemetry().record_error('gmail', 'messages.get', f'{type(exception).__name__} {status or ""}'.strip())
+
+        batch = self.service.new_batch_http_request(callback=on_response)
+        messages = self.service.users().messages()
+        for message_id in ids:
+            kwargs = {'userId': 'me', 'id': message_id, 'format': format, 'fields': MESSAGE_FIELDS.get(format)}
+            if format == 'metadata':
+                kwargs['metadataHeaders'] = METADATA_HEADERS
+            batch.add(messages.get(**kwargs), request_id=message_id)
+        start = time.perf_counter()
+        try:
+            batch.execute(http=self._thread_http())
+        except (HttpError, OSError, httplib2.HttpLib2Error) as e:
+            # The whole batch failed: its messages are retried in the next round
+            get_telemetry().record_call('gmail', 'batch', time.perf_counter() - start, e)
+        else:
+            get_telemetry().record_call('gmail', 'batch', time.perf_counter() - start)
+        return results
+
+    @instrumented("gmail")
+    def sync(self, store: InboxStore, max_results=500, format='full') -> Dict[str, int]:
+        """
+        Brings `store` up to date with the mailbox.
+
+        After the first (full) sync only the changes since the stored historyId
+        are pulled via users.history.list: new messages are downloaded, deleted
+        ones removed and label changes applied to the stored emails. If Gmail no
+        longer has that history (404), falls back to a full resync of the most
+        recent `max_results` messages, which also removes stored emails that
+        are no longer in the mailbox. Returns counts of what changed.
+        """
+        from googleapiclient.errors import HttpError
+
         if not self.service:
             self.authenticate()
 
-        results = self.service.users().messages().list(userId='me', maxResults=max_results).execute()
-        messages = results.get('messages', [])
-
-        emails = []
-        for message in messages:
-            msg = self.service.users().messages().get(userId='me', id=message['id']).execute()
-            
-            # Extract headers
-            headers = msg['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-            date_str = next((h['value'] for h in headers if h['name'] == 'Date'), '')
-            
-            # Extract Body
-            body = ""
-            if 'parts' in msg['payload']:
-                for part in msg['payload']['parts']:
-                    if part['mimeType'] == 'text/plain':
-                        data = part['body'].get('data')
-                        if data:
-                            body = base64.urlsafe_b64decode(data).decode()
-                            break
-            elif 'body' in msg['payload']:
-                 data = msg['payload']['body'].get('data')
-                 if data:
-                    body = base64.urlsafe_b64decode(data).decode()
-
-            # Clean body if it's HTML (fallback)
-            if not body:
-                 # Try to get html part if plain text failed
-                if 'parts' in msg['payload']:
-                    for part in msg['payload']['parts']:
-                        if part['mimeType'] == 'text/html':
-                            data = part['body'].get('data')
-                            if data:
-                                html_content = base64.urlsafe_b64decode(data).decode()
-                                soup = BeautifulSoup(html_content, 'html.parser')
-                                body = soup.get_text()
-                                break
-            
-            # Create Email Object
-            email = Email(
-                id=msg['id'],
-                sender=sender,
-                subject=subject,
-                body=body[:2000], # Truncate for LLM context limits
-                timestamp=date_str or datetime.now().isoformat()
-            )
-            emails.append(email)
-            
-        return emails
+        history_id = self._load_sync_state().get('historyId')
+        if history_id:
+            try:
+                return self._sync_history(store, history_id, format)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+        return self._sync_full(store, max_results, format)
+
+    def _sync_full(self, store: InboxStore, max_results: int, format: str) -> Dict[str, int]:
+        # Read the historyId first so changes made while we fetch are picked up next time
+        history_id = self.service.users().getProfile(userId='me', fields='historyId').execute()['historyId']
+        ids = self.list_message_ids(max_results)
+        emails = [self._parse_message(msg) for msg in self.get_messages(ids, format=format)]
+        store.upsert_many(merge_with_saved(emails, store))
+
+        listed = set(ids)
+        missing = [email for email in store.load_all() if email.id not in listed]
+        if len(ids) >= max_results:
+            # Only the newest messages were listed: older stored emails may still be in the mailbox
+            oldest = min((parse_timestamp(email.timestamp) for email in emails), default=float("inf"))
+            missing = [email for email in missing if parse_timestamp(email.timestamp) >= oldest]
+        deleted = [email.id for email in missing]
+        if deleted:
+            store.delete(deleted)
+        self._save_sync_state({'historyId': history_id})
+        return {'added': len(emails), 'deleted': len(deleted), 'updated': 0, 'full_sync': 1}
+
+    def _sync_history(self, store: InboxStore, start_history_id: str, format: str) -> Dict[str, int]:
+        added, deleted, labels = [], set(), {}
+        page_token = None
+        latest_history_id = start_history_id
+        while True:
+            response = self.service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=HISTORY_TYPES,
+                pageToken=page_token,
+            ).execute()
+            for record in response.get('history', []):
+                for item in record.get('messagesAdded', []):
+                    added.append(item['message']['id'])
+                for item in record.get('messagesDeleted', []):
+                    deleted.add(item['message']['id'])
+                for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                    # The message in the record carries its labels after the change
+                    labels[item['message']['id']] = item['message'].get('labelIds', [])
+            latest_history_id = response.get('historyId', latest_history_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        new_ids = [i for i in dict.fromkeys(added) if i not in deleted]
+        new_emails = [self._parse_message(msg) for msg in self.get_messages(new_ids, format=format)]
+        if new_emails:
+            store.upsert_many(merge_with_saved(new_emails, store))
+        if deleted:
+            store.delete(deleted)
+
+        relabelled = store.get_many(i for i in labels if i not in deleted and i not in new_ids)
+        for email in relabelled.values():
+            email.label_ids = labels[email.id]
+            email.read = 'UNREAD' not in email.label_ids
+        if relabelled:
+            store.upsert_many(relabelled.values())
+
+        self._save_sync_state({'historyId': latest_history_id})
+        return {'added': len(new_emails), 'deleted': len(deleted), 'updated': len(relabelled), 'full_sync': 0}
+
+    def _load_sync_state(self) -> Dict:
+        if os.path.exists(self.sync_state_file):
+            with open(self.sync_state_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def _save_sync_state(self, state: Dict):
+        with open(self.sync_state_file, 'w') as f:
+            json.dump(state, f)
+
+    def _parse_message(self, msg: Dict) -> Email:
+        # Extract headers
+        headers = msg['payload']['headers']
+        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+        sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
+        date_str = next((h['value'] for h in headers if h['name'] == 'Date'), '')
+
+        # Extract Body
+        body = extract_body(msg['payload'], max_chars=self.body_char_limit)
+
+        # Metadata-only fetches have no body, fall back to Gmail's snippet
+        if not body:
+            body = msg.get('snippet', '')
+
+        # Create Email Object
+        label_ids = msg.get('labelIds', [])
+        return Email(
+            id=msg['id'],
+            sender=sender,
+            subject=subject,
+            body=body,
+            timestamp=date_str or datetime.now().isoformat(),
+            read='UNREAD' not in label_ids,
+            label_ids=label_ids,
+            thread_id=msg.get('threadId'),
+            simhash=simhash(f"{subject}\n{body}")
+        )
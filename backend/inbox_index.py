@@ -0,0 +1,241 @@
+import itertools
+import sys
+from array import array
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, List, MutableMapping, Optional, Set
+
+from backend.models import Email
+from backend.retrieval import tokenize
+
+SORT_KEYS = ("timestamp", "sender", "subject", "category")
+# Shared by all indexes, so a version never repeats even when the index is replaced
+_VERSIONS = itertools.count(1)
+
+
+@dataclass
+class QueryResult:
+    emails: List[Email]
+    total: int
+    # category -> number of matching emails, ignoring the category filter itself
+    facets: Dict[Optional[str], int] = field(default_factory=dict)
+
+
+def parse_timestamp(value: str) -> float:
+    """Epoch seconds for ISO 8601 or RFC 2822 dates; 0 if unparseable."""
+    if not value:
+        return 0.0
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            parsed = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0.0
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class InboxIndex:
+    """
+    In-memory query layer over the inbox: an id map plus inverted indexes on
+    category, sender and subject/body tokens, and lazily built sort orders.
+    Filters intersect index sets, so queries avoid scanning every email.
+
+    The emails themselves live in `store` (a dict by default, or e.g. a
+    CompactEmailMapping); emails already in the store are indexed too.
+    """
+
+    def __init__(self, emails: Iterable[Email] = (), store: Optional[MutableMapping[str, Email]] = None):
+        self.by_id: MutableMapping[str, Email] = {} if store is None else store
+        self._by_category: Dict[Optional[str], Set[str]] = {}
+        self._by_sender: Dict[str, Set[str]] = {}
+        self._by_token: Dict[str, Set[str]] = {}
+        self._timestamps: Dict[str, float] = {}
+        # Tokens each email was indexed under, as packed token numbers (see _token_names)
+        self._tokens: Dict[str, array] = {}
+        self._token_numbers: Dict[str, int] = {}
+        self._token_names: List[str] = []
+        # (category, sender) each email was indexed under; emails may be mutated in place
+        self._keys: Dict[str, tuple] = {}
+        self._sorted: Dict[str, List[str]] = {}
+        # Bumped on every change; lets callers cache anything derived from the index
+        self.version = next(_VERSIONS)
+        for email_id in list(self.by_id):
+            self._index(self.by_id[email_id])
+        for email in emails:
+            self._insert(email)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __contains__(self, email_id: str) -> bool:
+        return email_id in self.by_id
+
+    def get(self, email_id: str) -> Optional[Email]:
+        return self.by_id.get(email_id)
+
+    def ids(self) -> List[str]:
+        return list(self.by_id)
+
+    def upsert(self, email: Email):
+        if email.id in self.by_id:
+            # Replaced in the store by _insert, so the store can update it in place
+            self._unindex(email.id)
+        self._insert(email)
+
+    def remove(self, email_id: str):
+        if email_id in self.by_id:
+            self._delete(email_id)
+
+    def memory_usage(self) -> int:
+        """Approximate bytes held by the indexes, not counting the emails in `by_id`."""
+        size = sys.getsizeof
+        total = 0
+        for mapping in (self._by_category, self._by_sender, self._by_token):
+            total += size(mapping) + sum(size(key) + size(ids) for key, ids in mapping.items())
+        total += size(self._timestamps) + len(self._timestamps) * size(0.0)
+        total += size(self._tokens) + sum(map(size, self._tokens.values()))
+        total += size(self._token_numbers) + size(self._token_names) + len(self._token_numbers) * size(0)
+        total += size(self._keys) + sum(map(size, self._keys.values()))
+        total += sum(map(size, self._sorted.values()))
+        return total
+
+    def category_counts(self) -> Dict[Optional[str], int]:
+        return {category: len(ids) for category, ids in self._by_category.items() if ids}
+
+    def query(self, category: Optional[str] = None, sender: Optional[str] = None,
+              text: Optional[str] = None, date_from: Optional[float] = None,
+              date_to: Optional[float] = None, sort_by: str = "timestamp",
+              descending: bool = True, offset: int = 0, limit: Optional[int] = 50,
+              uncategorized: bool = False) -> QueryResult:
+        """
+        Filters (all optional, combined with AND), sorts and pages the inbox.
+        `text` matches emails containing every token of it in subject or body;
+        `uncategorized=True` selects emails without a category.
+        """
+        if sort_by not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key {sort_by!r}, expected one of {SORT_KEYS}")
+
+        # Everything except the category filter, for facet counts
+        base = self._filter(sender, text, date_from, date_to)
+        if base is None:
+            facets = self.category_counts()
+        else:
+            facets = dict(Counter(self._keys[i][0] for i in base))
+
+        matches = base
+        if category is not None or uncategorized:
+            category_ids = self._by_category.get(None if uncategorized else category, set())
+            matches = category_ids if matches is None else matches & category_ids
+        total = len(self.by_id) if matches is None else len(matches)
+
+        if matches is not None and len(matches) * 8 < len(self.by_id):
+            # Small result set: sorting it beats walking the full sort order
+            order = sorted(matches, key=self._sort_key(sort_by), reverse=descending)
+            page = [self.by_id[i] for i in (order[offset:] if limit is None else order[offset:offset + limit])]
+            return QueryResult(emails=page, total=total, facets=facets)
+
+        order = self._sort_order(sort_by)
+        if descending:
+            order = reversed(order)
+        page = []
+        skipped = 0
+        for email_id in order:
+            if matches is not None and email_id not in matches:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            page.append(self.by_id[email_id])
+            if limit is not None and len(page) >= limit:
+                break
+        return QueryResult(emails=page, total=total, facets=facets)
+
+    def _filter(self, sender, text, date_from, date_to) -> Optional[Set[str]]:
+        # None means "no filter", i.e. every email
+        sets = []
+        if sender:
+            sets.append(self._by_sender.get(sender.lower(), set()))
+        if text:
+            for token in set(tokenize(text)):
+                sets.append(self._by_token.get(token, set()))
+        if not sets and date_from is None and date_to is None:
+            return None
+
+        if sets:
+            sets.sort(key=len)
+            result = set(sets[0])
+            for other in sets[1:]:
+                result &= other
+        else:
+            result = set(self.by_id)
+        if date_from is not None or date_to is not None:
+            low = date_from if date_from is not None else float("-inf")
+            high = date_to if date_to is not None else float("inf")
+            result = {i for i in result if low <= self._timestamps[i] <= high}
+        return result
+
+    def _sort_order(self, sort_by: str) -> List[str]:
+        order = self._sorted.get(sort_by)
+        if order is None:
+            order = sorted(self.by_id, key=self._sort_key(sort_by))
+            self._sorted[sort_by] = order
+        return order
+
+    def _sort_key(self, sort_by: str):
+        if sort_by == "timestamp":
+            return self._timestamps.__getitem__
+        # Stores that can read a single field avoid loading whole emails
+        field = getattr(self.by_id, "field", None)
+        if field is not None:
+            return lambda email_id: (field(email_id, sort_by) or "").lower()
+        return lambda email_id: (getattr(self.by_id[email_id], sort_by) or "").lower()
+
+    def _insert(self, email: Email):
+        self.by_id[email.id] = email
+        self._index(email)
+
+    def _index(self, email: Email):
+        category, sender = email.category, (email.sender or "").lower()
+        self._keys[email.id] = (category, sender)
+        self._by_category.setdefault(category, set()).add(email.id)
+        self._by_sender.setdefault(sender, set()).add(email.id)
+        self._timestamps[email.id] = parse_timestamp(email.timestamp)
+        tokens = set(tokenize(f"{email.subject or ''} {email.body or ''}"))
+        self._tokens[email.id] = array("I", map(self._token_number, tokens))
+        for token in tokens:
+            self._by_token.setdefault(token, set()).add(email.id)
+        # Sort orders are rebuilt by the next query that needs them: inserting into a list is
+        # O(n) per email, while a sync upserts many emails between two queries
+        self._sorted.clear()
+        self.version = next(_VERSIONS)
+
+    def _token_number(self, token: str) -> int:
+        number = self._token_numbers.get(token)
+        if number is None:
+            number = self._token_numbers[token] = len(self._token_names)
+            self._token_names.append(token)
+        return number
+
+    def _delete(self, email_id: str):
+        self._unindex(email_id)
+        del self.by_id[email_id]
+
+    def _unindex(self, email_id: str):
+        self._sorted.clear()
+        category, sender = self._keys.pop(email_id)
+        self._by_category.get(category, set()).discard(email_id)
+        self._by_sender.get(sender, set()).discard(email_id)
+        self._timestamps.pop(email_id, None)
+        for number in self._tokens.pop(email_id, ()):
+            token = self._token_names[number]
+            ids = self._by_token.get(token)
+            if ids is not None:
+                ids.discard(email_id)
+                if not ids:
+                    del self._by_token[token]
+        self.version = next(_VERSIONS)
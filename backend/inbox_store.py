@@ -0,0 +1,275 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional
+
+from backend.inbox_index import parse_timestamp
+from backend.models import Email, ThreadState
+
+
+class InboxStore(ABC):
+    """Storage engine for processed emails."""
+
+    @abstractmethod
+    def load_all(self) -> List[Email]:
+        pass
+
+    @abstractmethod
+    def replace_all(self, emails: List[Email]):
+        """Replaces the stored inbox with `emails`."""
+        pass
+
+    @abstractmethod
+    def upsert_many(self, emails: Iterable[Email]):
+        pass
+
+    @abstractmethod
+    def get_many(self, email_ids: Iterable[str]) -> Dict[str, Email]:
+        pass
+
+    @abstractmethod
+    def query(self, category: Optional[str] = None, offset: int = 0, limit: int = 50,
+              newest_first: bool = True) -> List[Email]:
+        """Returns one page of emails, optionally filtered by category, ordered by timestamp."""
+        pass
+
+    @abstractmethod
+    def count(self, category: Optional[str] = None) -> int:
+        pass
+
+    @abstractmethod
+    def delete(self, email_ids: Iterable[str]):
+        pass
+
+    def upsert(self, email: Email):
+        self.upsert_many([email])
+
+    def get(self, email_id: str) -> Optional[Email]:
+        return self.get_many([email_id]).get(email_id)
+
+    # --- Conversations ---
+    # Defaults scan all emails and do not keep thread states (every run re-seeds the
+    # summary from the stored messages); SQLiteInboxStore overrides them.
+
+    def get_thread(self, thread_id: str) -> List[Email]:
+        """The stored messages of a conversation, in storage order."""
+        return [email for email in self.load_all() if email.thread_id == thread_id]
+
+    def thread_sizes(self, thread_ids: Iterable[str]) -> Dict[str, int]:
+        """Number of stored messages per thread id (threads without messages are left out)."""
+        wanted = set(thread_ids)
+        sizes: Dict[str, int] = {}
+        for email in self.load_all():
+            if email.thread_id in wanted:
+                sizes[email.thread_id] = sizes.get(email.thread_id, 0) + 1
+        return sizes
+
+    def get_thread_state(self, thread_id: str) -> Optional[ThreadState]:
+        return None
+
+    def save_thread_state(self, state: ThreadState):
+        pass
+
+
+class JSONInboxStore(InboxStore):
+    """The original single-file format. Every write rewrites the whole file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load_all(self) -> List[Email]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as f:
+            return [Email(**item) for item in json.load(f)]
+
+    def replace_all(self, emails: List[Email]):
+        with self._lock:
+            self._write(emails)
+
+    def upsert_many(self, emails: Iterable[Email]):
+        with self._lock:
+            current = {email.id: email for email in self.load_all()}
+            for email in emails:
+                current[email.id] = email
+            self._write(list(current.values()))
+
+    def get_many(self, email_ids: Iterable[str]) -> Dict[str, Email]:
+        wanted = set(email_ids)
+        return {email.id: email for email in self.load_all() if email.id in wanted}
+
+    def query(self, category: Optional[str] = None, offset: int = 0, limit: int = 50,
+              newest_first: bool = True) -> List[Email]:
+        emails = [e for e in self.load_all() if category is None or e.category == category]
+        emails.sort(key=lambda e: parse_timestamp(e.timestamp), reverse=newest_first)
+        return emails[offset:offset + limit]
+
+    def count(self, category: Optional[str] = None) -> int:
+        return sum(1 for e in self.load_all() if category is None or e.category == category)
+
+    def delete(self, email_ids: Iterable[str]):
+        doomed = set(email_ids)
+        with self._lock:
+            self._write([e for e in self.load_all() if e.id not in doomed])
+
+    def _write(self, emails: List[Email]):
+        with open(self.path, "w") as f:
+            json.dump([email.model_dump() for email in emails], f, indent=2)
+
+
+class SQLiteInboxStore(InboxStore):
+    """
+    SQLite engine in WAL mode: single-email upserts are O(1) and concurrent
+    sessions/processes can read while one writes. The full Email is stored as
+    JSON next to indexed columns used for filtering, ordering and grouping
+    into threads. Timestamps come as RFC 2822 or ISO 8601 text, so emails are
+    ordered by `sort_time`, the timestamp as epoch seconds. Conversation
+    summaries live in their own table.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS emails (
+                id TEXT PRIMARY KEY,
+                sender TEXT,
+                category TEXT,
+                timestamp TEXT,
+                -- The timestamp as epoch seconds, for ordering
+                sort_time REAL,
+                thread_id TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_emails_thread ON emails(thread_id);
+            CREATE INDEX IF NOT EXISTS idx_emails_category_time ON emails(category, sort_time);
+            CREATE INDEX IF NOT EXISTS idx_emails_sort_time ON emails(sort_time);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS threads (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            """
+        )
+        self._conn.commit()
+
+    def load_all(self) -> List[Email]:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM emails ORDER BY rowid").fetchall()
+        return [Email.model_validate_json(data) for (data,) in rows]
+
+    def replace_all(self, emails: List[Email]):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM emails")
+            self._conn.executemany(self._UPSERT, [self._row(e) for e in emails])
+
+    def upsert_many(self, emails: Iterable[Email]):
+        with self._lock, self._conn:
+            self._conn.executemany(self._UPSERT, [self._row(e) for e in emails])
+
+    def get_many(self, email_ids: Iterable[str]) -> Dict[str, Email]:
+        ids = list(email_ids)
+        found = {}
+        with self._lock:
+            # Stay below SQLite's bound-parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(f"SELECT data FROM emails WHERE id IN ({placeholders})", chunk).fetchall()
+                for (data,) in rows:
+                    email = Email.model_validate_json(data)
+                    found[email.id] = email
+        return found
+
+    def query(self, category: Optional[str] = None, offset: int = 0, limit: int = 50,
+              newest_first: bool = True) -> List[Email]:
+        order = "DESC" if newest_first else "ASC"
+        sql = "SELECT data FROM emails"
+        params: list = []
+        if category is not None:
+            sql += " WHERE category = ?"
+            params.append(category)
+        sql += f" ORDER BY sort_time {order} LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [Email.model_validate_json(data) for (data,) in rows]
+
+    def count(self, category: Optional[str] = None) -> int:
+        with self._lock:
+            if category is None:
+                return self._conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM emails WHERE category = ?", (category,)).fetchone()[0]
+
+    def delete(self, email_ids: Iterable[str]):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM emails WHERE id = ?", [(i,) for i in email_ids])
+
+    def get_thread(self, thread_id: str) -> List[Email]:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM emails WHERE thread_id = ? ORDER BY rowid",
+                                      (thread_id,)).fetchall()
+        return [Email.model_validate_json(data) for (data,) in rows]
+
+    def thread_sizes(self, thread_ids: Iterable[str]) -> Dict[str, int]:
+        ids = list(set(thread_ids))
+        sizes = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                sizes.update(self._conn.execute(
+                    f"SELECT thread_id, COUNT(*) FROM emails WHERE thread_id IN ({placeholders}) GROUP BY thread_id",
+                    chunk
+                ).fetchall())
+        return sizes
+
+    def get_thread_state(self, thread_id: str) -> Optional[ThreadState]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM threads WHERE id = ?", (thread_id,)).fetchone()
+        return ThreadState.model_validate_json(row[0]) if row else None
+
+    def save_thread_state(self, state: ThreadState):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO threads (id, data) VALUES (?, ?)",
+                               (state.thread_id, state.model_dump_json()))
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    _UPSERT = (
+        "INSERT INTO emails (id, sender, category, timestamp, sort_time, thread_id, data) VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET sender = excluded.sender, category = excluded.category, "
+        "timestamp = excluded.timestamp, sort_time = excluded.sort_time, thread_id = excluded.thread_id, "
+        "data = excluded.data"
+    )
+
+    @staticmethod
+    def _row(email: Email) -> tuple:
+        return (email.id, email.sender, email.category, email.timestamp, parse_timestamp(email.timestamp),
+                email.thread_id, email.model_dump_json())
+
+
+def migrate_json_to_sqlite(json_path: str, store: SQLiteInboxStore) -> int:
+    """
+    One-shot import of a JSON inbox into an SQLite store. Runs only once per
+    database; returns the number of emails imported.
+    """
+    if store.get_meta("migrated_from_json") or not os.path.exists(json_path):
+        return 0
+    emails = JSONInboxStore(json_path).load_all()
+    store.upsert_many(emails)
+    store.set_meta("migrated_from_json", json_path)
+    return len(emails)
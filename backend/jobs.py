@@ -0,0 +1,426 @@
+import argparse
+import copy
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from backend.agent import EmailAgent
+from backend.inbox_store import InboxStore
+from backend.models import PromptConfig
+from backend.rate_limiter import backoff_delay
+
+DATA_DIR = "data"
+JOBS_DB_FILE = os.path.join(DATA_DIR, "jobs.sqlite3")
+
+# Tasks that can be handed out at :now: pending and past their backoff, or leased and expired
+_READY = ("((t.status = 'pending' AND (t.not_before IS NULL OR t.not_before <= :now)) "
+          "OR (t.status = 'leased' AND t.lease_expires < :now))")
+# Messages of a conversation are only handed out while none of them is leased or waiting
+# out a backoff, so one worker gets all of them and can process them in order
+_THREAD_FREE = ("(t.thread_id IS NULL OR NOT EXISTS (SELECT 1 FROM tasks o WHERE o.job_id = t.job_id "
+                "AND o.thread_id = t.thread_id AND ((o.status = 'leased' AND o.lease_expires >= :now) "
+                "OR (o.status = 'pending' AND o.not_before > :now))))")
+
+
+@dataclass
+class JobProgress:
+    job_id: str
+    status: str
+    total: int
+    done: int
+    failed: int
+    # Waiting or currently leased by a worker
+    pending: int
+    # Emails per second over the last minute
+    throughput: float
+    llm_calls_saved: int = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.status != "running" or self.pending == 0
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        if not self.throughput:
+            return None
+        return self.pending / self.throughput
+
+
+class JobQueue:
+    """
+    Persistent queue of processing jobs in SQLite. A job is a list of email ids
+    plus the prompts to process them with. Workers (threads or processes) lease
+    a few emails at a time, and all of a conversation's emails at once; a lease that is not completed within `lease_seconds`
+    (e.g. the worker crashed) expires and the emails are handed out again, up
+    to `max_attempts` times. Failed emails are retried after a jittered
+    exponential backoff of `retry_delay` seconds and up, at most `max_retry_delay`.
+    """
+
+    def __init__(self, path: str = JOBS_DB_FILE, lease_seconds: float = 600, max_attempts: int = 3,
+                 retry_delay: float = 5.0, max_retry_delay: float = 300.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Autocommit; leases use explicit BEGIN IMMEDIATE transactions
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                created REAL NOT NULL,
+                status TEXT NOT NULL,
+                prompts TEXT NOT NULL,
+                force INTEGER NOT NULL DEFAULT 0,
+                llm_calls_saved INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                job_id TEXT NOT NULL,
+                email_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                lease_owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                finished REAL,
+                -- A failed email waits until then before it is handed out again
+                not_before REAL,
+                thread_id TEXT,
+                PRIMARY KEY (job_id, email_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(job_id, status, position);
+            CREATE INDEX IF NOT EXISTS idx_tasks_thread ON tasks(job_id, thread_id);
+            """
+        )
+
+    def create_job(self, email_ids: Iterable[str], prompts: PromptConfig, force: bool = False,
+                   thread_ids: Optional[Dict[str, str]] = None) -> str:
+        """`thread_ids` maps email ids to their conversation; a conversation's emails are leased together."""
+        job_id = uuid.uuid4().hex[:12]
+        ids = list(dict.fromkeys(email_ids))
+        thread_ids = thread_ids or {}
+        with self._lock, self._transaction():
+            self._conn.execute(
+                "INSERT INTO jobs (id, created, status, prompts, force) VALUES (?, ?, 'running', ?, ?)",
+                (job_id, time.time(), prompts.model_dump_json(), int(force)),
+            )
+            self._conn.executemany(
+                "INSERT INTO tasks (job_id, email_id, position, status, thread_id) VALUES (?, ?, ?, 'pending', ?)",
+                [(job_id, email_id, position, thread_ids.get(email_id)) for position, email_id in enumerate(ids)],
+            )
+        return job_id
+
+    def job_settings(self, job_id: str):
+        """(prompts, force) the job was created with."""
+        with self._lock:
+            prompts, force = self._conn.execute("SELECT prompts, force FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return PromptConfig.model_validate_json(prompts), bool(force)
+
+    def next_job(self) -> Optional[str]:
+        """The oldest running job that has emails to hand out now."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT j.id FROM jobs j WHERE j.status = 'running' AND EXISTS ("
+                f" SELECT 1 FROM tasks t WHERE t.job_id = j.id AND {_READY} AND {_THREAD_FREE})"
+                " ORDER BY j.created LIMIT 1",
+                {"now": now},
+            ).fetchone()
+        return row[0] if row else None
+
+    def retry_wait(self) -> Optional[float]:
+        """Seconds until a failed email of a running job may be retried, None if none is waiting."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(t.not_before) FROM tasks t JOIN jobs j ON j.id = t.job_id "
+                "WHERE j.status = 'running' AND t.status = 'pending' AND t.not_before IS NOT NULL"
+            ).fetchone()
+        return max(0.0, row[0] - time.time()) if row[0] is not None else None
+
+    def latest_job(self) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM jobs ORDER BY created DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def lease(self, owner: str, job_id: str, limit: int = 1) -> List[str]:
+        """
+        Atomically hands up to `limit` emails of the job to `owner`, plus the
+        other emails of their conversations; returns their ids.
+        """
+        now = time.time()
+        with self._lock, self._transaction():
+            # Expired leases that used up their attempts are given up on
+            self._conn.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired' "
+                "WHERE job_id = ? AND status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (job_id, now, self.max_attempts),
+            )
+            rows = self._conn.execute(
+                f"SELECT t.email_id, t.thread_id FROM tasks t WHERE t.job_id = :job AND {_READY} AND {_THREAD_FREE} "
+                "ORDER BY t.position LIMIT :limit",
+                {"job": job_id, "now": now, "limit": limit},
+            ).fetchall()
+            ids = [email_id for email_id, _ in rows]
+            for thread_id in dict.fromkeys(thread_id for _, thread_id in rows if thread_id):
+                ids += [email_id for (email_id,) in self._conn.execute(
+                    f"SELECT t.email_id FROM tasks t WHERE t.job_id = :job AND t.thread_id = :thread AND {_READY} "
+                    "ORDER BY t.position",
+                    {"job": job_id, "thread": thread_id, "now": now},
+                ).fetchall()]
+            ids = list(dict.fromkeys(ids))
+            self._conn.executemany(
+                "UPDATE tasks SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE job_id = ? AND email_id = ?",
+                [(owner, now + self.lease_seconds, job_id, email_id) for email_id in ids],
+            )
+            self._finish_if_done(job_id)
+        return ids
+
+    def complete(self, owner: str, job_id: str, email_ids: Iterable[str], llm_calls_saved: int = 0) -> bool:
+        """Marks emails done (only if `owner` still holds them); returns True once the job is finished."""
+        with self._lock, self._transaction():
+            self._conn.executemany(
+                "UPDATE tasks SET status = 'done', finished = ?, error = NULL "
+                "WHERE job_id = ? AND email_id = ? AND lease_owner = ? AND status = 'leased'",
+                [(time.time(), job_id, email_id, owner) for email_id in email_ids],
+            )
+            if llm_calls_saved:
+                self._conn.execute(
+                    "UPDATE jobs SET llm_calls_saved = llm_calls_saved + ? WHERE id = ?", (llm_calls_saved, job_id)
+                )
+            return self._finish_if_done(job_id)
+
+    def fail(self, owner: str, job_id: str, failures: Dict[str, str]) -> bool:
+        """
+        Releases failed emails for another attempt after a backoff, or gives
+        up after `max_attempts`.
+        """
+        now = time.time()
+        with self._lock, self._transaction():
+            rows = []
+            for email_id, error in failures.items():
+                row = self._conn.execute(
+                    "SELECT attempts FROM tasks WHERE job_id = ? AND email_id = ? AND lease_owner = ? AND status = 'leased'",
+                    (job_id, email_id, owner),
+                ).fetchone()
+                if row is None:
+                    continue
+                attempts = row[0]
+                retry_at = now + backoff_delay(attempts, self.retry_delay, self.max_retry_delay)
+                rows.append(("failed" if attempts >= self.max_attempts else "pending", error, retry_at, job_id, email_id))
+            self._conn.executemany(
+                "UPDATE tasks SET status = ?, error = ?, not_before = ?, lease_owner = NULL, lease_expires = NULL "
+                "WHERE job_id = ? AND email_id = ?",
+                rows,
+            )
+            return self._finish_if_done(job_id)
+
+    def cancel(self, job_id: str):
+        """Stops the job; its emails that are not done yet are never handed out again."""
+        with self._lock, self._transaction():
+            cancelled = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status = 'running'", (job_id,)
+            ).rowcount
+            if cancelled:
+                self._conn.execute(
+                    "UPDATE tasks SET status = 'cancelled', lease_owner = NULL, lease_expires = NULL "
+                    "WHERE job_id = ? AND status IN ('pending', 'leased')",
+                    (job_id,),
+                )
+
+    def progress(self, job_id: str, window: float = 60.0) -> Optional[JobProgress]:
+        now = time.time()
+        with self._lock:
+            job = self._conn.execute(
+                "SELECT status, created, llm_calls_saved FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+            recent_done = self._conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status = 'done' AND finished >= ?",
+                (job_id, now - window),
+            ).fetchone()[0]
+
+        status, created, llm_calls_saved = job
+        elapsed = now - max(created, now - window)
+        return JobProgress(
+            job_id=job_id,
+            status=status,
+            total=sum(counts.values()),
+            done=counts.get("done", 0),
+            failed=counts.get("failed", 0),
+            pending=counts.get("pending", 0) + counts.get("leased", 0),
+            throughput=recent_done / elapsed if recent_done and elapsed > 0 else 0.0,
+            llm_calls_saved=llm_calls_saved,
+        )
+
+    def errors(self, job_id: str) -> Dict[str, str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT email_id, error FROM tasks WHERE job_id = ? AND status = 'failed'", (job_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def _finish_if_done(self, job_id: str) -> bool:
+        remaining = self._conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status IN ('pending', 'leased')", (job_id,)
+        ).fetchone()[0]
+        if remaining:
+            return False
+        self._conn.execute("UPDATE jobs SET status = 'done' WHERE id = ? AND status = 'running'", (job_id,))
+        return True
+
+    def _transaction(self):
+        return _Transaction(self._conn)
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so concurrent leases never overlap
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class JobWorker:
+    """
+    Background pool that processes queued emails. Each thread leases a chunk
+    of a job (one email, or `agent.batch_size` when the job's prompts batch,
+    plus the rest of their conversations),
+    runs the agent on it and checkpoints the results to `store` before
+    marking them done, so finished work survives reruns and crashes. Any
+    number of workers, in this or other processes, can share one queue.
+    """
+
+    def __init__(self, queue: JobQueue, agent: EmailAgent, store: InboxStore, threads: int = 4,
+                 poll_interval: float = 1.0, owner: Optional[str] = None):
+        self.queue = queue
+        self.agent = agent
+        self.store = store
+        self.threads = max(1, threads)
+        self.poll_interval = poll_interval
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        self._stop.clear()
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._run, args=(f"{self.owner}/{i}",), daemon=True, name=f"job-worker-{i}")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait: bool = True):
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def run_until_idle(self):
+        """Processes queued work on the calling thread until the queue is empty, waiting out retry backoffs."""
+        while True:
+            if self._step(copy.copy(self.agent), f"{self.owner}/main"):
+                continue
+            wait = self.queue.retry_wait()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    def _run(self, owner: str):
+        # Each thread gets its own copy: last_failures etc. are per-run state
+        agent = copy.copy(self.agent)
+        while not self._stop.is_set():
+            try:
+                busy = self._step(agent, owner)
+            except Exception:
+                # e.g. the database is locked for too long; try again after a pause
+                busy = False
+            if not busy:
+                self._stop.wait(self.poll_interval)
+
+    def _step(self, agent: EmailAgent, owner: str) -> bool:
+        job_id = self.queue.next_job()
+        if job_id is None:
+            return False
+        prompts, force = self.queue.job_settings(job_id)
+        email_ids = self.queue.lease(owner, job_id, agent.batch_size if prompts.batch_analysis else 1)
+        if not email_ids:
+            # Another worker got there first
+            return True
+
+        emails = self.store.get_many(email_ids)
+        failures = {email_id: "email not found in the inbox store" for email_id in email_ids if email_id not in emails}
+        try:
+            agent.process_emails(list(emails.values()), prompts, max_workers=1, force=force)
+            failures.update(agent.last_failures)
+        except Exception as e:
+            failures.update({email_id: str(e) for email_id in emails})
+
+        processed = [email for email in emails.values() if email.id not in failures]
+        # Checkpoint first: if we crash before `complete`, the re-leased emails are up to date and skipped
+        self.store.upsert_many(processed)
+        finished = self.queue.complete(owner, job_id, [email.id for email in processed], agent.last_llm_calls_saved)
+        if failures:
+            finished = self.queue.fail(owner, job_id, failures)
+        if finished and agent.preclassifier is not None:
+            agent.preclassifier.save()
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process queued jobs alongside the app (shares data/jobs.sqlite3).")
+    parser.add_argument("--threads", type=int, default=None, help="default: PROCESSING_WORKERS")
+    parser.add_argument("--exit-when-idle", action="store_true", help="stop once the queue is empty")
+    parser.add_argument("--metrics-file", help="keep a Prometheus text file of this worker's metrics up to date")
+    args = parser.parse_args()
+
+    from backend.services import (
+        Settings, create_agent, create_llm_service, create_near_duplicate_index, create_preclassifier,
+        create_preprocessor,
+    )
+    from backend.storage import get_store, load_inbox
+    from backend.telemetry import get_telemetry
+
+    # The app's settings, from the environment
+    settings = Settings.load()
+    inbox = load_inbox()
+    agent = create_agent(create_llm_service(settings, os.getenv("GEMINI_API_KEY")), settings, get_store(),
+                         create_preclassifier(settings, inbox), create_preprocessor(settings),
+                         create_near_duplicate_index(settings, inbox))
+    worker = JobWorker(JobQueue(), agent, get_store(), threads=args.threads or settings.processing_workers)
+    if args.exit_when_idle:
+        worker.run_until_idle()
+        if args.metrics_file:
+            get_telemetry().write_prometheus(args.metrics_file)
+        return
+    worker.start()
+    try:
+        while True:
+            time.sleep(15)
+            if args.metrics_file:
+                get_telemetry().write_prometheus(args.metrics_file)
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+from backend.llm_service import LLMService, chat_context, compose_prompt
+from backend.telemetry import Telemetry, get_telemetry
+
+DATA_DIR = "data"
+CACHE_FILE = os.path.join(DATA_DIR, "llm_cache.sqlite3")
+
+
+def _text(value) -> bool:
+    return isinstance(value, str) and bool(value.strip())
+
+
+def _analysis(value) -> bool:
+    return isinstance(value, dict) and _text(value.get("category")) and isinstance(value.get("tasks"), list)
+
+
+# Results worth keeping per operation; anything else (empty answers, a batch
+# nothing could be read from) is returned once but asked for again next time
+_VALID_RESULTS: Dict[str, Callable] = {
+    "categorize": _text,
+    "extract_actions": lambda value: isinstance(value, list) and all(isinstance(t, str) for t in value),
+    "reply": _text,
+    "chat": _text,
+    "analyze": _analysis,
+    "analyze_thread": lambda value: _analysis(value) and _text(value.get("summary")),
+    "analyze_batch": lambda value: isinstance(value, dict) and bool(value) and all(map(_analysis, value.values())),
+}
+
+
+class CachedLLMService(LLMService):
+    """
+    Wraps any LLMService with a persistent response cache.
+
+    Entries are keyed on the model name, the operation and a hash of the fully
+    rendered prompt, so editing a prompt naturally misses while unchanged emails
+    are served from disk. The least recently used entries are evicted once the
+    cache grows past `max_entries` or `max_bytes`. Only valid results are
+    stored (see _VALID_RESULTS); failed requests raise and store nothing.
+    """
+
+    def __init__(self, inner: LLMService, path: str = CACHE_FILE,
+                 max_entries: int = 10000, max_bytes: int = 50 * 1024 * 1024,
+                 telemetry: Optional[Telemetry] = None):
+        self.inner = inner
+        # Hits and misses per operation are also reported here
+        self.telemetry = telemetry or get_telemetry()
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        self._conn.commit()
+
+    @property
+    def model_name(self) -> str:
+        return getattr(self.inner, "model_name", type(self.inner).__name__)
+
+    @property
+    def supports_structured_output(self) -> bool:
+        return self.inner.supports_structured_output
+
+    # --- LLMService ---
+
+    def categorize_email(self, email_content: str, prompt_template: str) -> str:
+        return self._cached("categorize", compose_prompt(prompt_template, email_content),
+                            lambda: self.inner.categorize_email(email_content, prompt_template))
+
+    def extract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
+        return self._cached("extract_actions", compose_prompt(prompt_template, email_content),
+                            lambda: self.inner.extract_action_items(email_content, prompt_template))
+
+    def generate_reply(self, email_content: str, prompt_template: str) -> str:
+        return self._cached("reply", compose_prompt(prompt_template, email_content),
+                            lambda: self.inner.generate_reply(email_content, prompt_template))
+
+    def chat(self, context: str, user_query: str) -> str:
+        return self._cached("chat", f"Context: {context}\n\nUser Question: {user_query}",
+                            lambda: self.inner.chat(context, user_query))
+
+    def generate_reply_stream(self, email_content: str, prompt_template: str) -> Iterator[str]:
+        return self._cached_stream("reply", compose_prompt(prompt_template, email_content),
+                                   lambda: self.inner.generate_reply_stream(email_content, prompt_template))
+
+    def chat_stream(self, context: str, user_query: str) -> Iterator[str]:
+        return self._cached_stream("chat", f"Context: {context}\n\nUser Question: {user_query}",
+                                   lambda: self.inner.chat_stream(context, user_query))
+
+    def chat_turn(self, context: str, history: List[Dict[str, str]], user_query: str) -> str:
+        return self._cached("chat", f"Context: {chat_context(context, history)}\n\nUser Question: {user_query}",
+                            lambda: self.inner.chat_turn(context, history, user_query))
+
+    def chat_turn_stream(self, context: str, history: List[Dict[str, str]], user_query: str) -> Iterator[str]:
+        return self._cached_stream("chat", f"Context: {chat_context(context, history)}\n\nUser Question: {user_query}",
+                                   lambda: self.inner.chat_turn_stream(context, history, user_query))
+
+    def release_context(self, context: str):
+        self.inner.release_context(context)
+
+    def analyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        return self._cached("analyze", compose_prompt(prompt_template, email_content),
+                            lambda: self.inner.analyze_email(email_content, prompt_template))
+
+    def analyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        return self._cached("analyze_batch", compose_prompt(prompt_template, emails_content),
+                            lambda: self.inner.analyze_batch(emails_content, prompt_template))
+
+    def analyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        return self._cached("analyze_thread", compose_prompt(prompt_template, email_content),
+                            lambda: self.inner.analyze_thread_message(email_content, prompt_template))
+
+    # --- Cache management ---
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def _key(self, operation: str, prompt: str) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return f"{self.model_name}:{operation}:{prompt_hash}"
+
+    def _cached(self, operation: str, prompt: str, compute: Callable):
+        key = self._key(operation, prompt)
+        found, value = self._lookup(key)
+        self.telemetry.record_cache(operation, found)
+        if found:
+            return value
+
+        value = compute()
+        if _VALID_RESULTS[operation](value):
+            self._store(key, value)
+        return value
+
+    def _cached_stream(self, operation: str, prompt: str, stream: Callable) -> Iterator[str]:
+        # Shares entries with the blocking call; a hit is yielded as one chunk.
+        # Only streams that run to completion are stored, not cancelled ones.
+        key = self._key(operation, prompt)
+        found, value = self._lookup(key)
+        self.telemetry.record_cache(operation, found)
+        if found:
+            yield value
+            return
+
+        chunks = []
+        for chunk in stream():
+            chunks.append(chunk)
+            yield chunk
+        value = "".join(chunks).strip()
+        if _VALID_RESULTS[operation](value):
+            self._store(key, value)
+
+    def _lookup(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+                return True, json.loads(row[0])
+            self.misses += 1
+        return False, None
+
+    def _store(self, key: str, value):
+        encoded = json.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, encoded, len(encoded), time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        stale = []
+        for key, entry_size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            stale.append((key,))
+            entries -= 1
+            size -= entry_size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self.evictions += len(stale)
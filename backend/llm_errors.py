@@ -0,0 +1,43 @@
+import re
+from typing import Optional
+
+
+class LLMError(Exception):
+    """Base class for failed LLM requests."""
+
+
+class LLMResponseError(LLMError):
+    """Raised when the model's output does not match the expected format."""
+
+
+class RateLimitError(LLMError):
+    """The provider rejected the request for quota reasons (HTTP 429)."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        # Seconds the provider asked us to wait, if it said
+        self.retry_after = retry_after
+
+
+class TransientLLMError(LLMError):
+    """Timeouts and server-side errors that are worth retrying."""
+
+
+class LLMRequestError(LLMError):
+    """Errors that retrying will not fix, e.g. an invalid API key or a blocked prompt."""
+
+
+_RETRY_AFTER = [
+    re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE),
+    re.compile(r"retry-after:?\s*([\d.]+)", re.IGNORECASE),
+]
+
+
+def parse_retry_after(message: str) -> Optional[float]:
+    """Extracts a retry delay in seconds from a provider error message."""
+    for pattern in _RETRY_AFTER:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
@@ -0,0 +1,119 @@
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from backend.llm_service import LLMService
+
+# Operation names as used by telemetry and the response cache
+OPERATIONS = ("categorize", "extract_actions", "analyze", "analyze_batch", "analyze_thread", "reply", "chat")
+# Names that stand for several operations in a route
+OPERATION_GROUPS = {
+    "classification": ("categorize", "extract_actions", "analyze", "analyze_batch", "analyze_thread"),
+    "drafts": ("reply",),
+}
+
+
+def expand_operations(names) -> List[str]:
+    """Operation names for a list of operation and group names, e.g. ["classification", "chat"]."""
+    operations = []
+    for name in names:
+        name = name.strip()
+        if not name:
+            continue
+        if name not in OPERATION_GROUPS and name not in OPERATIONS:
+            raise ValueError(f"Unknown LLM operation {name!r}, expected one of "
+                             f"{', '.join(list(OPERATION_GROUPS) + list(OPERATIONS))}")
+        operations.extend(op for op in OPERATION_GROUPS.get(name, (name,)) if op not in operations)
+    return operations
+
+
+def _model_name(service: LLMService) -> str:
+    return getattr(service, "model_name", type(service).__name__)
+
+
+class RoutedLLMService(LLMService):
+    """
+    Sends each operation to its own service, e.g. classification to a local
+    model and drafts to Gemini: `routes` maps operation or group names (see
+    OPERATION_GROUPS) to services, everything else goes to `default`.
+
+    Wrap each service in InstrumentedLLMService before routing, so telemetry
+    prices every request by the model that served it.
+    """
+
+    def __init__(self, default: LLMService, routes: Optional[Dict[str, LLMService]] = None):
+        self.default = default
+        self.routes: Dict[str, LLMService] = {}
+        for name, service in (routes or {}).items():
+            for operation in expand_operations([name]):
+                self.routes[operation] = service
+        # The service that served the calling thread's latest request, for `last_usage`
+        self._last = threading.local()
+
+    def route(self, operation: str) -> LLMService:
+        return self.routes.get(operation, self.default)
+
+    @property
+    def model_name(self) -> str:
+        """All models in use, so response cache keys and prompt fingerprints change with the routes."""
+        default = _model_name(self.default)
+        routed = {op: _model_name(service) for op, service in self.routes.items() if _model_name(service) != default}
+        names = [default]
+        # A group routed as a whole is named once, e.g. "gemini-2.5-flash+classification=qwen3"
+        for group, operations in OPERATION_GROUPS.items():
+            if all(op in routed for op in operations) and len({routed[op] for op in operations}) == 1:
+                names.append(f"{group}={routed[operations[0]]}")
+                for op in operations:
+                    del routed[op]
+        names += [f"{op}={routed[op]}" for op in OPERATIONS if op in routed]
+        return "+".join(names)
+
+    @property
+    def supports_structured_output(self) -> bool:
+        return all(self.route(op).supports_structured_output for op in ("analyze", "analyze_batch", "analyze_thread"))
+
+    def last_usage(self) -> Optional[Dict[str, int]]:
+        service = getattr(self._last, "service", None)
+        return service.last_usage() if service is not None else None
+
+    def _use(self, operation: str) -> LLMService:
+        service = self.route(operation)
+        self._last.service = service
+        return service
+
+    # --- LLMService ---
+
+    def categorize_email(self, email_content: str, prompt_template: str) -> str:
+        return self._use("categorize").categorize_email(email_content, prompt_template)
+
+    def extract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
+        return self._use("extract_actions").extract_action_items(email_content, prompt_template)
+
+    def generate_reply(self, email_content: str, prompt_template: str) -> str:
+        return self._use("reply").generate_reply(email_content, prompt_template)
+
+    def chat(self, context: str, user_query: str) -> str:
+        return self._use("chat").chat(context, user_query)
+
+    def generate_reply_stream(self, email_content: str, prompt_template: str) -> Iterator[str]:
+        return self._use("reply").generate_reply_stream(email_content, prompt_template)
+
+    def chat_stream(self, context: str, user_query: str) -> Iterator[str]:
+        return self._use("chat").chat_stream(context, user_query)
+
+    def chat_turn(self, context: str, history: List[Dict[str, str]], user_query: str) -> str:
+        return self._use("chat").chat_turn(context, history, user_query)
+
+    def chat_turn_stream(self, context: str, history: List[Dict[str, str]], user_query: str) -> Iterator[str]:
+        return self._use("chat").chat_turn_stream(context, history, user_query)
+
+    def release_context(self, context: str):
+        self.route("chat").release_context(context)
+
+    def analyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        return self._use("analyze").analyze_email(email_content, prompt_template)
+
+    def analyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        return self._use("analyze_batch").analyze_batch(emails_content, prompt_template)
+
+    def analyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        return self._use("analyze_thread").analyze_thread_message(email_content, prompt_template)
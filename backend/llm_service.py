@@ -1,11 +1,27 @@
 import os
 import json
+import hashlib
 import random
-import google.generativeai as genai
+import threading
+import time
+import datetime
+from collections import OrderedDict
 from abc import ABC, abstractmethod
-from typing import List, Dict
+from typing import Dict, Iterator, List, Optional
+from backend.llm_errors import (
+    LLMError, LLMRequestError, LLMResponseError, RateLimitError, TransientLLMError, parse_retry_after
+)
+from backend.rate_limiter import RateLimiter, RequestScheduler
+
 
 class LLMService(ABC):
+    """
+    Failed requests raise LLMError subclasses (see backend.llm_errors), e.g.
+    RateLimitError once retries are exhausted, never error text as a result.
+    """
+    # Services that can return schema-constrained JSON implement `analyze_email`.
+    supports_structured_output = False
+
     @abstractmethod
     def categorize_email(self, email_content: str, prompt_template: str) -> str:
         pass
@@ -22,48 +38,573 @@ class LLMService(ABC):
     def chat(self, context: str, user_query: str) -> str:
         pass
 
+    def generate_reply_stream(self, email_content: str, prompt_template: str) -> Iterator[str]:
+        """
+        Streaming `generate_reply`: yields the reply in chunks as they arrive.
+        Closing the generator cancels the request. Services without streaming
+        yield the complete reply once.
+        """
+        yield self.generate_reply(email_content, prompt_template)
+
+    def chat_stream(self, context: str, user_query: str) -> Iterator[str]:
+        """Streaming `chat`, see `generate_reply_stream`."""
+        yield self.chat(context, user_query)
+
+    def chat_turn(self, context: str, history: List[Dict[str, str]], user_query: str) -> str:
+        """
+        One turn of a multi-turn chat (see `ChatSession`). `history` holds the
+        earlier turns as {"role": "user" | "assistant", "content": str}. The
+        context is the unchanged start of every turn, so providers can cache
+        it; services without chat support send everything through `chat`.
+        """
+        return self.chat(chat_context(context, history), user_query)
+
+    def chat_turn_stream(self, context: str, history: List[Dict[str, str]], user_query: str) -> Iterator[str]:
+        """Streaming `chat_turn`, see `generate_reply_stream`."""
+        return self.chat_stream(chat_context(context, history), user_query)
+
+    def release_context(self, context: str):
+        """Frees what the provider keeps for a chat context, if anything (see `ChatSession.close`)."""
+
+    def start_chat(self, context: str, key=None, **options) -> "ChatSession":
+        """A multi-turn chat about `context`; see `ChatSession` for `key` and `options`."""
+        return ChatSession(self, context, key, **options)
+
+    def last_usage(self) -> Optional[Dict[str, int]]:
+        """
+        Usage the provider reported for the calling thread's most recent request,
+        as {"input_tokens", "output_tokens", "cached_tokens", "retries"}, where
+        cached_tokens is the part of the input served from the provider's
+        context cache; None if it is not known.
+        Reading it clears it.
+        """
+        return None
+
+    # The analyze_* defaults send the prompt, which asks for JSON, as a plain completion
+    # through `categorize_email` and validate the reply; services with structured output
+    # override them to have the schema enforced.
+
+    def analyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        """
+        Categorizes the email and extracts its action items in a single request.
+        Returns {"category": str, "tasks": List[str]}.
+        """
+        return parse_analysis(strip_code_fence(self.categorize_email(email_content, prompt_template)))
+
+    def analyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        """
+        Analyzes several emails in one request. `emails_content` holds the emails,
+        each tagged with its id. Returns {email_id: {"category": str, "tasks": List[str]}}
+        for every email the model answered correctly; malformed entries are dropped.
+        """
+        return parse_batch_analysis(strip_code_fence(self.categorize_email(emails_content, prompt_template)))
+
+    def analyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        """
+        Analyzes the newest message of a conversation, given the conversation
+        summary so far (part of the rendered prompt). Returns
+        {"category": str, "tasks": List[str], "summary": str} where `summary`
+        is the summary updated with this message.
+        """
+        return parse_thread_analysis(strip_code_fence(self.categorize_email(email_content, prompt_template)))
+
+
+# Schema for the fused categorize + action-extraction response
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "category": {"type": "string"},
+        "tasks": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["category", "tasks"],
+}
+
+
+# Schema for the multi-email analysis response: one entry per email id
+BATCH_ANALYSIS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "id": {"type": "string"},
+            **ANALYSIS_SCHEMA["properties"],
+        },
+        "required": ["id", "category", "tasks"],
+    },
+}
+
+
+# Schema for the per-message conversation analysis: the analysis plus the updated summary
+THREAD_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **ANALYSIS_SCHEMA["properties"],
+        "summary": {"type": "string"},
+    },
+    "required": ["category", "tasks", "summary"],
+}
+
+
+# Token budget for the earlier turns of a chat; older turns are folded into a summary
+CHAT_HISTORY_TOKENS = 1500
+# Most recent exchanges always kept word for word
+CHAT_KEEP_TURNS = 2
+CHAT_SUMMARY_QUERY = (
+    "Summarize the conversation above in at most 150 words for your own later reference: "
+    "the questions asked, the answers given and any facts, names, dates or decisions they mention."
+)
+
+# Chat contexts at least this large are uploaded once as Gemini cached content (the API's
+# minimum is 1,024 tokens for 2.5 Flash); smaller ones only benefit from implicit prefix caching
+CONTEXT_CACHE_MIN_TOKENS = 2048
+CONTEXT_CACHE_TTL_SECONDS = 600
+# Cached contexts kept per service; the least recently used is deleted beyond this
+CONTEXT_CACHE_ENTRIES = 8
+# After a failed upload (e.g. caching unavailable for the key or model), contexts are sent
+# inline for this long before caching is tried again
+CONTEXT_CACHE_RETRY_SECONDS = 600
+CHAT_SYSTEM_INSTRUCTION = "Answer the user's questions using the context below."
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) used for budgeting prompts."""
+    return len(text) // 4 + 1
+
+
+def compose_prompt(prompt_template: str, email_content: str) -> str:
+    """Appends the email to the prompt unless the rendered template already contains it."""
+    if email_content and email_content in prompt_template:
+        return prompt_template
+    return prompt_template + "\n\n" + email_content
+
+
+def format_chat_history(history: List[Dict[str, str]]) -> str:
+    return "\n".join(f"{'User' if turn['role'] == 'user' else 'Assistant'}: {turn['content']}" for turn in history)
+
+
+def chat_context(context: str, history: List[Dict[str, str]]) -> str:
+    """The context followed by the earlier turns, for services that take a single prompt."""
+    if not history:
+        return context
+    return f"{context}\n\nConversation so far:\n{format_chat_history(history)}"
+
+
+class ChatSession:
+    """
+    A conversation about one context (an email, the inbox). The context goes
+    first and unchanged into every request, so the provider can cache it
+    (Gemini explicitly, see `GeminiLLMService.chat_turn`); the earlier turns
+    follow, kept within `history_tokens` by folding the oldest into a running
+    summary (one small extra request, only when the budget is exceeded).
+
+    `key` identifies what the context was built from: callers compare it and
+    start a new session when the email or inbox changed. `close` frees the
+    provider-side cache.
+    """
+
+    def __init__(self, llm: LLMService, context: str, key=None,
+                 history_tokens: int = CHAT_HISTORY_TOKENS, keep_turns: int = CHAT_KEEP_TURNS):
+        self.llm = llm
+        self.context = context
+        self.key = key
+        self.history_tokens = history_tokens
+        self.keep_turns = keep_turns
+        self.summary = ""
+        # Turns not yet folded into the summary, alternating user/assistant
+        self.turns: List[Dict[str, str]] = []
+        self.summarized_turns = 0
+        self._lock = threading.Lock()
+
+    def ask(self, query: str, extra_context: str = "") -> str:
+        """
+        Answers `query` with the context and the conversation so far.
+        `extra_context` is sent with this question only (and remembered as
+        part of it), e.g. emails that became relevant to a follow-up.
+        """
+        question = self._question(query, extra_context)
+        answer = self.llm.chat_turn(self.context, self.history(), question)
+        self._record(question, answer)
+        return answer
+
+    def ask_stream(self, query: str, extra_context: str = "") -> Iterator[str]:
+        """Like `ask`, yielding the answer as it is generated. A stopped answer is remembered as far as it got."""
+        question = self._question(query, extra_context)
+        chunks = []
+        try:
+            for chunk in self.llm.chat_turn_stream(self.context, self.history(), question):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            if chunks:
+                self._record(question, "".join(chunks))
+
+    def history(self) -> List[Dict[str, str]]:
+        """What is sent along with the next question: the summary, then the recent turns."""
+        self._compact()
+        with self._lock:
+            history = []
+            if self.summary:
+                history = [
+                    {"role": "user", "content": f"Summary of our conversation so far: {self.summary}"},
+                    {"role": "assistant", "content": "Understood."},
+                ]
+            return history + list(self.turns)
+
+    def history_size(self) -> int:
+        """Estimated tokens of the history sent with each question."""
+        with self._lock:
+            return estimate_tokens(self.summary) + sum(estimate_tokens(turn["content"]) for turn in self.turns)
+
+    def close(self):
+        self.llm.release_context(self.context)
+
+    def _question(self, query: str, extra_context: str) -> str:
+        if not extra_context:
+            return query
+        return f"Additional context for this question:\n{extra_context}\n\nQuestion: {query}"
+
+    def _record(self, question: str, answer: str):
+        with self._lock:
+            self.turns += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+    def _compact(self):
+        with self._lock:
+            keep = 2 * self.keep_turns
+            if len(self.turns) <= keep:
+                return
+            size = estimate_tokens(self.summary) + sum(estimate_tokens(turn["content"]) for turn in self.turns)
+            if size <= self.history_tokens:
+                return
+            old, summary = self.turns[:-keep], self.summary
+        text = (f"Earlier summary: {summary}\n\n" if summary else "") + format_chat_history(old)
+        try:
+            summary = self.llm.chat(text, CHAT_SUMMARY_QUERY)
+        except LLMError:
+            # Keep the gist rather than failing the question: the latest part of the old turns
+            summary = text[-self.history_tokens * 2:]
+        with self._lock:
+            self.summary = summary
+            self.turns = self.turns[len(old):]
+            self.summarized_turns += len(old) // 2
+
+
+def to_llm_error(error: Exception) -> LLMError:
+    """Maps a Google API client exception to the matching LLMError."""
+    from google.api_core import exceptions as google_exceptions
+
+    if isinstance(error, LLMError):
+        return error
+    message = str(error)
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return RateLimitError(message, retry_after=parse_retry_after(message))
+    if isinstance(error, (google_exceptions.ServerError, google_exceptions.DeadlineExceeded,
+                          TimeoutError, ConnectionError)):
+        return TransientLLMError(message)
+    return LLMRequestError(message)
+
 
 class GeminiLLMService(LLMService):
-    def __init__(self, api_key: str):
+    supports_structured_output = True
+
+    def __init__(self, api_key: str, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, max_retries: int = 5):
+        # Imported here: the SDK takes about a second to import and most code never needs it
+        import google.generativeai as genai
+
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        self.model_name = 'gemini-2.5-flash'
+        self.model = genai.GenerativeModel(self.model_name)
+        # Every request goes through the scheduler: quota budgets, backoff and retries
+        self.scheduler = RequestScheduler(RateLimiter(requests_per_minute, tokens_per_minute), max_retries)
+        self._usage = threading.local()
+        # Chat contexts uploaded as cached content: context hash -> (model, cache, expiry time)
+        self._context_caches: "OrderedDict[str, tuple]" = OrderedDict()
+        # Model name -> time until which uploads are not tried again after a failure
+        self._context_cache_disabled: Dict[str, float] = {}
+        self._context_lock = threading.Lock()
 
-    def categorize_email(self, email_content: str, prompt_template: str) -> str:
-        prompt = prompt_template + "\n\n" + email_content
+    def last_usage(self) -> Optional[Dict[str, int]]:
+        usage = getattr(self._usage, "value", None)
+        self._usage.value = None
+        return usage
+
+    def _set_usage(self, usage_metadata, attempts: int):
+        self._usage.value = None if usage_metadata is None else {
+            "input_tokens": usage_metadata.prompt_token_count,
+            "output_tokens": usage_metadata.candidates_token_count or 0,
+            "cached_tokens": getattr(usage_metadata, "cached_content_token_count", 0) or 0,
+            "retries": attempts - 1,
+        }
+
+    def _generate(self, prompt, model=None, **generation_config) -> str:
+        """Runs one request; `prompt` is a string or a list of chat contents, `model` e.g. a cached-content model."""
+        estimate = estimate_tokens(prompt if isinstance(prompt, str) else json.dumps(prompt))
+        attempts = 0
+
+        def request():
+            nonlocal attempts
+            attempts += 1
+            try:
+                return (model or self.model).generate_content(prompt, generation_config=generation_config or None)
+            except Exception as e:
+                raise to_llm_error(e) from e
+
+        response = self.scheduler.run(request, tokens=estimate)
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            # The estimate only covers the prompt; charge the real total afterwards
+            self.scheduler.limiter.record(usage.total_token_count - estimate)
+        self._set_usage(usage, attempts)
         try:
-            response = self.model.generate_content(prompt)
             return response.text.strip()
-        except Exception as e:
-            return f"Error: {str(e)}"
+        except ValueError as e:
+            # No text, e.g. the response was blocked
+            raise LLMRequestError(str(e)) from e
 
-    def extract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
-        prompt = prompt_template + "\n\n" + email_content
+    def _generate_stream(self, prompt, model=None) -> Iterator[str]:
+        estimate = estimate_tokens(prompt if isinstance(prompt, str) else json.dumps(prompt))
+        attempts = 0
+
+        def start():
+            nonlocal attempts
+            attempts += 1
+            # Errors surface on the first chunk, so it is part of the retried request
+            try:
+                response = (model or self.model).generate_content(prompt, stream=True)
+                chunks = iter(response)
+                return response, chunks, next(chunks, None)
+            except Exception as e:
+                raise to_llm_error(e) from e
+
+        response, chunks, chunk = self.scheduler.run(start, tokens=estimate)
+        usage = None
         try:
-            response = self.model.generate_content(prompt)
-            text = response.text.strip()
-            # Attempt to parse JSON
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0]
-            elif "```" in text:
-                 text = text.split("```")[1].split("```")[0]
-            
-            data = json.loads(text)
-            return data.get("tasks", [])
-        except Exception:
-            return []
+            while chunk is not None:
+                # The last chunk carries the totals
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                # Chunks without text (e.g. only safety ratings) raise on .text
+                if chunk.parts:
+                    yield chunk.text
+                try:
+                    chunk = next(chunks, None)
+                except Exception as e:
+                    raise to_llm_error(e) from e
+            self._set_usage(usage, attempts)
+        finally:
+            # Stop the server-side stream when the caller closes the generator early
+            cancel = getattr(getattr(response, "_iterator", None), "cancel", None)
+            if cancel is not None:
+                cancel()
+
+    def categorize_email(self, email_content: str, prompt_template: str) -> str:
+        prompt = compose_prompt(prompt_template, email_content)
+        return self._generate(prompt)
+
+    def extract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
+        prompt = compose_prompt(prompt_template, email_content)
+        return parse_action_items(self._generate(prompt))
 
     def generate_reply(self, email_content: str, prompt_template: str) -> str:
-        prompt = prompt_template + "\n\n" + email_content
-        try:
-            response = self.model.generate_content(prompt)
-            return response.text.strip()
-        except Exception as e:
-            return f"Error generating draft: {str(e)}"
+        prompt = compose_prompt(prompt_template, email_content)
+        return self._generate(prompt)
 
     def chat(self, context: str, user_query: str) -> str:
         prompt = f"Context: {context}\n\nUser Question: {user_query}\n\nAnswer:"
+        return self._generate(prompt)
+
+    def generate_reply_stream(self, email_content: str, prompt_template: str) -> Iterator[str]:
+        prompt = compose_prompt(prompt_template, email_content)
+        return self._generate_stream(prompt)
+
+    def chat_stream(self, context: str, user_query: str) -> Iterator[str]:
+        prompt = f"Context: {context}\n\nUser Question: {user_query}\n\nAnswer:"
+        return self._generate_stream(prompt)
+
+    def chat_turn(self, context: str, history: List[Dict[str, str]], user_query: str) -> str:
+        model = self._context_model(context)
+        if model is None:
+            return super().chat_turn(context, history, user_query)
+        return self._generate(chat_contents(history, user_query), model=model)
+
+    def chat_turn_stream(self, context: str, history: List[Dict[str, str]], user_query: str) -> Iterator[str]:
+        model = self._context_model(context)
+        if model is None:
+            return super().chat_turn_stream(context, history, user_query)
+        return self._generate_stream(chat_contents(history, user_query), model=model)
+
+    def release_context(self, context: str):
+        with self._context_lock:
+            entry = self._context_caches.pop(self._context_key(context), None)
+        if entry is not None:
+            self._delete_cache(entry[1])
+
+    def _context_model(self, context: str):
+        """
+        A model bound to `context` uploaded as cached content, so chat turns
+        only send the conversation. None for contexts too small to cache or
+        when caching is unavailable; the context is then sent every turn.
+        """
+        if estimate_tokens(context) < CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        key = self._context_key(context)
+        with self._context_lock:
+            entry = self._context_caches.get(key)
+            # A little margin, so the cache does not expire mid-request
+            if entry is not None and entry[2] > time.time() + 30:
+                self._context_caches.move_to_end(key)
+                return entry[0]
+            if self._context_cache_disabled.get(self.model_name, 0) > time.time():
+                return None
+
+        import google.generativeai as genai
+        from google.generativeai import caching
+
+        def create():
+            try:
+                return caching.CachedContent.create(
+                    model=f"models/{self.model_name}",
+                    system_instruction=CHAT_SYSTEM_INSTRUCTION,
+                    contents=[f"Context: {context}"],
+                    ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS),
+                )
+            except Exception as e:
+                raise to_llm_error(e) from e
+
         try:
-            response = self.model.generate_content(prompt)
-            return response.text.strip()
-        except Exception as e:
-            return f"Error: {str(e)}"
+            # Uploading counts against the same quota as requests
+            cache = self.scheduler.run(create, tokens=estimate_tokens(context))
+            model = genai.GenerativeModel.from_cached_content(cache)
+        except Exception:
+            # E.g. caching is not available for this key or model: send the context every turn for a while
+            with self._context_lock:
+                self._context_cache_disabled[self.model_name] = time.time() + CONTEXT_CACHE_RETRY_SECONDS
+            return None
+
+        evicted = []
+        with self._context_lock:
+            self._context_caches[key] = (model, cache, time.time() + CONTEXT_CACHE_TTL_SECONDS)
+            while len(self._context_caches) > CONTEXT_CACHE_ENTRIES:
+                evicted.append(self._context_caches.popitem(last=False)[1][1])
+        for old in evicted:
+            self._delete_cache(old)
+        return model
+
+    @staticmethod
+    def _context_key(context: str) -> str:
+        return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _delete_cache(cache):
+        try:
+            cache.delete()
+        except Exception:
+            # Expires on its own anyway
+            pass
+
+    def analyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        prompt = compose_prompt(prompt_template, email_content)
+        text = self._generate(
+            prompt,
+            response_mime_type="application/json",
+            response_schema=ANALYSIS_SCHEMA,
+        )
+        return parse_analysis(text)
+
+    def analyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        prompt = compose_prompt(prompt_template, emails_content)
+        text = self._generate(
+            prompt,
+            response_mime_type="application/json",
+            response_schema=BATCH_ANALYSIS_SCHEMA,
+        )
+        return parse_batch_analysis(text)
+
+    def analyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        prompt = compose_prompt(prompt_template, email_content)
+        text = self._generate(
+            prompt,
+            response_mime_type="application/json",
+            response_schema=THREAD_ANALYSIS_SCHEMA,
+        )
+        return parse_thread_analysis(text)
+
+
+def chat_contents(history: List[Dict[str, str]], user_query: str) -> List[Dict]:
+    """The turns as Gemini chat contents, ending with the new question."""
+    contents = [{"role": "user" if turn["role"] == "user" else "model", "parts": [turn["content"]]} for turn in history]
+    return contents + [{"role": "user", "parts": [user_query]}]
+
+
+def strip_code_fence(text: str) -> str:
+    """The content of a Markdown code fence in `text` (e.g. ```json ... ```), or `text` itself."""
+    if "```json" in text:
+        return text.split("```json")[1].split("```")[0]
+    if "```" in text:
+        return text.split("```")[1].split("```")[0]
+    return text
+
+
+def parse_action_items(text: str) -> List[str]:
+    """
+    The "tasks" list of an action extraction response (JSON, possibly in a
+    code fence), raising LLMResponseError if it is malformed.
+    """
+    try:
+        data = json.loads(strip_code_fence(text))
+    except json.JSONDecodeError as e:
+        raise LLMResponseError(f"Action extraction response is not valid JSON: {e}") from e
+    tasks = data.get("tasks") if isinstance(data, dict) else None
+    if not isinstance(tasks, list) or not all(isinstance(t, str) for t in tasks):
+        raise LLMResponseError("Action extraction response has no valid 'tasks' list")
+    return tasks
+
+
+def parse_analysis(text: str) -> Dict:
+    """Validates a fused analysis response, raising LLMResponseError if it is malformed."""
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise LLMResponseError(f"Analysis response is not valid JSON: {e}") from e
+    return validate_analysis(data)
+
+
+def validate_analysis(data) -> Dict:
+    """Checks a decoded analysis object, raising LLMResponseError if it is malformed."""
+    if not isinstance(data, dict):
+        raise LLMResponseError("Analysis response is not a JSON object")
+    category = data.get("category")
+    tasks = data.get("tasks")
+    if not isinstance(category, str) or not category.strip():
+        raise LLMResponseError("Analysis response is missing 'category'")
+    if not isinstance(tasks, list) or not all(isinstance(t, str) for t in tasks):
+        raise LLMResponseError("Analysis response has an invalid 'tasks' list")
+    return {"category": category.strip(), "tasks": tasks}
+
+
+def parse_thread_analysis(text: str) -> Dict:
+    """Validates a thread analysis response, raising LLMResponseError if it is malformed."""
+    analysis = parse_analysis(text)
+    summary = json.loads(text).get("summary")
+    if not isinstance(summary, str) or not summary.strip():
+        raise LLMResponseError("Thread analysis response is missing 'summary'")
+    return {**analysis, "summary": summary.strip()}
+
+
+def parse_batch_analysis(text: str) -> Dict[str, Dict]:
+    """Maps email id -> analysis for every well-formed entry of a batch response."""
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise LLMResponseError(f"Batch analysis response is not valid JSON: {e}") from e
+    if not isinstance(data, list):
+        raise LLMResponseError("Batch analysis response is not a JSON array")
+
+    results = {}
+    for item in data:
+        if not isinstance(item, dict) or not isinstance(item.get("id"), str):
+            continue
+        try:
+            results[item["id"]] = validate_analysis(item)
+        except LLMResponseError:
+            continue
+    return results
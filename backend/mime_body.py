@@ -0,0 +1,165 @@
+import base64
+import codecs
+import itertools
+import re
+from html import unescape
+from typing import Dict, Iterator, Optional
+
+# Default character budget for extracted bodies. Generous, because quoted history and
+# footers are only stripped afterwards (backend.preprocess), which also caps what the LLM sees.
+BODY_CHAR_LIMIT = 8000
+
+# Base64 characters decoded per step (HTML); a multiple of 4 so chunks decode independently
+_B64_CHUNK = 16384
+
+_SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template", "svg"}
+_BLOCK_TAGS = {
+    "p", "div", "br", "li", "tr", "table", "section", "article", "header", "footer",
+    "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "hr", "ul", "ol",
+}
+_TAG = re.compile(r"<!--.*?-->|<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*>|<![^>]*>", re.DOTALL)
+_WHITESPACE = re.compile(r"[ \t\r\f\v\xa0]+")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+
+
+def extract_body(payload: Dict, max_chars: int = BODY_CHAR_LIMIT) -> str:
+    """
+    Returns the readable text of a Gmail API message payload.
+
+    Walks the MIME tree once (any nesting, e.g. multipart/alternative inside
+    multipart/mixed), preferring text/plain over text/html and skipping
+    attachments. Parts are decoded with their declared charset and HTML is
+    converted by a streaming parser; decoding stops as soon as `max_chars`
+    characters of text have been produced.
+    """
+    plain, html = _find_text_parts(payload)
+    if plain is not None:
+        return _normalize(_decode_prefix(plain, max_chars))[:max_chars]
+    if html is not None:
+        return html_to_text(_iter_decoded(html), max_chars)
+    return ""
+
+
+def _find_text_parts(part: Dict, found: Optional[list] = None):
+    # Depth-first walk, remembering the first text/plain and first text/html part
+    if found is None:
+        found = [None, None]
+    mime_type = (part.get("mimeType") or "").lower()
+
+    if mime_type.startswith("multipart/"):
+        for child in part.get("parts", []):
+            _find_text_parts(child, found)
+            if found[0] is not None:
+                break
+    elif not _is_attachment(part) and part.get("body", {}).get("data"):
+        if mime_type in ("text/plain", "") and found[0] is None:
+            found[0] = part
+        elif mime_type == "text/html" and found[1] is None:
+            found[1] = part
+    return found[0], found[1]
+
+
+def _is_attachment(part: Dict) -> bool:
+    if part.get("filename"):
+        return True
+    disposition = _header(part, "Content-Disposition") or ""
+    return disposition.lower().startswith("attachment")
+
+
+def _header(part: Dict, name: str) -> Optional[str]:
+    name = name.lower()
+    for header in part.get("headers", []):
+        if header.get("name", "").lower() == name:
+            return header.get("value")
+    return None
+
+
+def _charset(part: Dict) -> str:
+    content_type = _header(part, "Content-Type") or ""
+    match = re.search(r'charset\s*=\s*"?([^";\s]+)', content_type, re.IGNORECASE)
+    charset = match.group(1) if match else "utf-8"
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return "utf-8"
+    return charset
+
+
+def _iter_decoded(part: Dict, chunk_size: int = _B64_CHUNK) -> Iterator[str]:
+    """Yields the part's text chunk by chunk (base64url -> bytes -> str)."""
+    data = part["body"]["data"]
+    decoder = codecs.getincrementaldecoder(_charset(part))(errors="replace")
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        chunk += "=" * (-len(chunk) % 4)
+        yield decoder.decode(base64.urlsafe_b64decode(chunk))
+    yield decoder.decode(b"", final=True)
+
+
+def _decode_prefix(part: Dict, max_chars: int) -> str:
+    text = []
+    size = 0
+    for chunk in _iter_decoded(part, chunk_size=4096):
+        text.append(chunk)
+        size += len(chunk)
+        # Some slack for whitespace that normalization will collapse
+        if size >= max_chars * 2:
+            break
+    return "".join(text)[:max_chars * 2]
+
+
+def _normalize(text: str) -> str:
+    text = _WHITESPACE.sub(" ", text.replace("\r\n", "\n"))
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+
+def html_to_text(chunks, max_chars: int = BODY_CHAR_LIMIT) -> str:
+    """
+    Converts HTML (a string or an iterable of string chunks) to plain text.
+
+    A single regex pass over tags: script/style/head content is dropped, block
+    tags become line breaks and entities are unescaped. Text after the last
+    complete tag of a chunk is carried over to the next one, so tags and
+    entities split across chunks are handled. Stops once `max_chars` is reached.
+    """
+    if isinstance(chunks, str):
+        chunks = [chunks]
+    out = []
+    size = 0
+    skip = None
+    carry = ""
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        text = carry + ("" if final else chunk)
+        pos = 0
+        for match in _TAG.finditer(text):
+            if skip is None:
+                size += _emit(out, text[pos:match.start()])
+            pos = match.end()
+            closing, tag = match.group(1), (match.group(2) or "").lower()
+            if skip is not None:
+                if closing and tag == skip:
+                    skip = None
+            elif tag in _SKIP_TAGS and not closing:
+                skip = tag
+            elif tag in _BLOCK_TAGS:
+                out.append("\n")
+            if size >= max_chars:
+                break
+
+        carry = text[pos:]
+        if final or size >= max_chars:
+            if skip is None and size < max_chars:
+                _emit(out, carry)
+            break
+
+    return _normalize("".join(out))[:max_chars]
+
+
+def _emit(out: list, data: str) -> int:
+    if not data:
+        return 0
+    text = unescape(data)
+    out.append(text)
+    return len(text.strip())
@@ -1,3 +1,5 @@
+import hashlib
+import json
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
 from datetime import datetime
@@ -11,11 +13,42 @@ class Email(BaseModel):
     category: Optional[str] = None
     action_items: Optional[List[str]] = Field(default_factory=list)
     read: bool = False
+    label_ids: List[str] = Field(default_factory=list)
+    # Fingerprints of the prompts + model that produced category / action_items
+    category_fingerprint: Optional[str] = None
+    actions_fingerprint: Optional[str] = None
+    # "llm", "local" (pre-classifier) or "duplicate" (reused from a near-duplicate);
+    # None for emails processed before this was tracked
+    category_source: Optional[str] = None
+    # Gmail conversation id; messages of one thread share it
+    thread_id: Optional[str] = None
+    # SimHash of subject and body (backend.near_duplicate), set on ingest; None if too short
+    simhash: Optional[int] = None
+
+class ThreadState(BaseModel):
+    """What the agent remembers about a conversation between messages."""
+    thread_id: str
+    # Running summary, updated with every new message
+    summary: str = ""
+    # Ids of the messages the summary covers, oldest first
+    message_ids: List[str] = Field(default_factory=list)
 
 class PromptConfig(BaseModel):
     categorization: str
     action_extraction: str
     auto_reply: str
+    # When set, categorization and action extraction run as one structured-output request
+    combined_analysis: Optional[str] = None
+    # Multi-email variant of combined_analysis; {emails} is replaced by the batch
+    batch_analysis: Optional[str] = None
+    # Per-message analysis of a conversation: {summary} is the thread so far, the rest is the
+    # newest message. Returns category, tasks and the updated summary.
+    thread_analysis: Optional[str] = None
+
+    def fingerprint(self, *fields: str, model: str = "") -> str:
+        """Short stable hash of the given prompt templates and the model name."""
+        payload = json.dumps([model] + [getattr(self, name) for name in fields])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
 
 class Draft(BaseModel):
     email_id: str
@@ -0,0 +1,262 @@
+import re
+import threading
+from dataclasses import dataclass
+from email.utils import parseaddr
+from difflib import SequenceMatcher
+from functools import lru_cache
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from backend.models import Email
+
+# SimHash width; the LSH bands split it into equal parts
+SIMHASH_BITS = 64
+# Only the start of an email is hashed: enough to recognize a template, bounded cost per email
+MAX_SHINGLE_TOKENS = 256
+# Emails with fewer tokens are too short to tell templates apart ("Thanks!") and are never matched
+MIN_TOKENS = 8
+# Differing bits up to which two emails count as near-duplicates. Copies of a short template
+# that differ in a name or two mostly land within 10 bits; unrelated text averages 32.
+DEFAULT_MAX_DISTANCE = 10
+# LSH bands of 8 bits: hashes within 7 bits always share a bucket, within 10 bits 90% of the time
+LSH_BANDS = 8
+# Tokens of the source email kept to adapt its action items to a near-duplicate
+ANCHOR_TOKENS = 64
+# Mailbox providers: everyone shares the domain, so their senders are told apart by full address
+FREEMAIL_DOMAINS = frozenset({
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com", "msn.com", "yahoo.com",
+    "ymail.com", "icloud.com", "me.com", "mac.com", "aol.com", "proton.me", "protonmail.com",
+    "gmx.com", "gmx.de", "gmx.net", "web.de", "mail.com", "yandex.com", "yandex.ru", "zoho.com",
+})
+
+_WORD = re.compile(r"\w+")
+# Parts that differ between copies of one template: links, addresses and numbers
+_URL = re.compile(r"https?://\S+")
+_ADDRESS = re.compile(r"\S+@\S+\.\w+")
+_DIGITS = re.compile(r"\d+")
+
+# _LANES[i][b]: the 8 bits of byte value `b` at position `i` of a hash, each in its own
+# 16-bit lane, so one big-int addition per byte counts all 64 bits at once
+_LANE = 16
+_LANES = [
+    [sum(((b >> bit) & 1) << ((i * 8 + bit) * _LANE) for bit in range(8)) for b in range(256)]
+    for i in range(SIMHASH_BITS // 8)
+]
+
+
+def shingles(text: str) -> List[str]:
+    """Word bigrams of the normalized text (numbers, links and addresses masked)."""
+    text = _DIGITS.sub("0", _ADDRESS.sub(" email ", _URL.sub(" url ", text.lower())))
+    tokens = _WORD.findall(text)[:MAX_SHINGLE_TOKENS]
+    if len(tokens) < MIN_TOKENS:
+        return []
+    return [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+
+@lru_cache(maxsize=65536)
+def _feature_lanes(feature: str) -> int:
+    # Bigrams repeat a lot across (templated) mail, so their hashes are cached
+    digest = blake2b(feature.encode("utf-8"), digest_size=SIMHASH_BITS // 8).digest()
+    return sum(_LANES[i][byte] for i, byte in enumerate(digest))
+
+
+def simhash(text: str) -> Optional[int]:
+    """64-bit SimHash of `text`; similar texts differ in few bits. None for texts too short to compare."""
+    features = shingles(text)
+    if not features:
+        return None
+    total = sum(map(_feature_lanes, features))
+    mask = (1 << _LANE) - 1
+    half = len(features) / 2
+    value = 0
+    for bit in range(SIMHASH_BITS):
+        if (total >> (bit * _LANE)) & mask > half:
+            value |= 1 << bit
+    return value
+
+
+def email_simhash(email: Email) -> Optional[int]:
+    return simhash(f"{email.subject or ''}\n{email.body or ''}")
+
+
+def ensure_simhash(email: Email) -> Optional[int]:
+    """The email's SimHash, computed and stored on it if it was not set on ingest."""
+    if email.simhash is None:
+        email.simhash = email_simhash(email)
+    return email.simhash
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def lsh_bands(value: int, bands: int) -> List[int]:
+    """
+    Splits a hash into `bands` parts. Two hashes within `bands - 1` bits of
+    each other always agree on at least one part, and ones a few bits further
+    apart usually do, so bucketing by part finds them.
+    """
+    width = SIMHASH_BITS // bands
+    mask = (1 << width) - 1
+    # The last band takes the bits left over when SIMHASH_BITS is not divisible
+    parts = [(value >> (i * width)) & mask for i in range(bands - 1)]
+    parts.append(value >> ((bands - 1) * width))
+    return parts
+
+
+def _sender_key(sender: Optional[str]) -> str:
+    """The sender's domain, or the full address for freemail domains where the domain says nothing."""
+    address = (parseaddr(sender or "")[1] or sender or "").lower().strip("<> ")
+    if "@" not in address:
+        return address
+    domain = address.rsplit("@", 1)[1]
+    return address if domain in FREEMAIL_DOMAINS else domain
+
+
+def _anchor(email: Email) -> Tuple[str, ...]:
+    return tuple(_WORD.findall(f"{email.subject or ''}\n{email.body or ''}")[:ANCHOR_TOKENS])
+
+
+def adapted_action_items(source: Email, email: Email) -> List[str]:
+    """`source`'s action items rewritten for its near-duplicate `email`."""
+    return adapt_action_items(list(source.action_items or []), _anchor(source), _anchor(email))
+
+
+def adapt_action_items(items: List[str], source: Tuple[str, ...], target: Tuple[str, ...]) -> List[str]:
+    """
+    Rewrites action items of the `source` email for the `target` email: tokens
+    that were replaced one for one between the two (names, dates, build
+    numbers) are replaced in the items too.
+    """
+    mapping: Dict[str, str] = {}
+    ambiguous = set()
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, source, target, autojunk=False).get_opcodes():
+        if tag != "replace" or i2 - i1 != j2 - j1:
+            continue
+        for old, new in zip(source[i1:i2], target[j1:j2]):
+            if mapping.setdefault(old, new) != new:
+                ambiguous.add(old)
+    for old in ambiguous:
+        del mapping[old]
+    if not mapping:
+        return list(items)
+    pattern = re.compile(r"\b(" + "|".join(re.escape(old) for old in sorted(mapping, key=len, reverse=True)) + r")\b")
+    return [pattern.sub(lambda m: mapping[m.group(1)], item) for item in items]
+
+
+def group_near_duplicates(emails: List[Email], max_distance: int = DEFAULT_MAX_DISTANCE,
+                          bands: int = LSH_BANDS) -> List[List[Email]]:
+    """
+    Groups emails from the same sender (see `_sender_key`) whose SimHashes
+    are within `max_distance` bits of the group's first email. Groups are in
+    the order of their first email, each in input order.
+    """
+    # band part -> indexes of the groups whose first email has it
+    buckets: List[Dict[int, List[int]]] = [{} for _ in range(bands)]
+    groups: List[List[Email]] = []
+    keys: List[Tuple[int, str]] = []
+    for email in emails:
+        value = ensure_simhash(email)
+        if value is None:
+            continue
+        sender = _sender_key(email.sender)
+        parts = lsh_bands(value, bands)
+        group = next((g for part, bucket in zip(parts, buckets) for g in bucket.get(part, ())
+                      if keys[g][1] == sender and hamming_distance(value, keys[g][0]) <= max_distance), None)
+        if group is not None:
+            groups[group].append(email)
+            continue
+        for part, bucket in zip(parts, buckets):
+            bucket.setdefault(part, []).append(len(groups))
+        groups.append([email])
+        keys.append((value, sender))
+    # Emails too short to fingerprint stay on their own
+    return groups + [[email] for email in emails if email.simhash is None]
+
+
+@dataclass
+class _Entry:
+    email_id: str
+    category: str
+    action_items: List[str]
+    fingerprints: Tuple[Optional[str], Optional[str]]
+    anchor: Tuple[str, ...]
+
+
+@dataclass
+class Match:
+    """An already processed email close enough to reuse, with its results adapted."""
+    email_id: str
+    distance: int
+    category: str
+    action_items: List[str]
+
+
+class NearDuplicateIndex:
+    """
+    LSH index over the SimHashes of processed emails (see `lsh_bands`): a
+    lookup only compares against hashes sharing a band, not the whole inbox,
+    so a match beyond `bands - 1` bits can occasionally be missed.
+    Matches must come from the same sender domain (the same address for
+    freemail domains, see FREEMAIL_DOMAINS), be within `max_distance`
+    bits and carry results of the same prompt fingerprints.
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE, bands: int = LSH_BANDS):
+        self.max_distance = max_distance
+        self.bands = bands
+        # One entry per distinct (hash, sender key): copies of a template do not grow the buckets
+        self._entries: Dict[Tuple[int, str], _Entry] = {}
+        self._buckets: List[Dict[int, List[Tuple[int, str]]]] = [{} for _ in range(self.bands)]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, email: Email):
+        """Indexes a processed email's results."""
+        value = ensure_simhash(email)
+        if value is None or not email.category:
+            return
+        key = (value, _sender_key(email.sender))
+        entry = _Entry(email.id, email.category, list(email.action_items or []),
+                       (email.category_fingerprint, email.actions_fingerprint), _anchor(email))
+        with self._lock:
+            if key not in self._entries:
+                for part, bucket in zip(lsh_bands(value, self.bands), self._buckets):
+                    bucket.setdefault(part, []).append(key)
+            # The latest result wins, e.g. after the prompts changed
+            self._entries[key] = entry
+
+    def add_many(self, emails: Iterable[Email]):
+        """Indexes the emails whose results came from the LLM, e.g. the stored inbox on start."""
+        for email in emails:
+            if email.category and email.category_source not in ("local", "duplicate"):
+                self.add(email)
+
+    def match(self, email: Email, fingerprints: Tuple[str, str]) -> Optional[Match]:
+        """The closest indexed email within `max_distance` bits, with its action items adapted, or None."""
+        value = ensure_simhash(email)
+        if value is None:
+            return None
+        sender = _sender_key(email.sender)
+        best: Optional[Tuple[_Entry, int]] = None
+        with self._lock:
+            seen = set()
+            for part, bucket in zip(lsh_bands(value, self.bands), self._buckets):
+                for key in bucket.get(part, ()):
+                    if key in seen or key[1] != sender:
+                        continue
+                    seen.add(key)
+                    entry = self._entries[key]
+                    # Never an email's own earlier result, and only results of the current prompts
+                    if entry.email_id == email.id or entry.fingerprints != tuple(fingerprints):
+                        continue
+                    distance = hamming_distance(value, key[0])
+                    if distance <= self.max_distance and (best is None or distance < best[1]):
+                        best = (entry, distance)
+        if best is None:
+            return None
+        entry, distance = best
+        return Match(entry.email_id, distance, entry.category,
+                     adapt_action_items(entry.action_items, entry.anchor, _anchor(email)))
@@ -0,0 +1,409 @@
+import asyncio
+import json
+import threading
+import weakref
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from backend.llm_errors import LLMError, LLMRequestError, RateLimitError, TransientLLMError, parse_retry_after
+from backend.llm_service import (
+    ANALYSIS_SCHEMA, BATCH_ANALYSIS_SCHEMA, CHAT_SYSTEM_INSTRUCTION, THREAD_ANALYSIS_SCHEMA, LLMService,
+    compose_prompt, estimate_tokens, parse_action_items, parse_analysis, parse_batch_analysis,
+    parse_thread_analysis,
+)
+from backend.rate_limiter import RateLimiter, RequestScheduler
+
+# Statuses worth retrying besides 429: request timeout, conflict, and server errors
+# (llama.cpp and vLLM answer 503 while the model is still loading)
+_TRANSIENT_STATUSES = (408, 409)
+
+
+def to_llm_error(error: Exception) -> LLMError:
+    """Maps an httpx exception to the matching LLMError."""
+    import httpx
+
+    if isinstance(error, LLMError):
+        return error
+    if isinstance(error, httpx.HTTPStatusError):
+        response = error.response
+        message = f"{response.status_code} {_error_message(response)}"
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            try:
+                return RateLimitError(message, retry_after=float(retry_after))
+            except (TypeError, ValueError):
+                return RateLimitError(message, retry_after=parse_retry_after(message))
+        if response.status_code in _TRANSIENT_STATUSES or response.status_code >= 500:
+            return TransientLLMError(message)
+        return LLMRequestError(message)
+    # Connection failures, timeouts (including waiting for a free pooled connection), dropped streams
+    if isinstance(error, (httpx.TransportError, httpx.StreamError, TimeoutError, ConnectionError)):
+        return TransientLLMError(f"{type(error).__name__}: {error}")
+    return LLMRequestError(str(error))
+
+
+def _error_message(response) -> str:
+    try:
+        response.read()
+        error = response.json().get("error")
+        return (error.get("message") if isinstance(error, dict) else error) or response.text
+    except Exception:
+        return response.reason_phrase
+
+
+class OpenAICompatibleLLMService(LLMService):
+    """
+    LLMService for servers speaking the OpenAI chat-completions protocol, e.g.
+    llama.cpp's llama-server, vLLM or Ollama (`base_url` like
+    "http://localhost:8080/v1").
+
+    Requests go over one keep-alive connection pool shared by all threads, so
+    consecutive requests skip the TCP/TLS handshake; `max_connections` caps
+    the requests in flight (callers beyond it wait up to `timeout` for a free
+    connection). `timeout` bounds each read, `connect_timeout` connecting.
+    Structured output uses `response_format` with a JSON schema; pass
+    `structured_output=False` for servers without it.
+
+    Every call has a coroutine version (`acategorize_email`, `aanalyze_email`,
+    ...; the streams are async iterators, e.g. `achat_turn_stream`), using a
+    separate async pool per event loop; close it with `aclose`.
+    """
+
+    def __init__(self, base_url: str, model: str, api_key: Optional[str] = None,
+                 max_connections: int = 16, timeout: float = 120.0, connect_timeout: float = 5.0,
+                 requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 5, structured_output: bool = True, temperature: Optional[float] = None):
+        # Imported here, like the Gemini SDK: only needed when this backend is configured
+        import httpx
+
+        self.base_url = base_url.rstrip("/") + "/"
+        self.model_name = model
+        self.supports_structured_output = structured_output
+        self.max_connections = max_connections
+        self.temperature = temperature
+        self._client_options = dict(
+            base_url=self.base_url,
+            headers={"Authorization": f"Bearer {api_key}"} if api_key else {},
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.client = httpx.Client(**self._client_options)
+        # Async clients (and their semaphores) are bound to the event loop they were first used on
+        self._async_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self.scheduler = RequestScheduler(RateLimiter(requests_per_minute, tokens_per_minute), max_retries)
+        self._usage = threading.local()
+
+    def last_usage(self) -> Optional[Dict[str, int]]:
+        usage = getattr(self._usage, "value", None)
+        self._usage.value = None
+        return usage
+
+    def close(self):
+        self.client.close()
+
+    async def aclose(self):
+        """Closes the async pool of the running event loop."""
+        entry = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            await entry[0].aclose()
+
+    # --- Requests ---
+
+    def _payload(self, messages: List[Dict[str, str]], schema: Optional[Dict] = None,
+                 schema_name: str = "response", stream: bool = False) -> Dict:
+        payload = {"model": self.model_name, "messages": messages}
+        if self.temperature is not None:
+            payload["temperature"] = self.temperature
+        if schema is not None and self.supports_structured_output:
+            payload["response_format"] = {"type": "json_schema",
+                                          "json_schema": {"name": schema_name, "schema": schema}}
+        if stream:
+            # Usage comes in a last chunk of its own
+            payload.update(stream=True, stream_options={"include_usage": True})
+        return payload
+
+    def _set_usage(self, usage: Optional[Dict], attempts: int):
+        self._usage.value = None if not usage else {
+            "input_tokens": usage.get("prompt_tokens", 0),
+            "output_tokens": usage.get("completion_tokens", 0),
+            # Prompt prefix served from the server's KV cache, where it reports it (vLLM)
+            "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0,
+            "retries": attempts - 1,
+        }
+
+    def _answer(self, data: Dict, estimate: int, attempts: int) -> str:
+        usage = data.get("usage")
+        if usage:
+            # The estimate only covers the prompt; charge the real total afterwards
+            self.scheduler.limiter.record(usage.get("total_tokens", 0) - estimate)
+        self._set_usage(usage, attempts)
+        try:
+            content = data["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            raise LLMRequestError(f"Response has no message: {str(data)[:200]}") from e
+        if content is None:
+            raise LLMRequestError(f"Response has no text (finish reason {data['choices'][0].get('finish_reason')})")
+        return content.strip()
+
+    def _complete(self, messages: List[Dict[str, str]], **options) -> str:
+        payload = self._payload(messages, **options)
+        estimate = estimate_tokens(json.dumps(messages))
+        attempts = 0
+
+        def request():
+            nonlocal attempts
+            attempts += 1
+            try:
+                response = self.client.post("chat/completions", json=payload)
+                response.raise_for_status()
+                return response.json()
+            except Exception as e:
+                raise to_llm_error(e) from e
+
+        return self._answer(self.scheduler.run(request, tokens=estimate), estimate, attempts)
+
+    async def _acomplete(self, messages: List[Dict[str, str]], **options) -> str:
+        payload = self._payload(messages, **options)
+        estimate = estimate_tokens(json.dumps(messages))
+        client, slots = self._async_client()
+        attempts = 0
+
+        async def request():
+            nonlocal attempts
+            attempts += 1
+            try:
+                async with slots:
+                    response = await client.post("chat/completions", json=payload)
+                response.raise_for_status()
+                return response.json()
+            except Exception as e:
+                raise to_llm_error(e) from e
+
+        return self._answer(await self.scheduler.run_async(request, tokens=estimate), estimate, attempts)
+
+    def _async_client(self):
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        entry = self._async_clients.get(loop)
+        if entry is None:
+            # Requests beyond the pool size wait here rather than in the pool's queue, which
+            # gets slow with thousands of waiting requests
+            entry = self._async_clients[loop] = (httpx.AsyncClient(**self._client_options),
+                                                 asyncio.Semaphore(self.max_connections))
+        return entry
+
+    def _complete_stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        estimate = estimate_tokens(json.dumps(messages))
+        request = self.client.build_request("POST", "chat/completions", json=self._payload(messages, stream=True))
+        attempts = 0
+
+        def start():
+            nonlocal attempts
+            attempts += 1
+            # Errors surface on the status or the first event, so both are part of the retried request
+            response = None
+            try:
+                response = self.client.send(request, stream=True)
+                response.raise_for_status()
+                events = _sse_events(response.iter_lines())
+                return response, events, next(events, None)
+            except Exception as e:
+                if response is not None:
+                    response.close()
+                raise to_llm_error(e) from e
+
+        response, events, event = self.scheduler.run(start, tokens=estimate)
+        usage = None
+        try:
+            while event is not None:
+                usage = event.get("usage") or usage
+                text = _delta_text(event)
+                if text:
+                    yield text
+                try:
+                    event = next(events, None)
+                except Exception as e:
+                    raise to_llm_error(e) from e
+            self._stream_done(usage, estimate, attempts)
+        finally:
+            # Closing the connection early stops generation on the server
+            response.close()
+
+    async def _acomplete_stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        estimate = estimate_tokens(json.dumps(messages))
+        client, slots = self._async_client()
+        request = client.build_request("POST", "chat/completions", json=self._payload(messages, stream=True))
+        attempts = 0
+
+        async def start():
+            nonlocal attempts
+            attempts += 1
+            response = None
+            try:
+                response = await client.send(request, stream=True)
+                if response.is_error:
+                    # The error message is in the body, which to_llm_error can only read once loaded
+                    await response.aread()
+                response.raise_for_status()
+                events = _asse_events(response.aiter_lines())
+                return response, events, await anext(events, None)
+            except Exception as e:
+                if response is not None:
+                    await response.aclose()
+                raise to_llm_error(e) from e
+
+        # The connection is busy until the stream ends
+        async with slots:
+            response, events, event = await self.scheduler.run_async(start, tokens=estimate)
+            usage = None
+            try:
+                while event is not None:
+                    usage = event.get("usage") or usage
+                    text = _delta_text(event)
+                    if text:
+                        yield text
+                    try:
+                        event = await anext(events, None)
+                    except Exception as e:
+                        raise to_llm_error(e) from e
+                self._stream_done(usage, estimate, attempts)
+            finally:
+                await response.aclose()
+
+    def _stream_done(self, usage: Optional[Dict], estimate: int, attempts: int):
+        if usage:
+            self.scheduler.limiter.record(usage.get("total_tokens", 0) - estimate)
+        self._set_usage(usage, attempts)
+
+    # --- Prompts ---
+
+    @staticmethod
+    def _prompt(email_content: str, prompt_template: str) -> List[Dict[str, str]]:
+        return [{"role": "user", "content": compose_prompt(prompt_template, email_content)}]
+
+    @staticmethod
+    def _chat(context: str, history: List[Dict[str, str]], user_query: str) -> List[Dict[str, str]]:
+        # The context is the system message, so every turn of a chat shares the prompt prefix
+        # and servers with prefix caching (vLLM, llama.cpp) only process the new turns
+        return ([{"role": "system", "content": f"{CHAT_SYSTEM_INSTRUCTION}\n\nContext: {context}"}]
+                + [{"role": turn["role"], "content": turn["content"]} for turn in history]
+                + [{"role": "user", "content": user_query}])
+
+    # --- LLMService ---
+
+    def categorize_email(self, email_content: str, prompt_template: str) -> str:
+        return self._complete(self._prompt(email_content, prompt_template))
+
+    def extract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
+        return parse_action_items(self._complete(self._prompt(email_content, prompt_template)))
+
+    def generate_reply(self, email_content: str, prompt_template: str) -> str:
+        return self._complete(self._prompt(email_content, prompt_template))
+
+    def chat(self, context: str, user_query: str) -> str:
+        return self._complete(self._chat(context, [], user_query))
+
+    def generate_reply_stream(self, email_content: str, prompt_template: str) -> Iterator[str]:
+        return self._complete_stream(self._prompt(email_content, prompt_template))
+
+    def chat_stream(self, context: str, user_query: str) -> Iterator[str]:
+        return self._complete_stream(self._chat(context, [], user_query))
+
+    def chat_turn(self, context: str, history: List[Dict[str, str]], user_query: str) -> str:
+        return self._complete(self._chat(context, history, user_query))
+
+    def chat_turn_stream(self, context: str, history: List[Dict[str, str]], user_query: str) -> Iterator[str]:
+        return self._complete_stream(self._chat(context, history, user_query))
+
+    def analyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        return parse_analysis(self._complete(self._prompt(email_content, prompt_template),
+                                             schema=ANALYSIS_SCHEMA, schema_name="analysis"))
+
+    def analyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        return parse_batch_analysis(self._complete(self._prompt(emails_content, prompt_template),
+                                                   schema=BATCH_ANALYSIS_SCHEMA, schema_name="batch_analysis"))
+
+    def analyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        return parse_thread_analysis(self._complete(self._prompt(email_content, prompt_template),
+                                                    schema=THREAD_ANALYSIS_SCHEMA, schema_name="thread_analysis"))
+
+    # --- Async ---
+
+    async def acategorize_email(self, email_content: str, prompt_template: str) -> str:
+        return await self._acomplete(self._prompt(email_content, prompt_template))
+
+    async def aextract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
+        return parse_action_items(await self._acomplete(self._prompt(email_content, prompt_template)))
+
+    async def agenerate_reply(self, email_content: str, prompt_template: str) -> str:
+        return await self._acomplete(self._prompt(email_content, prompt_template))
+
+    async def achat(self, context: str, user_query: str) -> str:
+        return await self._acomplete(self._chat(context, [], user_query))
+
+    async def aanalyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        return parse_analysis(await self._acomplete(self._prompt(email_content, prompt_template),
+                                                    schema=ANALYSIS_SCHEMA, schema_name="analysis"))
+
+    async def aanalyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        return parse_batch_analysis(await self._acomplete(self._prompt(emails_content, prompt_template),
+                                                          schema=BATCH_ANALYSIS_SCHEMA, schema_name="batch_analysis"))
+
+    async def aanalyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        return parse_thread_analysis(await self._acomplete(self._prompt(email_content, prompt_template),
+                                                           schema=THREAD_ANALYSIS_SCHEMA,
+                                                           schema_name="thread_analysis"))
+
+    async def achat_turn(self, context: str, history: List[Dict[str, str]], user_query: str) -> str:
+        return await self._acomplete(self._chat(context, history, user_query))
+
+    def agenerate_reply_stream(self, email_content: str, prompt_template: str) -> AsyncIterator[str]:
+        return self._acomplete_stream(self._prompt(email_content, prompt_template))
+
+    def achat_stream(self, context: str, user_query: str) -> AsyncIterator[str]:
+        return self._acomplete_stream(self._chat(context, [], user_query))
+
+    def achat_turn_stream(self, context: str, history: List[Dict[str, str]], user_query: str) -> AsyncIterator[str]:
+        return self._acomplete_stream(self._chat(context, history, user_query))
+
+
+_DONE = object()
+
+
+def _sse_event(line: str):
+    """The decoded event of a server-sent event line: None for other lines, _DONE for "[DONE]"."""
+    if not line.startswith("data:"):
+        return None
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return _DONE
+    try:
+        return json.loads(data)
+    except json.JSONDecodeError as e:
+        raise LLMRequestError(f"Malformed stream event: {data[:200]}") from e
+
+
+def _sse_events(lines: Iterator[str]) -> Iterator[Dict]:
+    """Decoded `data:` events of a server-sent event stream, up to "[DONE]"."""
+    done = False
+    for line in lines:
+        # Read on to the end of the body after "[DONE]", or the connection can't go back to the pool
+        event = None if done else _sse_event(line)
+        done = done or event is _DONE
+        if event is not None and not done:
+            yield event
+
+
+async def _asse_events(lines: AsyncIterator[str]) -> AsyncIterator[Dict]:
+    """_sse_events for an async stream."""
+    done = False
+    async for line in lines:
+        event = None if done else _sse_event(line)
+        done = done or event is _DONE
+        if event is not None and not done:
+            yield event
+
+
+def _delta_text(event: Dict) -> Optional[str]:
+    choices = event.get("choices") or []
+    return (choices[0].get("delta") or {}).get("content") if choices else None
@@ -0,0 +1,143 @@
+import json
+import math
+import os
+import threading
+import zlib
+from typing import Dict, Iterable, Optional, Tuple
+
+from backend.models import Email
+from backend.retrieval import tokenize
+
+DATA_DIR = "data"
+PRECLASSIFIER_FILE = os.path.join(DATA_DIR, "preclassifier.json")
+
+
+def email_features(email: Email, n_features: int) -> Dict[int, int]:
+    """Hashed bag of words over subject, body and sender (stable across processes)."""
+    sender = (email.sender or "").lower()
+    domain = sender.rsplit("@", 1)[-1].strip("> ") if "@" in sender else ""
+    tokens = [f"s:{t}" for t in tokenize(email.subject or "")]
+    tokens += tokenize(email.body or "")
+    tokens += [f"from:{sender}", f"domain:{domain}"]
+
+    features: Dict[int, int] = {}
+    for token in tokens:
+        index = zlib.crc32(token.encode("utf-8")) % n_features
+        features[index] = features.get(index, 0) + 1
+    return features
+
+
+class Preclassifier:
+    """
+    Multinomial naive Bayes over hashed features, trained incrementally on
+    LLM-labelled emails. `predict` returns a category only once that category
+    has `min_examples` training emails, with the posterior as confidence.
+    Every email counts once: learning it again only moves it to its new
+    category, if that changed.
+    """
+
+    def __init__(self, n_features: int = 2 ** 18, alpha: float = 0.1, min_examples: int = 20):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.min_examples = min_examples
+        self.class_docs: Dict[str, int] = {}
+        self.class_totals: Dict[str, int] = {}
+        self.feature_counts: Dict[str, Dict[int, int]] = {}
+        # Category each email was learned under, by email id
+        self.learned: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def trained_examples(self) -> int:
+        return sum(self.class_docs.values())
+
+    def partial_fit(self, email: Email, category: Optional[str] = None):
+        category = category or email.category
+        if not category:
+            return
+        features = email_features(email, self.n_features)
+        with self._lock:
+            previous = self.learned.get(email.id) if email.id else None
+            if previous == category:
+                return
+            if previous is not None:
+                self._count(previous, features, -1)
+            self._count(category, features, 1)
+            if email.id:
+                self.learned[email.id] = category
+
+    def _count(self, category: str, features: Dict[int, int], sign: int):
+        self.class_docs[category] = max(0, self.class_docs.get(category, 0) + sign)
+        counts = self.feature_counts.setdefault(category, {})
+        for index, count in features.items():
+            counts[index] = counts.get(index, 0) + sign * count
+            if counts[index] <= 0:
+                del counts[index]
+        self.class_totals[category] = max(0, self.class_totals.get(category, 0) + sign * sum(features.values()))
+
+    def fit(self, emails: Iterable[Email]):
+        """Learns from every email whose category came from the LLM."""
+        for email in emails:
+            if email.category and email.category_source not in ("local", "duplicate"):
+                self.partial_fit(email)
+
+    def predict(self, email: Email) -> Tuple[Optional[str], float]:
+        """Most likely category and its posterior probability, or (None, 0.0) if untrained."""
+        with self._lock:
+            classes = [c for c, docs in self.class_docs.items() if docs >= self.min_examples]
+            if len(classes) < 2:
+                return None, 0.0
+            features = email_features(email, self.n_features)
+            total_docs = sum(self.class_docs[c] for c in classes)
+            scores = {}
+            for category in classes:
+                counts = self.feature_counts[category]
+                denominator = math.log(self.class_totals[category] + self.alpha * self.n_features)
+                score = math.log(self.class_docs[category] / total_docs)
+                for index, count in features.items():
+                    score += count * (math.log(counts.get(index, 0) + self.alpha) - denominator)
+                scores[category] = score
+
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        normalizer = sum(math.exp(score - top) for score in scores.values())
+        return best, 1.0 / normalizer
+
+    def save(self, path: str = PRECLASSIFIER_FILE):
+        with self._lock:
+            data = {
+                "n_features": self.n_features,
+                "alpha": self.alpha,
+                "min_examples": self.min_examples,
+                "class_docs": self.class_docs,
+                "class_totals": self.class_totals,
+                "feature_counts": {c: {str(k): v for k, v in counts.items()} for c, counts in self.feature_counts.items()},
+                "learned": self.learned,
+            }
+        # Written to a temporary file first so concurrent savers never leave a torn file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = PRECLASSIFIER_FILE) -> Optional["Preclassifier"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            data = json.load(f)
+        model = cls(n_features=data["n_features"], alpha=data["alpha"], min_examples=data["min_examples"])
+        model.class_docs = data["class_docs"]
+        model.class_totals = data["class_totals"]
+        model.feature_counts = {c: {int(k): v for k, v in counts.items()} for c, counts in data["feature_counts"].items()}
+        model.learned = data.get("learned", {})
+        return model
+
+    @classmethod
+    def load_or_train(cls, emails: Iterable[Email], path: str = PRECLASSIFIER_FILE) -> "Preclassifier":
+        """Loads the saved model, or trains a new one from already processed emails."""
+        model = cls.load(path)
+        if model is None:
+            model = cls()
+            model.fit(emails)
+        return model
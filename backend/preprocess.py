@@ -0,0 +1,254 @@
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from backend.llm_service import estimate_tokens
+from backend.models import Email
+
+# Default token budget for one email body as sent to the LLM
+BODY_TOKEN_BUDGET = 512
+# Cleaned bodies an EmailPreprocessor keeps, and emails its per-email report holds
+CACHE_ENTRIES = 4096
+REPORT_ENTRIES = 10000
+
+# Reply/forward attributions: quoted history starts here if quoted text follows (see strip_quoted)
+_QUOTE_HEADERS = [
+    re.compile(r"^On\b.{0,200}\bwrote:\s*$", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^Am\b.{0,200}\bschrieb.{0,40}:\s*$", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^Le\b.{0,200}\ba écrit\s*:\s*$", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^-{2,}\s*Original Message\s*-{2,}\s*$", re.IGNORECASE),
+]
+# Separator rows Outlook puts above a quoted header block; only dropped when nothing follows them
+_SEPARATOR = re.compile(r"^[_-]{10,}$")
+# Outlook-style quoted header block: "From:" followed closely by "Sent:"/"Date:" and "Subject:"
+_OUTLOOK_FROM = re.compile(r"^\*?From:\*?\s", re.IGNORECASE)
+_OUTLOOK_FIELDS = re.compile(r"^\*?(Sent|Date|To|Subject):\*?\s", re.IGNORECASE)
+
+# "-- " is the standard signature delimiter; the others are client boilerplate
+_SIGNATURE_DELIMITER = re.compile(r"^(--|__)\s*$")
+_MOBILE_SIGNATURE = re.compile(r"^(Sent from my \w+|Get Outlook for \w+|Sent from (Mail|Yahoo Mail) for \w+).*$",
+                               re.IGNORECASE)
+_SIGN_OFF = re.compile(r"^(best|best regards|kind regards|regards|warm regards|cheers|thanks|thank you|"
+                       r"many thanks|sincerely|yours|br)[,.!]?\s*$", re.IGNORECASE)
+# Lines after a sign-off that still count as a signature block (name, title, phone, ...)
+_MAX_SIGNATURE_LINES = 8
+# Signature block lines: contact details, or short lines that are not sentences
+_CONTACT = re.compile(r"@|https?://|www\.|\+?\d[\d ()./-]{6,}")
+_MAX_SIGNATURE_LINE_CHARS = 60
+# Trailing abbreviations that end titles and company names, not sentences
+_ABBREVIATION_END = re.compile(r"\b(Inc|Ltd|Co|Corp|LLC|GmbH|Jr|Sr|Dr|Ph\.D)\.$", re.IGNORECASE)
+
+# Paragraphs that are footers, disclaimers or tracking boilerplate
+_BOILERPLATE = re.compile(
+    r"unsubscribe|opt[ -]out|manage (your )?(email )?(preferences|subscriptions)|"
+    r"view (this email |it )?in (your |a )?browser|you are receiving this|you received this|"
+    r"this (e-?mail|message)( and any attachments?)? (is|are|may be) (confidential|intended)|"
+    r"intended recipient|all rights reserved|privacy policy|©|\(c\) \d{4}",
+    re.IGNORECASE,
+)
+# Paragraphs longer than this are content even if they mention e.g. a privacy policy
+_MAX_BOILERPLATE_CHARS = 600
+
+# Long links (usually tracking redirects) are cut down to their host
+_LONG_URL = re.compile(r"https?://([^/\s]+)/\S{40,}")
+_SPACES = re.compile(r"[ \t\r\f\v\xa0]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def _outlook_header(lines: List[str], i: int) -> bool:
+    """Whether line `i` starts an Outlook-style quoted header block ("From:" then "Sent:"/"Subject:" ...)."""
+    return bool(_OUTLOOK_FROM.match(lines[i].strip())) and sum(
+        bool(_OUTLOOK_FIELDS.match(l.strip())) for l in lines[i + 1:i + 5]) >= 2
+
+
+def _quote_follows(lines: List[str], i: int) -> bool:
+    """Whether quoted text ("> " lines or an Outlook header block) starts right below the header at line `i`."""
+    # The attribution itself may be wrapped onto the next line
+    following = [j for j in range(i + 1, min(len(lines), i + 5)) if lines[j].strip()][:2]
+    return any(lines[j].strip().startswith(">") or _outlook_header(lines, j) for j in following)
+
+
+def strip_quoted(text: str) -> str:
+    """
+    Removes quoted history: "> " lines, and everything from a reply/forward
+    header on when quoted text follows it (a header alone may just be prose).
+    """
+    lines = text.split("\n")
+    kept: List[str] = []
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        # Attribution lines are often wrapped over two lines
+        two_lines = stripped + " " + lines[i + 1].strip() if i + 1 < len(lines) else stripped
+        if any(p.match(stripped) or p.match(two_lines) for p in _QUOTE_HEADERS) and _quote_follows(lines, i):
+            break
+        if _outlook_header(lines, i):
+            break
+        if stripped.startswith(">"):
+            continue
+        kept.append(line)
+    # A separator row left above the removed quote
+    while kept and (not kept[-1].strip() or _SEPARATOR.match(kept[-1].strip())):
+        kept.pop()
+    return "\n".join(kept)
+
+
+def _signature_line(line: str) -> bool:
+    """Whether a line after a sign-off looks like part of a signature (name, title, phone) and not a sentence."""
+    line = line.strip()
+    if not line or _CONTACT.search(line):
+        return True
+    sentence = "?" in line or (len(line.split()) >= 3 and line[-1] in ".!:" and not _ABBREVIATION_END.search(line))
+    return len(line) <= _MAX_SIGNATURE_LINE_CHARS and not sentence
+
+
+def strip_signature(text: str) -> str:
+    """Removes a trailing signature: after "-- ", mobile client lines, or contact lines after a sign-off."""
+    lines = text.rstrip().split("\n")
+    for i, line in enumerate(lines):
+        if _SIGNATURE_DELIMITER.match(line.strip()):
+            lines = lines[:i]
+            break
+    lines = [line for line in lines if not _MOBILE_SIGNATURE.match(line.strip())]
+    # Keep the sign-off and the name below it, drop a short contact block after them. A sign-off
+    # followed by sentences ("Thanks!\n\nCan you also ...") is part of the message, not a signature.
+    for i in range(len(lines) - 1, -1, -1):
+        if _SIGN_OFF.match(lines[i].strip()):
+            after = lines[i + 1:]
+            if len(after) - 1 <= _MAX_SIGNATURE_LINES and all(_signature_line(line) for line in after):
+                lines = lines[:i + 2]
+            break
+    return "\n".join(lines)
+
+
+def strip_boilerplate(text: str) -> str:
+    """Drops footer/disclaimer paragraphs and shortens tracking links."""
+    paragraphs = re.split(r"\n\s*\n", text)
+    kept = [p for p in paragraphs if not (_BOILERPLATE.search(p) and len(p) <= _MAX_BOILERPLATE_CHARS)]
+    # A body that is all boilerplate (e.g. a one-line notification) is left as is
+    text = "\n\n".join(kept) if kept else text
+    return _LONG_URL.sub(lambda m: f"https://{m.group(1)}/…", text)
+
+
+def normalize_whitespace(text: str) -> str:
+    """Collapses runs of spaces and blank lines, and repeated identical lines."""
+    lines: List[str] = []
+    for line in _SPACES.sub(" ", text).split("\n"):
+        line = line.strip()
+        if line and lines and line == lines[-1]:
+            continue
+        lines.append(line)
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cuts `text` to about `max_tokens` tokens at line or sentence boundaries,
+    keeping the opening (what the email is about) and, with a third of the
+    budget, the ending (where requests, deadlines and error messages tend to be).
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens * 4
+    head_budget = budget * 2 // 3
+    tail_budget = budget - head_budget
+
+    head = text[:head_budget]
+    cut = max(head.rfind(boundary) + len(boundary) for boundary in ("\n", ". ", " "))
+    if cut >= head_budget // 2:
+        head = head[:cut]
+
+    tail = text[-tail_budget:]
+    starts = [i + len(boundary) for boundary in ("\n", ". ") for i in [tail.find(boundary)] if i != -1]
+    if starts and min(starts) <= tail_budget // 2:
+        tail = tail[min(starts):]
+    return head.rstrip() + "\n[…]\n" + tail.strip()
+
+
+def preprocess_body(body: str, max_tokens: int = BODY_TOKEN_BUDGET) -> str:
+    """The body as the LLM should see it: without quotes, signature and boilerplate, within `max_tokens`."""
+    text = (body or "").replace("\r\n", "\n")
+    cleaned = normalize_whitespace(strip_boilerplate(strip_signature(strip_quoted(text))))
+    # Never throw the whole message away (e.g. a forward that is only quoted text)
+    if not cleaned:
+        cleaned = normalize_whitespace(text)
+    return truncate_to_tokens(cleaned, max_tokens)
+
+
+@dataclass
+class PreprocessStats:
+    emails: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class EmailPreprocessor:
+    """
+    Cleans email bodies before they go into prompts (see `preprocess_body`)
+    and keeps track of the tokens that saved, per email and in total.
+
+    Cleaned bodies are cached by email id and body hash, the least recently
+    used beyond `cache_entries` dropped. The per-email `report` keeps the
+    `report_entries` most recent emails; `stats` also counts the older ones.
+    """
+
+    def __init__(self, max_tokens: int = BODY_TOKEN_BUDGET, cache_entries: int = CACHE_ENTRIES,
+                 report_entries: int = REPORT_ENTRIES):
+        self.max_tokens = max_tokens
+        self.cache_entries = cache_entries
+        self.report_entries = report_entries
+        # email id -> (tokens before, tokens after), most recently processed last
+        self.report: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+        self._totals = PreprocessStats()
+        self._cache: "OrderedDict[Tuple[str, int], str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def body(self, email: Email) -> str:
+        """The cleaned body, recorded in the report."""
+        text = self._cleaned(email)
+        before, after = estimate_tokens(email.body or ""), estimate_tokens(text)
+        with self._lock:
+            previous = self.report.pop(email.id, None)
+            if previous is None:
+                self._totals.emails += 1
+            else:
+                self._totals.tokens_before -= previous[0]
+                self._totals.tokens_after -= previous[1]
+            self.report[email.id] = (before, after)
+            self._totals.tokens_before += before
+            self._totals.tokens_after += after
+            while len(self.report) > self.report_entries:
+                self.report.popitem(last=False)
+        return text
+
+    def clean(self, email: Email) -> Email:
+        """A copy of `email` with the preprocessed body."""
+        return email.model_copy(update={"body": self.body(email)})
+
+    def tokens_saved(self, email: Email) -> int:
+        """Tokens preprocessing removes from the email's body; not recorded in the report."""
+        return estimate_tokens(email.body or "") - estimate_tokens(self._cleaned(email))
+
+    def stats(self) -> PreprocessStats:
+        with self._lock:
+            return PreprocessStats(self._totals.emails, self._totals.tokens_before, self._totals.tokens_after)
+
+    def _cleaned(self, email: Email) -> str:
+        body = email.body or ""
+        key = (email.id, hash(body))
+        with self._lock:
+            text = self._cache.get(key)
+            if text is not None:
+                self._cache.move_to_end(key)
+                return text
+        text = preprocess_body(body, self.max_tokens)
+        with self._lock:
+            self._cache[key] = text
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return text
@@ -0,0 +1,148 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from backend.llm_errors import RateLimitError, TransientLLMError
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """
+    Refills at `rate_per_minute` up to `capacity`. `reserve` never blocks: it
+    takes the amount right away (the level may go negative, i.e. into the
+    future) and returns how long the caller has to wait before using it, so
+    concurrent callers queue up in order.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        # Default: one second's worth, so requests are spread out instead of bursting
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            # Requests larger than the bucket only wait for a full bucket
+            needed = min(amount, self.capacity)
+            wait = max(0.0, (needed - self.level) / self.rate)
+            self.level -= amount
+            return wait
+
+    def debit(self, amount: float):
+        """Takes `amount` without waiting, e.g. to correct an estimate afterwards."""
+        with self._lock:
+            self.level -= amount
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets shared by all threads.
+    A limit of None is not enforced.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests = TokenBucket(requests_per_minute, capacity=1) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # After a 429 everyone holds off until this time (monotonic clock)
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0):
+        """Blocks until a request of about `tokens` tokens fits in the budgets."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Takes the budget for a request of about `tokens` tokens; returns the seconds to wait before sending it."""
+        wait = 0.0
+        if self.requests:
+            wait = self.requests.reserve(1)
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self._lock:
+            return max(wait, self.paused_until - time.monotonic())
+
+    def record(self, extra_tokens: int):
+        """Charges tokens a request used beyond its estimate."""
+        if self.tokens and extra_tokens > 0:
+            self.tokens.debit(extra_tokens)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0,
+                  retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff; never shorter than a provider's retry-after hint."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, base))
+    return delay
+
+
+class RequestScheduler:
+    """
+    Runs LLM requests within a RateLimiter's budgets, retrying rate-limited
+    and transient failures with jittered exponential backoff. A rate-limited
+    request pauses every caller sharing the limiter, not just the one that
+    hit it. Gives up after `max_retries` retries by re-raising the last error.
+    """
+
+    def __init__(self, limiter: Optional[RateLimiter] = None, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+
+    def run(self, request: Callable[[], T], tokens: int = 0) -> T:
+        attempt = 0
+        while True:
+            self.limiter.acquire(tokens)
+            try:
+                return request()
+            except (RateLimitError, TransientLLMError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay:
+                    time.sleep(delay)
+                attempt += 1
+                self.retries += 1
+
+    async def run_async(self, request: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+        """`run` for coroutines: waits with asyncio.sleep, so the event loop keeps serving other requests."""
+        attempt = 0
+        while True:
+            wait = self.limiter.reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                return await request()
+            except (RateLimitError, TransientLLMError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay:
+                    await asyncio.sleep(delay)
+                attempt += 1
+                self.retries += 1
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Delay before the next attempt; after a 429 the whole limiter is paused instead (returns 0)."""
+        delay = backoff_delay(attempt, self.base_delay, self.max_delay, getattr(error, "retry_after", None))
+        if isinstance(error, RateLimitError):
+            self.limiter.pause(delay)
+            return 0.0
+        return delay
@@ -0,0 +1,219 @@
+import heapq
+import math
+import re
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from backend.models import Email
+from backend.llm_service import estimate_tokens
+from backend.preprocess import EmailPreprocessor
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have i in is it me my of on or our so that the this "
+    "to was we were what when which who will with you your do does did any about can".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased alphanumeric tokens without stopwords."""
+    return [t for t in _TOKEN.findall(text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+def email_terms(email: Email) -> Counter:
+    # Subject and sender say more about an email than any single body word
+    terms = Counter(tokenize(email.body or ""))
+    for token in tokenize(email.subject or ""):
+        terms[token] += 3
+    for token in tokenize(email.sender or "") + tokenize(email.category or ""):
+        terms[token] += 2
+    for item in email.action_items or []:
+        terms.update(tokenize(item))
+    return terms
+
+
+class BM25Index:
+    """
+    Incremental Okapi BM25 index over emails. `sync` adds, updates and removes
+    documents so that only changed emails are re-tokenized between chat turns.
+
+    Documents are numbered slots and every term's postings are two packed
+    arrays (slots, term frequencies). Removing a document only empties its
+    slot; the postings are rebuilt once empty slots outnumber the documents.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.total_length = 0
+        # Per slot: email id (None once removed), length, and the revision it was indexed at
+        self._doc_ids: List[Optional[str]] = []
+        self._doc_lengths = array("I")
+        self._revisions = array("q")
+        self._slots: Dict[str, int] = {}
+        # Version of the CompactInbox last synced with
+        self._synced_version: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def add(self, email: Email, revision: Optional[int] = None):
+        """Indexes `email`, replacing an earlier version; `revision` defaults to a hash of its content."""
+        self.remove(email.id)
+        self._synced_version = None
+        terms = email_terms(email)
+        slot = len(self._doc_ids)
+        self._doc_ids.append(email.id)
+        self._slots[email.id] = slot
+        length = sum(terms.values())
+        self._doc_lengths.append(length)
+        self.total_length += length
+        self._revisions.append(self._signature(email) if revision is None else revision)
+        for term, freq in terms.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = (array("I"), array("I"))
+            postings[0].append(slot)
+            postings[1].append(freq)
+
+    def remove(self, email_id: str):
+        slot = self._slots.pop(email_id, None)
+        if slot is None:
+            return
+        self._synced_version = None
+        self._doc_ids[slot] = None
+        self.total_length -= self._doc_lengths[slot]
+        if len(self._doc_ids) - len(self._slots) > max(len(self._slots), 1024):
+            self._compact()
+
+    def sync(self, emails: Iterable[Email]):
+        """
+        Brings the index in line with `emails`, re-indexing only new or changed
+        ones. A CompactInbox is compared by its per-email revisions, so only
+        the changed emails are materialized, and is not scanned at all if its
+        version is the one last synced with.
+        """
+        revisions = getattr(emails, "revisions", None)
+        if revisions is not None and emails.version == self._synced_version:
+            return
+        if revisions is None:
+            emails = list(emails)
+            for email in emails:
+                if self._revision(email.id) != self._signature(email):
+                    self.add(email)
+            ids = [email.id for email in emails]
+        else:
+            for email_id, revision in revisions():
+                if self._revision(email_id) != revision:
+                    self.add(emails.get(email_id), revision)
+            ids = emails.ids
+        # Every current email is indexed now, so anything beyond them was removed
+        if len(self._slots) > len(ids):
+            current = set(ids)
+            for email_id in [i for i in self._slots if i not in current]:
+                self.remove(email_id)
+        self._synced_version = None if revisions is None else emails.version
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Returns up to `k` (email id, score) pairs, best first."""
+        n = len(self._slots)
+        if not n:
+            return []
+        avg_length = self.total_length / n
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            docs = [(slot, freq) for slot, freq in zip(*postings) if self._doc_ids[slot] is not None]
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for slot, freq in docs:
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[slot] / avg_length)
+                scores[slot] = scores.get(slot, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self._doc_ids[slot], score) for slot, score in best]
+
+    def _revision(self, email_id: str) -> Optional[int]:
+        slot = self._slots.get(email_id)
+        return None if slot is None else self._revisions[slot]
+
+    def _compact(self):
+        """Renumbers the documents without the empty slots."""
+        new_slots = array("q", [-1]) * len(self._doc_ids)
+        doc_ids, lengths, revisions = [], array("I"), array("q")
+        for slot, email_id in enumerate(self._doc_ids):
+            if email_id is None:
+                continue
+            new_slots[slot] = len(doc_ids)
+            self._slots[email_id] = len(doc_ids)
+            doc_ids.append(email_id)
+            lengths.append(self._doc_lengths[slot])
+            revisions.append(self._revisions[slot])
+        postings = {}
+        for term, (slots, freqs) in self.postings.items():
+            kept = [(new_slots[slot], freq) for slot, freq in zip(slots, freqs) if new_slots[slot] >= 0]
+            if kept:
+                postings[term] = (array("I", (slot for slot, _ in kept)), array("I", (freq for _, freq in kept)))
+        self.postings = postings
+        self._doc_ids, self._doc_lengths, self._revisions = doc_ids, lengths, revisions
+
+    @staticmethod
+    def _signature(email: Email) -> int:
+        return hash((email.subject, email.sender, email.body, email.category, tuple(email.action_items or [])))
+
+
+def format_email_for_context(position: int, email: Email, max_body_chars: int = 800,
+                             preprocessor: Optional[EmailPreprocessor] = None) -> str:
+    sender = email.sender or "<unknown sender>"
+    subject = email.subject or "<no subject>"
+    category = email.category or "Uncategorized"
+    actions = "; ".join(email.action_items) if email.action_items else "None"
+    # Cleaned first, so quotes and footers do not use up the characters
+    body = preprocessor.body(email) if preprocessor is not None else (email.body or "")
+    body = body.replace("\n", " ").strip()
+    if len(body) > max_body_chars:
+        body = body[:max_body_chars] + " ...[truncated]"
+    return f"Email {position} | From: {sender} | Subject: {subject} | Category: {category} | Action Items: {actions} | Body: {body}"
+
+
+def build_context(index: BM25Index, emails_by_id: Dict[str, Email], query: str,
+                  token_budget: int = 3000, max_body_chars: int = 800,
+                  fallback: Optional[List[Email]] = None,
+                  preprocessor: Optional[EmailPreprocessor] = None) -> str:
+    """
+    Fills `token_budget` with the emails most relevant to `query`, best first.
+    If nothing matches, uses `fallback` (e.g. the newest emails) instead.
+    """
+    entries = select_context(index, emails_by_id, query, token_budget, max_body_chars, fallback, preprocessor)
+    return "\n\n".join(entry for _, entry in entries)
+
+
+def select_context(index: BM25Index, emails_by_id: Dict[str, Email], query: str,
+                   token_budget: int = 3000, max_body_chars: int = 800,
+                   fallback: Optional[List[Email]] = None,
+                   preprocessor: Optional[EmailPreprocessor] = None,
+                   exclude: Iterable[str] = (), start: int = 1) -> List[Tuple[str, str]]:
+    """
+    The (email id, formatted entry) pairs `build_context` is made of. Emails
+    in `exclude` (e.g. already sent earlier in a chat) are skipped and the
+    entries are numbered from `start`.
+    """
+    exclude = set(exclude)
+    ranked = [emails_by_id[email_id] for email_id, _ in index.search(query, k=50)
+              if email_id in emails_by_id and email_id not in exclude]
+    if not ranked:
+        ranked = [email for email in fallback or [] if email.id not in exclude]
+
+    entries, used = [], 0
+    for email in ranked:
+        entry = format_email_for_context(start + len(entries), email, max_body_chars, preprocessor)
+        tokens = estimate_tokens(entry)
+        if entries and used + tokens > token_budget:
+            continue
+        entries.append((email.id, entry))
+        used += tokens
+    return entries
@@ -0,0 +1,155 @@
+"""
+Builds the LLM stack and the agent from the settings, for the app (main.py)
+and the job worker CLI (python -m backend.jobs), so a job is processed the
+same way whoever runs it. The app reads settings from Streamlit secrets and
+the environment, the worker from the environment only.
+"""
+import os
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from backend.agent import EmailAgent
+from backend.inbox_store import InboxStore
+from backend.llm_cache import CachedLLMService
+from backend.llm_router import RoutedLLMService
+from backend.llm_service import GeminiLLMService, LLMService
+from backend.models import Email
+from backend.near_duplicate import NearDuplicateIndex
+from backend.preclassifier import Preclassifier
+from backend.preprocess import EmailPreprocessor
+from backend.telemetry import InstrumentedLLMService
+
+
+def env_setting(name: str, default=None):
+    return os.getenv(name) or default
+
+
+def _enabled(value) -> bool:
+    return str(value).lower() not in ("off", "false", "0")
+
+
+@dataclass
+class Settings:
+    # Max number of emails processed concurrently, and worker threads of the job queue
+    processing_workers: int = 4
+    # Emails packed into one LLM request when a batch prompt is configured
+    processing_batch_size: int = 20
+    # Local pre-classifier (PRECLASSIFIER=off disables it) and the confidence it needs to skip the LLM
+    preclassifier: bool = True
+    preclassifier_threshold: float = 0.95
+    # Gemini quota (defaults: free tier of gemini-2.5-flash); requests are paced to stay within it.
+    # Rate limits are per process: split the quota between the app and worker processes
+    llm_requests_per_minute: float = 10
+    llm_tokens_per_minute: float = 250000
+    # Strip quoted replies, signatures and footers from bodies before prompting (PREPROCESS=off
+    # disables it), and the token budget per body after that
+    preprocess: bool = True
+    preprocess_max_tokens: int = 512
+    # Reuse results for near-duplicates of processed emails (NEAR_DUPLICATES=off disables it), and how
+    # many of the 64 SimHash bits may differ for two emails to count as near-duplicates
+    near_duplicates: bool = True
+    near_duplicate_max_distance: int = 10
+    # Persistent response cache (LLM_CACHE=off disables it)
+    llm_cache: bool = True
+    # LLM backends: "gemini" or "openai_compat", a server speaking the OpenAI chat-completions protocol
+    # (llama.cpp, vLLM, Ollama). LLM_BACKEND serves every operation except those listed in
+    # OPENAI_COMPAT_OPERATIONS (e.g. "classification"), which go to the OpenAI-compatible server.
+    llm_backend: str = "gemini"
+    openai_compat_operations: List[str] = field(default_factory=list)
+    openai_compat_base_url: str = "http://localhost:8080/v1"
+    openai_compat_model: str = "local-model"
+    openai_compat_api_key: Optional[str] = None
+    # Connections kept open to the server, i.e. requests in flight; raise PROCESSING_WORKERS to use them
+    openai_compat_max_connections: int = 16
+    openai_compat_timeout: float = 120
+
+    @classmethod
+    def load(cls, get: Callable = env_setting) -> "Settings":
+        """Settings from `get(NAME, default)`, e.g. the environment."""
+        defaults = cls()
+        return cls(
+            processing_workers=int(get("PROCESSING_WORKERS", defaults.processing_workers)),
+            processing_batch_size=int(get("PROCESSING_BATCH_SIZE", defaults.processing_batch_size)),
+            preclassifier=_enabled(get("PRECLASSIFIER", "on")),
+            preclassifier_threshold=float(get("PRECLASSIFIER_THRESHOLD", defaults.preclassifier_threshold)),
+            llm_requests_per_minute=float(get("LLM_REQUESTS_PER_MINUTE", defaults.llm_requests_per_minute)),
+            llm_tokens_per_minute=float(get("LLM_TOKENS_PER_MINUTE", defaults.llm_tokens_per_minute)),
+            preprocess=_enabled(get("PREPROCESS", "on")),
+            preprocess_max_tokens=int(get("PREPROCESS_MAX_TOKENS", defaults.preprocess_max_tokens)),
+            near_duplicates=_enabled(get("NEAR_DUPLICATES", "on")),
+            near_duplicate_max_distance=int(get("NEAR_DUPLICATE_MAX_DISTANCE",
+                                                defaults.near_duplicate_max_distance)),
+            llm_cache=_enabled(get("LLM_CACHE", "on")),
+            llm_backend=str(get("LLM_BACKEND", defaults.llm_backend)).lower(),
+            openai_compat_operations=[op for op in str(get("OPENAI_COMPAT_OPERATIONS", "")).split(",")
+                                      if op.strip()],
+            openai_compat_base_url=get("OPENAI_COMPAT_BASE_URL", defaults.openai_compat_base_url),
+            openai_compat_model=get("OPENAI_COMPAT_MODEL", defaults.openai_compat_model),
+            openai_compat_api_key=get("OPENAI_COMPAT_API_KEY"),
+            openai_compat_max_connections=int(get("OPENAI_COMPAT_MAX_CONNECTIONS",
+                                                  defaults.openai_compat_max_connections)),
+            openai_compat_timeout=float(get("OPENAI_COMPAT_TIMEOUT", defaults.openai_compat_timeout)),
+        )
+
+
+def create_llm_backend(name: str, settings: Settings, api_key: Optional[str]) -> LLMService:
+    if name == "gemini":
+        return GeminiLLMService(
+            api_key,
+            requests_per_minute=settings.llm_requests_per_minute,
+            tokens_per_minute=settings.llm_tokens_per_minute
+        )
+    if name == "openai_compat":
+        # Imported here: httpx is only needed when this backend is configured
+        from backend.openai_compat_service import OpenAICompatibleLLMService
+        return OpenAICompatibleLLMService(
+            settings.openai_compat_base_url,
+            settings.openai_compat_model,
+            api_key=settings.openai_compat_api_key,
+            max_connections=settings.openai_compat_max_connections,
+            timeout=settings.openai_compat_timeout
+        )
+    raise ValueError(f"Unknown LLM_BACKEND {name!r}, expected 'gemini' or 'openai_compat'")
+
+
+def create_llm_service(settings: Settings, api_key: Optional[str]) -> LLMService:
+    """The configured LLM backends (one rate limiter / connection pool each) behind the response cache."""
+    # Telemetry sits inside the cache, so only requests that reach a backend are recorded as calls
+    llm_service = InstrumentedLLMService(create_llm_backend(settings.llm_backend, settings, api_key))
+    if settings.openai_compat_operations and settings.llm_backend != "openai_compat":
+        local = InstrumentedLLMService(create_llm_backend("openai_compat", settings, api_key))
+        llm_service = RoutedLLMService(llm_service, {op: local for op in settings.openai_compat_operations})
+    if settings.llm_cache:
+        llm_service = CachedLLMService(llm_service)
+    return llm_service
+
+
+def create_preclassifier(settings: Settings, inbox: List[Email]) -> Optional[Preclassifier]:
+    # Trained from the already processed inbox the first time, then saved after each run
+    return Preclassifier.load_or_train(inbox) if settings.preclassifier else None
+
+
+def create_preprocessor(settings: Settings) -> Optional[EmailPreprocessor]:
+    return EmailPreprocessor(max_tokens=settings.preprocess_max_tokens) if settings.preprocess else None
+
+
+def create_near_duplicate_index(settings: Settings, inbox: List[Email]) -> Optional[NearDuplicateIndex]:
+    if not settings.near_duplicates:
+        return None
+    # Seeded from the already processed inbox, then fed by every processed email
+    index = NearDuplicateIndex(max_distance=settings.near_duplicate_max_distance)
+    index.add_many(inbox)
+    return index
+
+
+def create_agent(llm_service: LLMService, settings: Settings, store: InboxStore,
+                 preclassifier: Optional[Preclassifier] = None, preprocessor: Optional[EmailPreprocessor] = None,
+                 near_duplicates: Optional[NearDuplicateIndex] = None) -> EmailAgent:
+    """
+    The agent over `llm_service`, with the optional parts as returned by the
+    create_* functions above (None where the settings turn them off).
+    """
+    return EmailAgent(llm_service, max_workers=settings.processing_workers,
+                      batch_size=settings.processing_batch_size,
+                      preclassifier=preclassifier, preclassifier_threshold=settings.preclassifier_threshold,
+                      preprocessor=preprocessor, thread_store=store, near_duplicates=near_duplicates)
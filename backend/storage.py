@@ -1,25 +1,70 @@
 import json
 import os
+import threading
 from typing import List, Dict
 from backend.models import Email, PromptConfig
+from backend.inbox_store import InboxStore, JSONInboxStore, SQLiteInboxStore, migrate_json_to_sqlite
+from backend.inbox_index import InboxIndex, QueryResult
 
 DATA_DIR = "data"
 INBOX_FILE = os.path.join(DATA_DIR, "mock_inbox.json")
 PROMPTS_FILE = os.path.join(DATA_DIR, "default_prompts.json")
 PROCESSED_INBOX_FILE = os.path.join(DATA_DIR, "processed_inbox.json")
+INBOX_DB_FILE = os.path.join(DATA_DIR, "inbox.sqlite3")
+
+# Storage engine for processed emails: "sqlite" (default) or "json"
+INBOX_STORE = os.getenv("INBOX_STORE", "sqlite")
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store() -> InboxStore:
+    """Returns the process-wide inbox store, migrating the JSON inbox into SQLite on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if INBOX_STORE == "json":
+                _store = JSONInboxStore(PROCESSED_INBOX_FILE)
+            else:
+                _store = SQLiteInboxStore(INBOX_DB_FILE)
+                migrate_json_to_sqlite(PROCESSED_INBOX_FILE, _store)
+        return _store
 
 def load_inbox() -> List[Email]:
-    """Loads emails from the processed file if it exists."""
-    if os.path.exists(PROCESSED_INBOX_FILE):
-        with open(PROCESSED_INBOX_FILE, "r") as f:
-            data = json.load(f)
-            return [Email(**item) for item in data]
-    return []
+    """Loads all processed emails from the store."""
+    return get_store().load_all()
 
 def save_inbox(emails: List[Email]):
-    """Saves the current state of emails (including categories/actions) to disk."""
-    with open(PROCESSED_INBOX_FILE, "w") as f:
-        json.dump([email.model_dump() for email in emails], f, indent=2)
+    """Replaces the stored inbox with the current state of emails (including categories/actions)."""
+    get_store().replace_all(emails)
+
+def save_email(email: Email):
+    """Persists a single email (e.g. after processing it individually)."""
+    get_store().upsert(email)
+
+def save_emails(emails: List[Email]):
+    """Inserts or updates several emails in one transaction."""
+    get_store().upsert_many(emails)
+
+def merge_with_saved(emails: List[Email], store: InboxStore = None) -> List[Email]:
+    """
+    Carries saved processing results (category, action items, fingerprints) over to
+    freshly fetched emails whose content is unchanged, so they are not reprocessed.
+    """
+    saved = (store or get_store()).get_many(email.id for email in emails)
+    merged = []
+    for email in emails:
+        previous = saved.get(email.id)
+        if previous and previous.subject == email.subject and previous.body == email.body:
+            email = email.model_copy(update={
+                "category": previous.category,
+                "action_items": previous.action_items,
+                "category_fingerprint": previous.category_fingerprint,
+                "actions_fingerprint": previous.actions_fingerprint,
+                "category_source": previous.category_source,
+            })
+        merged.append(email)
+    return merged
 
 def load_prompts() -> PromptConfig:
     """Loads prompt configurations."""
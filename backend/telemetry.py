@@ -0,0 +1,365 @@
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from backend.llm_service import LLMService, chat_context, compose_prompt, estimate_tokens
+
+DATA_DIR = "data"
+METRICS_FILE = os.path.join(DATA_DIR, "metrics.prom")
+
+# Upper bounds (seconds) of the latency histogram buckets; the last one catches everything
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+# USD per million (input, output) tokens, for cost estimates; unknown models cost 0.
+# Input tokens served from the provider's context cache cost CACHED_INPUT_PRICE_FACTOR of that.
+MODEL_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+CACHED_INPUT_PRICE_FACTOR = 0.25
+
+
+class Histogram:
+    """Latency histogram with fixed bucket bounds; exported with cumulative counts, as Prometheus expects."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate from the buckets (linear within a bucket); None when empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+
+def escape_label_value(value) -> str:
+    """A label value as the Prometheus text format needs it: backslash, double quote and newline escaped."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Telemetry:
+    """
+    Process-wide counters and latency histograms for calls to external
+    services (LLM, Gmail), keyed by (service, operation). Thread-safe.
+    Feed it with `InstrumentedLLMService` and the `instrumented` decorator;
+    read it with `snapshot` or `to_prometheus`.
+    """
+
+    def __init__(self, prices: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.prices = MODEL_PRICES if prices is None else prices
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+            self.first_chunk: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+            self.calls: Dict[Tuple[str, str], int] = defaultdict(int)
+            # (service, operation, error class) -> count
+            self.errors: Dict[Tuple[str, str, str], int] = defaultdict(int)
+            self.retries: Dict[Tuple[str, str], int] = defaultdict(int)
+            self.input_tokens: Dict[Tuple[str, str], int] = defaultdict(int)
+            self.output_tokens: Dict[Tuple[str, str], int] = defaultdict(int)
+            # Part of input_tokens the provider served from its context cache
+            self.cached_tokens: Dict[Tuple[str, str], int] = defaultdict(int)
+            self.cost: Dict[Tuple[str, str], float] = defaultdict(float)
+            # (operation, "hit" | "miss") -> count
+            self.cache: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    # --- Recording ---
+
+    def record_call(self, service: str, operation: str, seconds: float, error: Optional[BaseException] = None):
+        key = (service, operation)
+        with self._lock:
+            self.calls[key] += 1
+            self.latency[key].observe(seconds)
+            if error is not None:
+                self.errors[(service, operation, type(error).__name__)] += 1
+
+    def record_error(self, service: str, operation: str, error: str):
+        """Counts a failure that is not a call of its own, e.g. one message of a batch request."""
+        with self._lock:
+            self.errors[(service, operation, error)] += 1
+
+    def record_first_chunk(self, service: str, operation: str, seconds: float):
+        with self._lock:
+            self.first_chunk[(service, operation)].observe(seconds)
+
+    def record_tokens(self, service: str, operation: str, model: str,
+                      input_tokens: int, output_tokens: int, retries: int = 0, cached_tokens: int = 0):
+        price_in, price_out = self.prices.get(model, (0.0, 0.0))
+        key = (service, operation)
+        input_cost = (input_tokens - cached_tokens) * price_in + cached_tokens * price_in * CACHED_INPUT_PRICE_FACTOR
+        with self._lock:
+            self.input_tokens[key] += input_tokens
+            self.output_tokens[key] += output_tokens
+            self.cached_tokens[key] += cached_tokens
+            self.cost[key] += (input_cost + output_tokens * price_out) / 1e6
+            self.retries[key] += retries
+
+    def record_cache(self, operation: str, hit: bool):
+        with self._lock:
+            self.cache[(operation, "hit" if hit else "miss")] += 1
+
+    # --- Reading ---
+
+    def snapshot(self) -> Dict:
+        """Per-operation summary rows plus totals, for display."""
+        with self._lock:
+            operations = []
+            for key in sorted(self.calls):
+                histogram = self.latency[key]
+                first_chunk = self.first_chunk.get(key)
+                operations.append({
+                    "service": key[0],
+                    "operation": key[1],
+                    "calls": self.calls[key],
+                    "errors": sum(n for (s, o, _), n in self.errors.items() if (s, o) == key),
+                    "retries": self.retries.get(key, 0),
+                    "mean_s": histogram.sum / histogram.count,
+                    "p50_s": histogram.quantile(0.5),
+                    "p95_s": histogram.quantile(0.95),
+                    "p99_s": histogram.quantile(0.99),
+                    "first_chunk_p50_s": first_chunk.quantile(0.5) if first_chunk else None,
+                    "input_tokens": self.input_tokens.get(key, 0),
+                    "output_tokens": self.output_tokens.get(key, 0),
+                    "cached_tokens": self.cached_tokens.get(key, 0),
+                    "cost_usd": self.cost.get(key, 0.0),
+                })
+            errors = [{"service": s, "operation": o, "error": e, "count": n}
+                      for (s, o, e), n in sorted(self.errors.items())]
+            cache = defaultdict(lambda: {"hits": 0, "misses": 0})
+            for (operation, result), n in self.cache.items():
+                cache[operation]["hits" if result == "hit" else "misses"] += n
+            return {
+                "since": self.started,
+                "operations": operations,
+                "errors": errors,
+                "cache": {operation: dict(counts) for operation, counts in sorted(cache.items())},
+                "total_cost_usd": sum(self.cost.values()),
+                "total_tokens": sum(self.input_tokens.values()) + sum(self.output_tokens.values()),
+            }
+
+    def to_prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+
+        def labels(**values) -> str:
+            return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in values.items()) + "}"
+
+        def histograms(name: str, help_text: str, data: Dict[Tuple[str, str], Histogram]):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (service, operation), histogram in sorted(data.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{labels(service=service, operation=operation, le=le)} {cumulative}")
+                lines.append(f"{name}_sum{labels(service=service, operation=operation)} {histogram.sum}")
+                lines.append(f"{name}_count{labels(service=service, operation=operation)} {histogram.count}")
+
+        def counter(name: str, help_text: str, rows):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for label_values, value in rows:
+                lines.append(f"{name}{labels(**label_values)} {value}")
+
+        with self._lock:
+            histograms("email_agent_call_duration_seconds", "Latency of calls to external services.", self.latency)
+            histograms("email_agent_first_chunk_seconds", "Time to the first chunk of streamed LLM responses.",
+                       self.first_chunk)
+            counter("email_agent_call_errors_total", "Failed calls by error class.",
+                    [(dict(service=s, operation=o, error=e), n) for (s, o, e), n in sorted(self.errors.items())])
+            counter("email_agent_call_retries_total", "Retries of rate-limited or transient failures.",
+                    [(dict(service=s, operation=o), n) for (s, o), n in sorted(self.retries.items())])
+            counter("email_agent_llm_tokens_total", "LLM tokens by direction.",
+                    [(dict(service=s, operation=o, direction="input"), n) for (s, o), n in sorted(self.input_tokens.items())]
+                    + [(dict(service=s, operation=o, direction="output"), n) for (s, o), n in sorted(self.output_tokens.items())])
+            counter("email_agent_llm_cached_tokens_total", "Input tokens served from the provider's context cache.",
+                    [(dict(service=s, operation=o), n) for (s, o), n in sorted(self.cached_tokens.items())])
+            counter("email_agent_llm_cost_usd_total", "Estimated LLM cost in USD.",
+                    [(dict(service=s, operation=o), round(n, 6)) for (s, o), n in sorted(self.cost.items())])
+            counter("email_agent_llm_cache_requests_total", "LLM response cache lookups (operation near_duplicate: results reused from similar emails).",
+                    [(dict(operation=o, result=r), n) for (o, r), n in sorted(self.cache.items())])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str = METRICS_FILE):
+        """Writes `to_prometheus()` atomically, e.g. for node_exporter's textfile collector."""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+_telemetry: Optional[Telemetry] = None
+_telemetry_lock = threading.Lock()
+
+def get_telemetry() -> Telemetry:
+    """Returns the process-wide Telemetry."""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry()
+        return _telemetry
+
+
+def instrumented(service: str, operation: Optional[str] = None):
+    """Decorator recording the latency and errors of every call of a function."""
+    def decorate(fn: Callable) -> Callable:
+        name = operation or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                get_telemetry().record_call(service, name, time.perf_counter() - start, e)
+                raise
+            get_telemetry().record_call(service, name, time.perf_counter() - start)
+            return result
+        return wrapper
+    return decorate
+
+
+class InstrumentedLLMService(LLMService):
+    """
+    Wraps any LLMService and records latency, errors, retries, tokens and
+    estimated cost of every request. Token counts come from the provider when
+    the service reports them (`last_usage`), otherwise they are estimated.
+
+    Put it directly around the provider (inside CachedLLMService) so cache
+    hits are not counted as requests.
+    """
+
+    def __init__(self, inner: LLMService, telemetry: Optional[Telemetry] = None, service: str = "llm"):
+        self.inner = inner
+        self.telemetry = telemetry or get_telemetry()
+        self.service = service
+
+    @property
+    def model_name(self) -> str:
+        return getattr(self.inner, "model_name", type(self.inner).__name__)
+
+    @property
+    def supports_structured_output(self) -> bool:
+        return self.inner.supports_structured_output
+
+    def last_usage(self) -> Optional[Dict[str, int]]:
+        return self.inner.last_usage()
+
+    # --- LLMService ---
+
+    def categorize_email(self, email_content: str, prompt_template: str) -> str:
+        return self._call("categorize", compose_prompt(prompt_template, email_content),
+                          lambda: self.inner.categorize_email(email_content, prompt_template))
+
+    def extract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
+        return self._call("extract_actions", compose_prompt(prompt_template, email_content),
+                          lambda: self.inner.extract_action_items(email_content, prompt_template))
+
+    def generate_reply(self, email_content: str, prompt_template: str) -> str:
+        return self._call("reply", compose_prompt(prompt_template, email_content),
+                          lambda: self.inner.generate_reply(email_content, prompt_template))
+
+    def chat(self, context: str, user_query: str) -> str:
+        return self._call("chat", context + user_query, lambda: self.inner.chat(context, user_query))
+
+    def generate_reply_stream(self, email_content: str, prompt_template: str) -> Iterator[str]:
+        return self._stream("reply", compose_prompt(prompt_template, email_content),
+                            lambda: self.inner.generate_reply_stream(email_content, prompt_template))
+
+    def chat_stream(self, context: str, user_query: str) -> Iterator[str]:
+        return self._stream("chat", context + user_query, lambda: self.inner.chat_stream(context, user_query))
+
+    def chat_turn(self, context: str, history: List[Dict[str, str]], user_query: str) -> str:
+        return self._call("chat", chat_context(context, history) + user_query,
+                          lambda: self.inner.chat_turn(context, history, user_query))
+
+    def chat_turn_stream(self, context: str, history: List[Dict[str, str]], user_query: str) -> Iterator[str]:
+        return self._stream("chat", chat_context(context, history) + user_query,
+                            lambda: self.inner.chat_turn_stream(context, history, user_query))
+
+    def release_context(self, context: str):
+        self.inner.release_context(context)
+
+    def analyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        return self._call("analyze", compose_prompt(prompt_template, email_content),
+                          lambda: self.inner.analyze_email(email_content, prompt_template))
+
+    def analyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        return self._call("analyze_batch", compose_prompt(prompt_template, emails_content),
+                          lambda: self.inner.analyze_batch(emails_content, prompt_template))
+
+    def analyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        return self._call("analyze_thread", compose_prompt(prompt_template, email_content),
+                          lambda: self.inner.analyze_thread_message(email_content, prompt_template))
+
+    # --- Recording ---
+
+    def _call(self, operation: str, prompt: str, request: Callable):
+        start = time.perf_counter()
+        try:
+            result = request()
+        except Exception as e:
+            self.telemetry.record_call(self.service, operation, time.perf_counter() - start, e)
+            raise
+        self.telemetry.record_call(self.service, operation, time.perf_counter() - start)
+        self._record_usage(operation, prompt, result)
+        return result
+
+    def _stream(self, operation: str, prompt: str, stream: Callable) -> Iterator[str]:
+        start = time.perf_counter()
+        chunks = []
+        error = None
+        try:
+            for chunk in stream():
+                if not chunks:
+                    self.telemetry.record_first_chunk(self.service, operation, time.perf_counter() - start)
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Also runs when the caller stops the stream early
+            self.telemetry.record_call(self.service, operation, time.perf_counter() - start, error)
+            if error is None:
+                self._record_usage(operation, prompt, "".join(chunks))
+
+    def _record_usage(self, operation: str, prompt: str, result):
+        usage = self.inner.last_usage() or {
+            "input_tokens": estimate_tokens(prompt),
+            "output_tokens": estimate_tokens(result if isinstance(result, str) else str(result)),
+        }
+        self.telemetry.record_tokens(self.service, operation, self.model_name, usage.get("input_tokens", 0),
+                                     usage.get("output_tokens", 0), usage.get("retries", 0),
+                                     usage.get("cached_tokens", 0))
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark for backend.mime_body.extract_body over the MIME fixtures in
+benchmarks/fixtures/mime, compared with the previous one-level walk +
+BeautifulSoup fallback (when bs4 is installed).
+
+    python -m benchmarks.bench_mime_body [--repeat 200] [--json]
+"""
+import argparse
+import base64
+import json
+import time
+from pathlib import Path
+
+from backend.mime_body import BODY_CHAR_LIMIT, extract_body
+from benchmarks.fake_gmail import message_from_mime
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures" / "mime"
+
+
+def legacy_extract_body(payload):
+    """The body logic GmailService.fetch_emails used before backend.mime_body."""
+    from bs4 import BeautifulSoup
+
+    body = ""
+    if 'parts' in payload:
+        for part in payload['parts']:
+            if part['mimeType'] == 'text/plain':
+                data = part['body'].get('data')
+                if data:
+                    body = base64.urlsafe_b64decode(data).decode()
+                    break
+    elif 'body' in payload:
+        data = payload['body'].get('data')
+        if data:
+            body = base64.urlsafe_b64decode(data).decode()
+    if not body and 'parts' in payload:
+        for part in payload['parts']:
+            if part['mimeType'] == 'text/html':
+                data = part['body'].get('data')
+                if data:
+                    body = BeautifulSoup(base64.urlsafe_b64decode(data).decode(), 'html.parser').get_text()
+                    break
+    return body[:BODY_CHAR_LIMIT]
+
+
+def load_fixtures():
+    return {path.name: message_from_mime(path.stem, path.read_bytes())["payload"]
+            for path in sorted(FIXTURES_DIR.glob("*.eml"))}
+
+
+def time_per_call(fn, payload, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(payload)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    try:
+        import bs4  # noqa: F401
+        have_legacy = True
+    except ImportError:
+        have_legacy = False
+
+    results = []
+    for name, payload in load_fixtures().items():
+        row = {
+            "fixture": name,
+            "chars": len(extract_body(payload)),
+            "extract_body_us": time_per_call(extract_body, payload, args.repeat) * 1e6,
+        }
+        if have_legacy:
+            try:
+                row["legacy_chars"] = len(legacy_extract_body(payload))
+                row["legacy_us"] = time_per_call(legacy_extract_body, payload, args.repeat) * 1e6
+            except UnicodeDecodeError:
+                # The old code assumed UTF-8 for every part
+                row["legacy_chars"] = None
+                row["legacy_us"] = None
+        results.append(row)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'fixture':45} {'chars':>6} {'extract_body':>14} {'legacy':>14} {'legacy chars':>13}")
+    for row in results:
+        legacy = f"{row['legacy_us']:.1f} us" if row.get("legacy_us") is not None else "n/a"
+        print(f"{row['fixture']:45} {row['chars']:>6} {row['extract_body_us']:>11.1f} us {legacy:>14} "
+              f"{str(row.get('legacy_chars', 'n/a')):>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Startup benchmark: import time of each backend module in a fresh interpreter
+(as `python -X importtime` reports it, including everything it pulls in), and
+the time of the app's first script run through Streamlit's AppTest. Exits
+non-zero when a module import exceeds --max-import-ms, so it can guard
+against heavy SDKs creeping back into module scope.
+
+    python -m benchmarks.bench_startup [--repeat 3] [--json] [--max-import-ms 500]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MODULES = [
+    "backend.models",
+    "backend.storage",
+    "backend.agent",
+    "backend.llm_service",
+    "backend.llm_cache",
+    "backend.gmail_service",
+    "backend.jobs",
+    "backend.compact_inbox",
+    "backend.preclassifier",
+]
+
+# Imported on first use only; importing any of the modules above must not load them
+LAZY_MODULES = ["google.generativeai", "googleapiclient.discovery", "pandas", "st_aggrid"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+COLD_START = """
+import json, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("main.py", default_timeout=120)
+at.secrets["GEMINI_API_KEY"] = "benchmark"
+start = time.perf_counter()
+at.run()
+print(json.dumps({"seconds": time.perf_counter() - start, "exceptions": len(at.exception)}))
+"""
+
+
+def run_probe(code: str) -> dict:
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True,
+                            env={**os.environ, "PYTHONPATH": str(ROOT)})
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def import_time(module: str, repeat: int) -> dict:
+    runs = [run_probe(PROBE.format(module=module, lazy=LAZY_MODULES)) for _ in range(repeat)]
+    return {
+        "module": module,
+        "import_ms": statistics.median(run["seconds"] for run in runs) * 1000,
+        "eager_heavy_imports": runs[0]["loaded"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--max-import-ms", type=float, default=None,
+                        help="fail if any module takes longer than this to import")
+    parser.add_argument("--skip-app", action="store_true", help="only measure module imports")
+    args = parser.parse_args()
+
+    modules = [import_time(module, args.repeat) for module in MODULES]
+    results = {"modules": modules}
+    if not args.skip_app:
+        start = time.perf_counter()
+        try:
+            results["app_first_run"] = run_probe(COLD_START)
+        except RuntimeError as e:
+            results["app_first_run"] = {"error": str(e)}
+        results["app_first_run"]["process_seconds"] = time.perf_counter() - start
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'module':28} {'import':>10}  eager heavy imports")
+        for row in modules:
+            print(f"{row['module']:28} {row['import_ms']:>7.1f} ms  {', '.join(row['eager_heavy_imports']) or '-'}")
+        app = results.get("app_first_run")
+        if app and "error" in app:
+            print(f"\napp first run failed: {app['error']}")
+        elif app:
+            print(f"\napp first run: {app['seconds']:.2f}s ({app['process_seconds']:.2f}s including "
+                  f"interpreter and streamlit startup)")
+
+    if args.max_import_ms is not None:
+        slow = [row["module"] for row in modules if row["import_ms"] > args.max_import_ms]
+        if slow:
+            print(f"imports slower than {args.max_import_ms:.0f} ms: {', '.join(slow)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
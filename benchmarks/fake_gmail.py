@@ -0,0 +1,322 @@
+"""
+Local stand-in for the parts of the Gmail REST API that GmailService uses
+(messages.list with paging, messages.get, batch requests, getProfile and
+history.list). Mutate the mailbox with add_message / delete_message /
+modify_labels to generate history for incremental syncs.
+
+    with FakeGmailServer(messages) as server:
+        emails = GmailService(api_root=server.url).fetch_emails(max_results=500)
+"""
+import base64
+import email
+import email.message
+import json
+import random
+import threading
+from collections import Counter
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_PREFIX = "/gmail/v1/users/me/"
+
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def payload_from_mime(message: email.message.Message) -> Dict:
+    """Converts a parsed MIME message into the `payload` structure of the Gmail API."""
+    payload = {
+        "mimeType": message.get_content_type(),
+        "filename": message.get_filename() or "",
+        "headers": [{"name": k, "value": str(v)} for k, v in message.items()],
+    }
+    if message.is_multipart():
+        payload["body"] = {"size": 0}
+        payload["parts"] = [payload_from_mime(part) for part in message.get_payload()]
+    else:
+        raw = message.get_payload(decode=True) or b""
+        payload["body"] = {"size": len(raw), "data": base64.urlsafe_b64encode(raw).decode("ascii")}
+    return payload
+
+
+def message_from_mime(message_id: str, raw: bytes, labels: Tuple[str, ...] = ("INBOX", "UNREAD")) -> Dict:
+    """Builds a Gmail API message resource from raw RFC 822 bytes (e.g. a .eml file)."""
+    parsed = email.message_from_bytes(raw)
+    return {
+        "id": message_id,
+        "threadId": message_id,
+        "labelIds": list(labels),
+        "snippet": "",
+        "historyId": "1",
+        "payload": payload_from_mime(parsed),
+    }
+
+
+def make_message(message_id: str, subject: str, sender: str, body: str,
+                 date: Optional[datetime] = None, thread_id: Optional[str] = None,
+                 html: Optional[str] = None, labels: Tuple[str, ...] = ("INBOX", "UNREAD")) -> Dict:
+    """Builds a Gmail API message resource with a text/plain (and optional text/html) part."""
+    date = date or datetime(2024, 1, 1, tzinfo=timezone.utc)
+    parts = [{"partId": "0", "mimeType": "text/plain", "headers": [], "body": {"data": _b64(body)}}]
+    if html is not None:
+        parts.append({"partId": "1", "mimeType": "text/html", "headers": [], "body": {"data": _b64(html)}})
+    return {
+        "id": message_id,
+        "threadId": thread_id or message_id,
+        "labelIds": list(labels),
+        "snippet": body[:100],
+        "historyId": "1",
+        "internalDate": str(int(date.timestamp() * 1000)),
+        "payload": {
+            "mimeType": "multipart/alternative",
+            "headers": [
+                {"name": "Subject", "value": subject},
+                {"name": "From", "value": sender},
+                {"name": "Date", "value": format_datetime(date)},
+            ],
+            "body": {"size": 0},
+            "parts": parts,
+        },
+    }
+
+
+QUOTED_REPLY = ("\n\nOn Mon, Jan 1, 2024 at 9:00 AM Someone <someone@example.com> wrote:\n"
+                + "> Earlier message in the thread, quoted again in every reply.\n" * 30)
+FOOTER = ("\n\n--\nJane Doe | Operations\nExample Corp, 1 Main Street\n+1 555 0100\n\n"
+          "This email and any attachments are confidential and intended solely for the addressee. "
+          "If you are not the intended recipient, please delete it.\n\n"
+          "Unsubscribe: https://mail.example.com/unsubscribe?u=0123456789abcdef0123456789abcdef&list=news")
+
+
+def synthetic_messages(count: int, seed: int = 0, noisy: bool = False, thread_length: int = 1) -> List[Dict]:
+    """
+    Deterministic corpus of `count` plausible messages, newest first. With
+    `noisy`, bodies also carry quoted reply history, signatures and footers;
+    with `thread_length` > 1, consecutive messages form conversations of that length.
+    """
+    rng = random.Random(seed)
+    senders = ["boss@company.com", "newsletter@techweekly.com", "billing@bank.com",
+               "friend@mail.com", "noreply@ci.example.com", "offers@shop.com"]
+    topics = ["Q4 report", "weekly digest", "invoice", "dinner plans", "build failed", "big sale"]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for i in range(count):
+        topic = rng.choice(topics)
+        body = f"Hi, this is about the {topic}. " * rng.randint(2, 20)
+        if noisy:
+            body += (QUOTED_REPLY if i % 2 else "") + FOOTER
+        messages.append(make_message(
+            f"m{i:07d}",
+            f"{topic.title()} #{i}",
+            rng.choice(senders),
+            body,
+            date=start + timedelta(minutes=count - i),
+            thread_id=f"t{i // thread_length:07d}" if thread_length > 1 else None,
+            html=f"<p>{body}</p>" if i % 3 == 0 else None,
+        ))
+    return messages
+
+
+class FakeGmailServer:
+    """Threaded HTTP server serving `messages` (newest first). Counts requests by endpoint."""
+
+    def __init__(self, messages: List[Dict], host: str = "127.0.0.1", port: int = 0,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.messages = list(messages)
+        self.by_id = {m["id"]: m for m in self.messages}
+        # Fraction of message gets answered with 429, to exercise retries
+        self.error_rate = error_rate
+        self.request_counts: Counter = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.history_id = 1
+        # (historyId, record) in order; history before `history_floor` has expired
+        self.history: List[Tuple[int, Dict]] = []
+        self.history_floor = 1
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakeGmailServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- Mailbox changes ---
+
+    def add_message(self, message: Dict):
+        with self._lock:
+            self.messages.insert(0, message)
+            self.by_id[message["id"]] = message
+            self._record("messagesAdded", {"message": self._stub(message)})
+
+    def delete_message(self, message_id: str):
+        with self._lock:
+            message = self.by_id.pop(message_id)
+            self.messages.remove(message)
+            self._record("messagesDeleted", {"message": self._stub(message)})
+
+    def modify_labels(self, message_id: str, add: Tuple[str, ...] = (), remove: Tuple[str, ...] = ()):
+        with self._lock:
+            message = self.by_id[message_id]
+            message["labelIds"] = [l for l in message["labelIds"] if l not in remove] + \
+                [l for l in add if l not in message["labelIds"]]
+            if add:
+                self._record("labelsAdded", {"message": self._stub(message), "labelIds": list(add)})
+            if remove:
+                self._record("labelsRemoved", {"message": self._stub(message), "labelIds": list(remove)})
+
+    def expire_history(self):
+        """Drops all history, as Gmail does after about a week; the next history.list returns 404."""
+        with self._lock:
+            self.history = []
+            self.history_floor = self.history_id + 1
+
+    def _record(self, kind: str, item: Dict):
+        self.history_id += 1
+        if kind != "messagesDeleted":
+            self.by_id[item["message"]["id"]]["historyId"] = str(self.history_id)
+        self.history.append((self.history_id, {"id": str(self.history_id), kind: [item]}))
+
+    @staticmethod
+    def _stub(message: Dict) -> Dict:
+        return {"id": message["id"], "threadId": message["threadId"], "labelIds": list(message["labelIds"])}
+
+    # --- API ---
+
+    def dispatch(self, method: str, target: str) -> Tuple[int, Dict]:
+        url = urlsplit(target)
+        params = {k: v if len(v) > 1 else v[0] for k, v in parse_qs(url.query).items()}
+        path = unquote(url.path)
+        if not path.startswith(API_PREFIX) or method != "GET":
+            return 404, {"error": {"code": 404, "message": f"Unknown endpoint {method} {path}"}}
+        resource = path[len(API_PREFIX):].split("/")
+
+        with self._lock:
+            if resource == ["messages"]:
+                self.request_counts["messages.list"] += 1
+                return 200, self._list(params)
+            if resource == ["profile"]:
+                self.request_counts["getProfile"] += 1
+                return 200, {"emailAddress": "me@example.com", "messagesTotal": len(self.messages),
+                             "historyId": str(self.history_id)}
+            if resource == ["history"]:
+                self.request_counts["history.list"] += 1
+                return self._history(params)
+            if len(resource) == 2 and resource[0] == "messages":
+                self.request_counts["messages.get"] += 1
+                if self.error_rate and self._rng.random() < self.error_rate:
+                    return 429, {"error": {"code": 429, "message": "Rate limit exceeded"}}
+                return self._get(resource[1], params)
+        return 404, {"error": {"code": 404, "message": f"Unknown endpoint {path}"}}
+
+    def _list(self, params: Dict) -> Dict:
+        offset = int(params.get("pageToken", 0))
+        limit = min(int(params.get("maxResults", 100)), 500)
+        page = self.messages[offset:offset + limit]
+        result = {
+            "messages": [{"id": m["id"], "threadId": m["threadId"]} for m in page],
+            "resultSizeEstimate": len(self.messages),
+        }
+        if offset + limit < len(self.messages):
+            result["nextPageToken"] = str(offset + limit)
+        return result
+
+    def _history(self, params: Dict) -> Tuple[int, Dict]:
+        start = int(params["startHistoryId"])
+        if start < self.history_floor:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        records = [record for history_id, record in self.history if history_id > start]
+        offset = int(params.get("pageToken", 0))
+        limit = int(params.get("maxResults", 100))
+        result = {"history": records[offset:offset + limit], "historyId": str(self.history_id)}
+        if offset + limit < len(records):
+            result["nextPageToken"] = str(offset + limit)
+        return 200, result
+
+    def _get(self, message_id: str, params: Dict) -> Tuple[int, Dict]:
+        message = self.by_id.get(message_id)
+        if message is None:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        fmt = params.get("format", "full")
+        if fmt == "full":
+            return 200, message
+        result = {k: v for k, v in message.items() if k != "payload"}
+        if fmt == "metadata":
+            wanted = params.get("metadataHeaders", [])
+            wanted = {wanted} if isinstance(wanted, str) else set(wanted)
+            headers = [h for h in message["payload"]["headers"] if not wanted or h["name"] in wanted]
+            result["payload"] = {"mimeType": message["payload"]["mimeType"], "headers": headers}
+        return 200, result
+
+    def _batch(self, content_type: str, body: bytes) -> Tuple[str, bytes]:
+        self.request_counts["batch"] += 1
+        request = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        boundary = "fake_gmail_batch_boundary"
+        chunks = []
+        for part in request.get_payload():
+            inner = part.get_payload()
+            if isinstance(inner, list):
+                inner = inner[0].as_string()
+            method, target = inner.split("\n", 1)[0].split()[:2]
+            status, payload = self.dispatch(method, target)
+            content_id = part.get("Content-ID", "").strip("<>")
+            chunks.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        chunks.append(f"--{boundary}--\r\n")
+        return f"multipart/mixed; boundary={boundary}", "".join(chunks).encode("utf-8")
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, payload = server.dispatch("GET", self.path)
+                self._send(status, "application/json; charset=UTF-8", json.dumps(payload).encode("utf-8"))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if urlsplit(self.path).path.rstrip("/").endswith("batch"):
+                    content_type, payload = server._batch(self.headers.get("Content-Type", ""), body)
+                    self._send(200, content_type, payload)
+                else:
+                    status, payload = server.dispatch("POST", self.path)
+                    self._send(status, "application/json; charset=UTF-8", json.dumps(payload).encode("utf-8"))
+
+            def _send(self, status: int, content_type: str, payload: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
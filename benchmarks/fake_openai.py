@@ -0,0 +1,175 @@
+"""
+Local stand-in for an OpenAI-compatible chat-completions server (llama.cpp,
+vLLM, Ollama), answering through benchmarks.fakes.FakeLLMService: the same
+canned answers, latency and injected 429/503s, but over HTTP, so
+OpenAICompatibleLLMService is exercised end to end (connection pool,
+timeouts, retries, streaming). Counts requests by operation and the TCP
+connections opened, which shows whether keep-alive works.
+
+    with FakeOpenAIServer(FakeLLMService(latency=Latency("fixed", 0.05))) as server:
+        llm = OpenAICompatibleLLMService(server.url, "fake-llm")
+        EmailAgent(llm, max_workers=16).process_emails(emails, prompts)
+"""
+import json
+import re
+import socket
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from backend.llm_errors import LLMError, RateLimitError, TransientLLMError
+from backend.llm_service import estimate_tokens
+from benchmarks.fakes import FakeLLMService
+
+COMPLETIONS_PATH = "/v1/chat/completions"
+# First line of the email(s) in a rendered prompt
+_EMAIL_START = re.compile(r"^(ID|From|Subject): ", re.MULTILINE)
+
+
+class FakeOpenAIServer:
+    """
+    Threaded HTTP/1.1 server for POST /v1/chat/completions. The operation is
+    told from the request: the `response_format` schema name for structured
+    output, the system message for chat, otherwise the wording of the prompt.
+    """
+
+    def __init__(self, llm: Optional[FakeLLMService] = None, host: str = "127.0.0.1", port: int = 0):
+        # No retries inside the fake: its failures are answered as HTTP errors for the client to retry
+        self.llm = llm or FakeLLMService()
+        self.llm.scheduler.max_retries = 0
+        self.request_counts: Counter = Counter()
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"requests": dict(self.request_counts), "connections": self.connections, "llm": self.llm.stats()}
+
+    # --- API ---
+
+    def complete(self, payload: Dict) -> Tuple[int, Dict, Dict[str, str]]:
+        """(status, body, extra headers) for one chat-completions request."""
+        messages = payload.get("messages") or []
+        if not messages:
+            return 400, {"error": {"message": "'messages' is required"}}, {}
+        operation, answer = self._operation(payload, messages)
+        with self._lock:
+            self.request_counts[operation] += 1
+        try:
+            result = answer()
+        except RateLimitError as e:
+            return 429, {"error": {"message": str(e)}}, {"Retry-After": str(e.retry_after or 1)}
+        except TransientLLMError as e:
+            return 503, {"error": {"message": str(e)}}, {}
+        except LLMError as e:
+            return 400, {"error": {"message": str(e)}}, {}
+        content = result if isinstance(result, str) else json.dumps(result)
+        prompt_tokens = estimate_tokens("".join(m.get("content") or "" for m in messages))
+        completion_tokens = estimate_tokens(content)
+        return 200, {
+            "object": "chat.completion",
+            "model": payload.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }, {}
+
+    def _operation(self, payload: Dict, messages: List[Dict]):
+        llm = self.llm
+        prompt = messages[-1].get("content") or ""
+        # The canned answers look at the email only, not at the instructions around it
+        start = _EMAIL_START.search(prompt)
+        text = prompt[start.start():] if start else prompt
+        schema = ((payload.get("response_format") or {}).get("json_schema") or {}).get("name")
+        if schema == "analysis":
+            return "analyze", lambda: llm.analyze_email(text, "")
+        if schema == "batch_analysis":
+            return "analyze_batch", lambda: [{"id": email_id, **analysis}
+                                             for email_id, analysis in llm.analyze_batch(text, "").items()]
+        if schema == "thread_analysis":
+            return "analyze_thread", lambda: llm.analyze_thread_message(text, "")
+        if messages[0].get("role") == "system":
+            return "chat", lambda: llm.chat(messages[0]["content"], text)
+        lowered = prompt.lower()
+        if "json" in lowered and "tasks" in lowered:
+            return "extract_actions", lambda: {"tasks": llm.extract_action_items(text, "")}
+        if "reply" in lowered:
+            return "reply", lambda: llm.generate_reply(text, "")
+        return "categorize", lambda: llm.categorize_email(text, "")
+
+    @staticmethod
+    def stream_events(body: Dict) -> bytes:
+        """A complete answer re-sent as server-sent events: a few content deltas, then usage."""
+        content = body["choices"][0]["message"]["content"]
+        words = content.split(" ")
+        chunks = [" ".join(words[i:i + 8]) + (" " if i + 8 < len(words) else "") for i in range(0, len(words), 8)]
+        events = [{"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": chunk}}]}
+                  for chunk in chunks]
+        events.append({"object": "chat.completion.chunk", "choices": [], "usage": body["usage"]})
+        return ("".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n").encode("utf-8")
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately; without this every response waits for a delayed ACK
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with server._lock:
+                    server.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.rstrip("/") != COMPLETIONS_PATH:
+                    return self._send(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+                try:
+                    payload = json.loads(body)
+                except json.JSONDecodeError:
+                    return self._send(400, {"error": {"message": "Request body is not JSON"}})
+                status, result, headers = server.complete(payload)
+                if status == 200 and payload.get("stream"):
+                    return self._send(status, server.stream_events(result), content_type="text/event-stream")
+                self._send(status, result, headers)
+
+            def _send(self, status: int, payload, headers: Optional[Dict[str, str]] = None,
+                      content_type: str = "application/json"):
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,229 @@
+"""
+Offline stand-ins for the external services, for benchmarks: FakeLLMService
+answers like a model would (deterministically, from the email text) with
+configurable latency, injected 429s/server errors and token accounting.
+For Gmail see benchmarks.fake_gmail, for serving it over HTTP as an
+OpenAI-compatible server benchmarks.fake_openai.
+
+    llm = FakeLLMService(latency=Latency("lognormal", 0.3), rate_limit_rate=0.05)
+    EmailAgent(llm, max_workers=8).process_emails(emails, prompts)
+    print(llm.stats())
+"""
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, List, Optional
+
+from backend.llm_errors import RateLimitError, TransientLLMError
+from backend.llm_service import LLMService, estimate_tokens
+from backend.rate_limiter import RateLimiter, RequestScheduler
+
+
+class Latency:
+    """
+    Response time distribution, in seconds: "none", "fixed" (always `median`),
+    "uniform" (0 to 2 * `median`) or "lognormal" (median `median`, spread
+    `sigma`; the long tail real APIs have). `per_output_token` is added per
+    generated token.
+    """
+
+    KINDS = ("none", "fixed", "uniform", "lognormal")
+
+    def __init__(self, kind: str = "none", median: float = 0.0, sigma: float = 0.5,
+                 per_output_token: float = 0.0):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution {kind!r}, expected one of {self.KINDS}")
+        self.kind = kind
+        self.median = median
+        self.sigma = sigma
+        self.per_output_token = per_output_token
+
+    def sample(self, rng: random.Random) -> float:
+        """Time to the first token; generation adds `per_output_token` per token."""
+        if self.kind == "fixed":
+            return self.median
+        if self.kind == "uniform":
+            return rng.uniform(0, 2 * self.median)
+        if self.kind == "lognormal" and self.median > 0:
+            return rng.lognormvariate(math.log(self.median), self.sigma)
+        return 0.0
+
+    def __repr__(self):
+        return f"Latency({self.kind!r}, median={self.median}, sigma={self.sigma})"
+
+
+# Keyword -> category of the canned model, checked in order; matches benchmarks.fake_gmail's corpus
+CATEGORY_KEYWORDS = [
+    ("unsubscribe", "Newsletter"),
+    ("digest", "Newsletter"),
+    ("newsletter", "Newsletter"),
+    ("big sale", "Spam"),
+    ("invoice", "Finance"),
+    ("dinner", "Personal"),
+]
+
+_BATCH_ID = re.compile(r"^ID: (\S+)", re.MULTILINE)
+
+
+class FakeLLMService(LLMService):
+    """
+    Deterministic LLMService for benchmarks. Each request sleeps for a sample
+    of `latency`, then fails with probability `rate_limit_rate` (RateLimitError,
+    with `retry_after`) or `error_rate` (TransientLLMError), which the shared
+    RequestScheduler retries exactly as for Gemini. With `requests_per_minute`
+    the fake also enforces a provider quota and answers 429 beyond it.
+
+    Counts requests per operation, failures and estimated prompt/output tokens.
+    """
+    supports_structured_output = True
+
+    def __init__(self, latency: Optional[Latency] = None, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 0.01,
+                 requests_per_minute: Optional[float] = None, client_requests_per_minute: Optional[float] = None,
+                 max_retries: int = 5, base_delay: float = 0.01, seed: int = 0):
+        self.model_name = "fake-llm"
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        # Server side quota (sliding one-minute window); client_requests_per_minute is what
+        # the client paces itself to
+        self.requests_per_minute = requests_per_minute
+        self._window: deque = deque()
+        self.scheduler = RequestScheduler(RateLimiter(client_requests_per_minute), max_retries,
+                                          base_delay=base_delay, max_delay=1.0)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.busy_seconds = 0.0
+
+    # --- LLMService ---
+
+    def categorize_email(self, email_content: str, prompt_template: str) -> str:
+        return self._request("categorize", prompt_template + email_content, lambda: self._category(email_content))
+
+    def extract_action_items(self, email_content: str, prompt_template: str) -> List[str]:
+        return self._request("extract_actions", prompt_template + email_content, lambda: self._tasks(email_content))
+
+    def generate_reply(self, email_content: str, prompt_template: str) -> str:
+        return self._request("reply", prompt_template + email_content, lambda: self._reply(email_content))
+
+    def chat(self, context: str, user_query: str) -> str:
+        return self._request("chat", context + user_query,
+                             lambda: f"Based on {len(context)} characters of context: {user_query}")
+
+    def analyze_email(self, email_content: str, prompt_template: str) -> Dict:
+        return self._request("analyze", prompt_template + email_content, lambda: {
+            "category": self._category(email_content),
+            "tasks": self._tasks(email_content),
+        })
+
+    def analyze_batch(self, emails_content: str, prompt_template: str) -> Dict[str, Dict]:
+        def answer():
+            entries = re.split(r"\n---\n", emails_content)
+            results = {}
+            for entry in entries:
+                match = _BATCH_ID.search(entry)
+                if match:
+                    results[match.group(1)] = {"category": self._category(entry), "tasks": self._tasks(entry)}
+            return results
+        return self._request("analyze_batch", prompt_template + emails_content, answer)
+
+    def analyze_thread_message(self, email_content: str, prompt_template: str) -> Dict:
+        def answer():
+            subject = next((line[len("Subject: "):] for line in email_content.splitlines()
+                            if line.startswith("Subject: ")), "")
+            return {"category": self._category(email_content), "tasks": self._tasks(email_content),
+                    "summary": f"Conversation so far: latest about {subject or 'this thread'}."}
+        return self._request("analyze_thread", prompt_template + email_content, answer)
+
+    # --- Accounting ---
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": sum(self.requests.values()),
+                "requests_by_operation": dict(self.requests),
+                "failures": dict(self.failures),
+                "retries": self.scheduler.retries,
+                "prompt_tokens": self.prompt_tokens,
+                "output_tokens": self.output_tokens,
+                "busy_seconds": round(self.busy_seconds, 3),
+            }
+
+    def _request(self, operation: str, prompt: str, answer):
+        prompt_tokens = estimate_tokens(prompt)
+
+        def attempt():
+            with self._lock:
+                self.requests[operation] += 1
+                self.prompt_tokens += prompt_tokens
+                roll = self._rng.random()
+                delay = self.latency.sample(self._rng)
+            if delay:
+                time.sleep(delay)
+            if self._over_quota():
+                self._fail("quota")
+                raise RateLimitError("Quota exceeded", retry_after=self.retry_after)
+            if roll < self.rate_limit_rate:
+                self._fail("rate_limit")
+                raise RateLimitError("Resource exhausted", retry_after=self.retry_after)
+            if roll < self.rate_limit_rate + self.error_rate:
+                self._fail("server_error")
+                raise TransientLLMError("503 Service unavailable")
+
+            result = answer()
+            output_tokens = estimate_tokens(result if isinstance(result, str) else json.dumps(result))
+            extra = self.latency.per_output_token * output_tokens
+            if extra:
+                time.sleep(extra)
+            with self._lock:
+                self.output_tokens += output_tokens
+                self.busy_seconds += delay + extra
+            return result
+
+        return self.scheduler.run(attempt, prompt_tokens)
+
+    def _over_quota(self) -> bool:
+        if not self.requests_per_minute:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._window and self._window[0] <= now - 60:
+                self._window.popleft()
+            if len(self._window) >= self.requests_per_minute:
+                return True
+            self._window.append(now)
+            return False
+
+    def _fail(self, reason: str):
+        with self._lock:
+            self.failures[reason] += 1
+
+    # --- Canned answers ---
+
+    @staticmethod
+    def _category(text: str) -> str:
+        lowered = text.lower()
+        for keyword, category in CATEGORY_KEYWORDS:
+            if keyword in lowered:
+                return category
+        return "Work"
+
+    def _tasks(self, text: str) -> List[str]:
+        if self._category(text) in ("Newsletter", "Spam"):
+            return []
+        subject = next((line[len("Subject: "):] for line in text.splitlines() if line.startswith("Subject: ")), "")
+        return [f"Follow up on {subject or 'this email'}"]
+
+    @staticmethod
+    def _reply(text: str) -> str:
+        subject = next((line[len("Subject: "):] for line in text.splitlines() if line.startswith("Subject: ")), "")
+        return f"Hi,\n\nThanks for your email about {subject or 'this'}. I'll get back to you shortly.\n\nBest regards"
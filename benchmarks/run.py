@@ -0,0 +1,287 @@
+"""
+Offline end-to-end benchmarks at several inbox sizes, with no network access:
+Gmail is served by benchmarks.fake_gmail, the LLM is benchmarks.fakes.FakeLLMService
+and stores live in a temporary directory (data/ is not touched).
+
+Scenarios:
+    fetch    GmailService.fetch_emails against the fake Gmail server
+    process  EmailAgent.process_emails with separate, combined, batched and thread prompts;
+             with --llm openai-stub through OpenAICompatibleLLMService and benchmarks.fake_openai
+    store    save_inbox / load_inbox (replace_all / load_all) for the SQLite and JSON stores
+    context  building the BM25 index and the chat context (build_context)
+    memory   memory held by the inbox and its InboxIndex: Email objects in a list, or a CompactInbox
+
+Results are printed as a table, and written as JSON with --output so runs on
+different commits can be compared with --compare.
+
+    python -m benchmarks.run [--sizes 10,1000,100000] [--scenarios fetch,process,store,context]
+                             [--latency lognormal --latency-ms 200] [--rate-limit-rate 0.02]
+                             [--noisy --preprocess] [--thread-length 5] [--near-duplicates]
+                             [--llm openai-stub --max-connections 16]
+                             [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from backend.agent import EmailAgent
+from backend.compact_inbox import CompactEmailMapping, CompactInbox
+from backend.gmail_service import GmailService
+from backend.inbox_index import InboxIndex
+from backend.inbox_store import JSONInboxStore, SQLiteInboxStore
+from backend.models import Email
+from backend.near_duplicate import NearDuplicateIndex
+from backend.openai_compat_service import OpenAICompatibleLLMService
+from backend.preprocess import EmailPreprocessor
+from backend.retrieval import BM25Index, build_context
+from backend.storage import load_prompts
+from benchmarks.fake_gmail import FakeGmailServer, synthetic_messages
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fakes import FakeLLMService, Latency
+
+SCENARIOS = ("fetch", "process", "store", "context", "memory")
+PROCESS_MODES = ("separate", "combined", "batch", "thread")
+CONTEXT_QUERIES = ["q4 report deadline", "invoice from the bank", "dinner plans this week",
+                   "why did the build fail", "what should I do today"]
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def corpus(size: int, noisy: bool = False, thread_length: int = 1) -> List[Email]:
+    """The synthetic Gmail corpus parsed the way fetch_emails parses it."""
+    parser = GmailService()
+    return [parser._parse_message(message)
+            for message in synthetic_messages(size, noisy=noisy, thread_length=thread_length)]
+
+
+def row(scenario: str, variant: str, size: int, seconds: float, **extra) -> Dict:
+    return {
+        "scenario": scenario,
+        "variant": variant,
+        "size": size,
+        "seconds": round(seconds, 4),
+        "per_email_us": round(seconds / max(1, size) * 1e6, 1),
+        **extra,
+    }
+
+
+def bench_fetch(size: int, emails: List[Email], args, workdir: str) -> List[Dict]:
+    messages = synthetic_messages(size, noisy=args.noisy, thread_length=args.thread_length)
+    with FakeGmailServer(messages, error_rate=args.gmail_error_rate) as server:
+        gmail = GmailService(api_root=server.url, max_workers=args.workers,
+                             sync_state_file=os.path.join(workdir, "sync_state.json"))
+        gmail.authenticate()
+        seconds, fetched = timed(lambda: gmail.fetch_emails(max_results=size))
+        counts = dict(server.request_counts)
+    return [row("fetch", "full", size, seconds, fetched=len(fetched), requests=counts)]
+
+
+def bench_process(size: int, emails: List[Email], args, workdir: str) -> List[Dict]:
+    base = load_prompts()
+    prompts_by_mode = {
+        "separate": base.model_copy(update={"combined_analysis": None, "batch_analysis": None}),
+        "combined": base.model_copy(update={"batch_analysis": None}),
+        "batch": base,
+        # Conversations through thread_analysis, the rest batched
+        "thread": base,
+    }
+    rows = []
+    for mode in args.modes:
+        llm = FakeLLMService(
+            latency=Latency(args.latency, args.latency_ms / 1000, per_output_token=args.per_token_ms / 1000),
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            requests_per_minute=args.quota_rpm,
+            client_requests_per_minute=args.client_rpm,
+            seed=args.seed,
+        )
+        preprocessor = EmailPreprocessor() if args.preprocess else None
+        thread_store = None
+        if mode == "thread":
+            thread_store = SQLiteInboxStore(os.path.join(workdir, f"threads-{size}.sqlite3"))
+            thread_store.replace_all(emails)
+        near_duplicates = NearDuplicateIndex(args.near_duplicate_distance) if args.near_duplicates else None
+        # The fake model behind a local HTTP server, requested over a real connection pool
+        server = FakeOpenAIServer(llm) if args.llm == "openai-stub" else None
+        with server or nullcontext():
+            client = OpenAICompatibleLLMService(server.url, llm.model_name,
+                                                max_connections=args.max_connections) if server else llm
+            if server:
+                # Back off as briefly as the fake does for its own retries
+                client.scheduler.base_delay = llm.scheduler.base_delay
+            agent = EmailAgent(client, max_workers=args.workers, batch_size=args.batch_size, preprocessor=preprocessor,
+                               thread_store=thread_store, near_duplicates=near_duplicates)
+            batch = [email.model_copy() for email in emails]
+            seconds, _ = timed(lambda: agent.process_emails(batch, prompts_by_mode[mode], force=True))
+            stats = server.stats() if server else llm.stats()
+            if server:
+                client.close()
+        extra = {"body_tokens_saved": preprocessor.stats().tokens_saved} if preprocessor else {}
+        rows.append(row("process", mode, size, seconds,
+                        emails_per_second=round(size / seconds, 1) if seconds else None,
+                        failed=len(agent.last_failures), threaded=agent.last_threaded, reused=agent.last_reused, llm=stats, **extra))
+    return rows
+
+
+def bench_store(size: int, emails: List[Email], args, workdir: str) -> List[Dict]:
+    rows = []
+    for engine, store in (("sqlite", SQLiteInboxStore(os.path.join(workdir, f"inbox-{size}.sqlite3"))),
+                          ("json", JSONInboxStore(os.path.join(workdir, f"inbox-{size}.json")))):
+        save_seconds, _ = timed(lambda: store.replace_all(emails))
+        load_seconds, loaded = timed(store.load_all)
+        rows.append(row("store", f"{engine}-save", size, save_seconds))
+        rows.append(row("store", f"{engine}-load", size, load_seconds, loaded=len(loaded)))
+    return rows
+
+
+def bench_context(size: int, emails: List[Email], args, workdir: str) -> List[Dict]:
+    index = BM25Index()
+    index_seconds, _ = timed(lambda: index.sync(emails))
+    emails_by_id = {email.id: email for email in emails}
+    start = time.perf_counter()
+    lengths = [len(build_context(index, emails_by_id, query, fallback=emails[:20])) for query in CONTEXT_QUERIES]
+    query_seconds = (time.perf_counter() - start) / len(CONTEXT_QUERIES)
+    return [
+        row("context", "index", size, index_seconds),
+        row("context", "build_context", size, query_seconds,
+            per_query_ms=round(query_seconds * 1000, 2), context_chars=max(lengths)),
+    ]
+
+
+def traced(fn):
+    """(seconds, result, bytes allocated by `fn` and still held afterwards)."""
+    tracemalloc.start()
+    try:
+        seconds, result = timed(fn)
+        held = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return seconds, result, held
+
+
+def bench_memory(size: int, emails: List[Email], args, workdir: str) -> List[Dict]:
+    rows = []
+    for variant, build_inbox, index_store in (
+        ("list", lambda: [email.model_copy() for email in emails], lambda inbox: None),
+        # Bodies go to a temporary file, only the columns stay in memory
+        ("compact", lambda: CompactInbox(emails), CompactEmailMapping),
+    ):
+        inbox_seconds, inbox, inbox_bytes = traced(build_inbox)
+        store = index_store(inbox)
+        index_seconds, _, index_bytes = traced(
+            lambda: InboxIndex(inbox) if store is None else InboxIndex(store=store))
+        rows.append(row("memory", variant, size, inbox_seconds + index_seconds,
+                        inbox_mb=round(inbox_bytes / 1e6, 2), index_mb=round(index_bytes / 1e6, 2),
+                        total_mb=round((inbox_bytes + index_bytes) / 1e6, 2)))
+    return rows
+
+
+BENCHMARKS = {"fetch": bench_fetch, "process": bench_process, "store": bench_store, "context": bench_context,
+              "memory": bench_memory}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(rows: List[Dict], baseline: Dict = None):
+    header = f"{'scenario':9} {'variant':14} {'size':>7} {'seconds':>10} {'us/email':>10}"
+    print(header + (f" {'baseline':>10} {'change':>8}" if baseline is not None else ""))
+    for r in rows:
+        line = f"{r['scenario']:9} {r['variant']:14} {r['size']:>7} {r['seconds']:>10.4f} {r['per_email_us']:>10.1f}"
+        if baseline is not None:
+            old = baseline.get((r["scenario"], r["variant"], r["size"]))
+            if old:
+                line += f" {old['seconds']:>10.4f} {(r['seconds'] / old['seconds'] - 1) * 100 if old['seconds'] else 0:>+7.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,100000", help="comma separated inbox sizes")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--modes", default=",".join(PROCESS_MODES), help="prompt setups for the process scenario")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--latency", choices=Latency.KINDS, default="none", help="fake LLM latency distribution")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="median fake LLM latency")
+    parser.add_argument("--per-token-ms", type=float, default=0.0, help="fake LLM generation time per output token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of LLM requests failing with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of LLM requests failing with 429")
+    parser.add_argument("--quota-rpm", type=float, default=None, help="fake provider quota, requests per minute")
+    parser.add_argument("--client-rpm", type=float, default=None, help="client side request pacing")
+    parser.add_argument("--llm", choices=("fake", "openai-stub"), default="fake",
+                        help="call the fake LLM directly, or over HTTP through benchmarks.fake_openai")
+    parser.add_argument("--max-connections", type=int, default=16, help="connection pool size for --llm openai-stub")
+    parser.add_argument("--preprocess", action="store_true", help="clean bodies before prompting (backend.preprocess)")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="reuse results for near-duplicate emails (backend.near_duplicate)")
+    parser.add_argument("--near-duplicate-distance", type=int, default=10, help="max differing SimHash bits")
+    parser.add_argument("--noisy", action="store_true", help="add quoted replies, signatures and footers to bodies")
+    parser.add_argument("--thread-length", type=int, default=1, help="messages per synthetic conversation")
+    parser.add_argument("--gmail-error-rate", type=float, default=0.0, help="fraction of messages.get answered 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--json", action="store_true", help="print the JSON results instead of a table")
+    args = parser.parse_args()
+    args.modes = [mode for mode in args.modes.split(",") if mode]
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(scenarios) - set(SCENARIOS) | set(args.modes) - set(PROCESS_MODES)
+    if unknown:
+        parser.error(f"unknown scenario or mode: {', '.join(sorted(unknown))}")
+
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="email-agent-bench-") as workdir:
+        for size in sizes:
+            emails = corpus(size, args.noisy, args.thread_length)
+            for name in scenarios:
+                log(f"{name} @ {size} emails ...")
+                rows.extend(BENCHMARKS[name](size, emails, args, workdir))
+
+    results = {
+        "commit": git_commit(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "json")},
+        "results": rows,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = {(r["scenario"], r["variant"], r["size"]): r for r in json.load(f)["results"]}
+    print_table(rows, baseline)
+
+
+if __name__ == "__main__":
+    main()
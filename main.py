@@ -1,13 +1,23 @@
-from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
 import streamlit as st
-import pandas as pd
 import json
 import os
 from pathlib import Path
+from typing import Optional
 from backend.models import Email, PromptConfig, Draft
-from backend.storage import load_inbox, save_inbox, load_prompts, save_prompts
-from backend.llm_service import GeminiLLMService
+from backend.storage import load_inbox, save_emails, save_email, load_prompts, save_prompts, merge_with_saved, get_store, InboxIndex
+from backend.gmail_service import GmailService
+from backend.llm_cache import CachedLLMService
 from backend.agent import EmailAgent
+from backend.preclassifier import Preclassifier
+from backend.preprocess import EmailPreprocessor
+from backend.near_duplicate import NearDuplicateIndex
+from backend.jobs import JobQueue, JobWorker
+from backend.retrieval import BM25Index, select_context
+from backend.compact_inbox import CompactInbox, CompactEmailMapping
+from backend.services import (
+    Settings, create_agent, create_llm_service, create_near_duplicate_index, create_preclassifier, create_preprocessor,
+)
+from backend.telemetry import get_telemetry, METRICS_FILE
 
 # --- Page Config ---
 st.set_page_config(
@@ -23,24 +33,81 @@ if "emails" not in st.session_state:
 if "prompts" not in st.session_state:
     st.session_state.prompts = load_prompts()
 
+def get_setting(name: str, default=None):
+    """Reads a setting from Streamlit secrets, falling back to the environment."""
+    return st.secrets.get(name) or os.getenv(name) or default
+
+# LLM backends, processing and the optional local shortcuts; see backend.services.Settings
+SETTINGS = Settings.load(get_setting)
+
+
+# Clients below are created once per server process and shared by every session,
+# so a new browser tab doesn't pay for SDK setup, cache files or model training again.
+
+@st.cache_resource
+def get_llm_service(api_key: str):
+    """The configured LLM backends (one rate limiter / connection pool each for the whole process) behind the response cache."""
+    return create_llm_service(SETTINGS, api_key)
+
+@st.cache_resource
+def get_preclassifier() -> Optional[Preclassifier]:
+    return create_preclassifier(SETTINGS, load_inbox())
+
+@st.cache_resource
+def get_preprocessor() -> Optional[EmailPreprocessor]:
+    # Shared, so its tokens-saved report covers every session and background job
+    return create_preprocessor(SETTINGS)
+
+@st.cache_resource
+def get_near_duplicate_index() -> Optional[NearDuplicateIndex]:
+    return create_near_duplicate_index(SETTINGS, load_inbox())
+
+def build_agent(llm_service) -> EmailAgent:
+    return create_agent(llm_service, SETTINGS, get_store(), get_preclassifier(), get_preprocessor(),
+                        get_near_duplicate_index())
+
 if "llm_service" not in st.session_state:
 
-    default_key = st.secrets.get("GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY")
+    default_key = get_setting("GEMINI_API_KEY")
 
     try:
-        st.session_state.llm_service = GeminiLLMService(default_key)
-        st.session_state.agent = EmailAgent(st.session_state.llm_service)
+        st.session_state.llm_service = get_llm_service(default_key)
+        st.session_state.agent = build_agent(st.session_state.llm_service)
     except Exception as e:
         st.error(f"Failed to initialize AI Service: {e}")
 
 if "agent" not in st.session_state and "llm_service" in st.session_state:
-    st.session_state.agent = EmailAgent(st.session_state.llm_service)
+    st.session_state.agent = build_agent(st.session_state.llm_service)
+
+@st.cache_resource
+def get_job_worker() -> JobWorker:
+    """Process-wide background worker for "Process Inbox" jobs; picks up unfinished jobs on start."""
+    # Its own agent over the shared clients, not whichever session happened to start it
+    agent = build_agent(get_llm_service(get_setting("GEMINI_API_KEY")))
+    worker = JobWorker(JobQueue(), agent, get_store(), threads=SETTINGS.processing_workers)
+    worker.start()
+    return worker
+
+if "agent" in st.session_state and "job_id" not in st.session_state:
+    # Resume showing a job that was still running when the page was reloaded
+    job_queue = get_job_worker().queue
+    latest_job = job_queue.latest_job()
+    progress = job_queue.progress(latest_job) if latest_job else None
+    st.session_state.job_id = latest_job if progress and not progress.finished else None
 
 if "drafts" not in st.session_state:
     st.session_state.drafts = []
 
+# "mock" loads data/mock_inbox.json, "gmail" syncs the real mailbox incrementally
+INBOX_SOURCE = get_setting("INBOX_SOURCE", "mock")
+
+@st.cache_resource
+def get_gmail_service() -> GmailService:
+    """One authenticated Gmail client per process; it keeps a connection per worker thread."""
+    return GmailService()
+
 if "gmail_service" not in st.session_state:
-    st.session_state.gmail_service = "mock"
+    st.session_state.gmail_service = get_gmail_service() if INBOX_SOURCE == "gmail" else "mock"
 
 # --- Helper: Load Mock Inbox ---
 def load_mock_inbox() -> list:
@@ -62,38 +129,177 @@ def load_mock_inbox() -> list:
             subject=it.get("subject"),
             body=it.get("body"),
             timestamp=it.get("timestamp"),
+            thread_id=it.get("thread_id"),
             category=it.get("category"),
             action_items=it.get("action_items", [])
         ))
     return emails
 
+# --- Inbox state: the email list plus its query index ---
+def set_inbox(emails):
+    # Columnar metadata with bodies in a memory-mapped file; the index reads emails from it
+    inbox = emails if isinstance(emails, CompactInbox) else CompactInbox(emails)
+    st.session_state.emails = inbox
+    st.session_state.inbox_index = InboxIndex(store=CompactEmailMapping(inbox))
+    bump_inbox_revision()
+
+def bump_inbox_revision():
+    # Chats about the inbox start over once it changed
+    st.session_state.inbox_revision = st.session_state.get("inbox_revision", 0) + 1
+
+def get_inbox_index() -> InboxIndex:
+    if "inbox_index" not in st.session_state:
+        st.session_state.inbox_index = InboxIndex(st.session_state.emails)
+    return st.session_state.inbox_index
+
+# Rows per page of the inbox table; only the visible page is sent to the browser
+INBOX_PAGE_SIZE = int(get_setting("INBOX_PAGE_SIZE", 100))
+
+def inbox_page(index: InboxIndex, category_filter: str, search_text: str, page: int):
+    """
+    Returns (DataFrame, grid options, total matches) for one page of the inbox
+    table. Rebuilt only when the inbox (index.version), filters or page change.
+    """
+    # pandas and the grid component are slow to import; the other pages don't need them
+    import pandas as pd
+    from st_aggrid import GridOptionsBuilder
+
+    key = (index.version, category_filter, search_text, page)
+    cached = st.session_state.get("inbox_page_cache")
+    if cached and cached[0] == key:
+        return cached[1]
+
+    result = index.query(
+        category=category_filter if category_filter not in ("All", "Uncategorized") else None,
+        uncategorized=category_filter == "Uncategorized",
+        text=search_text or None,
+        offset=(page - 1) * INBOX_PAGE_SIZE,
+        limit=INBOX_PAGE_SIZE
+    )
+
+    data = []
+    for email in result.emails:
+        data.append({
+            "ID": email.id,
+            "Sender": email.sender,
+            "Subject": email.subject,
+            "Category": email.category or "Uncategorized",
+            "Action Items": ", ".join(email.action_items) if email.action_items else "-"
+        })
+
+    df = pd.DataFrame(data, columns=["ID", "Sender", "Subject", "Category", "Action Items"])
+
+    gb = GridOptionsBuilder.from_dataframe(df)
+    gb.configure_selection(selection_mode="single", use_checkbox=False)
+    gb.configure_column("ID", width=80)
+    gb.configure_column("Subject", width=400)
+    gb.configure_column("Category", width=150)
+
+    value = (df, gb.build(), result.total)
+    st.session_state.inbox_page_cache = (key, value)
+    return value
+
+# Email fields that processing writes
+RESULT_FIELDS = ("category", "action_items", "category_fingerprint", "actions_fingerprint", "category_source")
+
+def reload_from_store():
+    """Picks up the results that job workers checkpointed to the store."""
+    inbox = st.session_state.emails
+    if not inbox:
+        return
+    # Compared field by field, so unchanged emails and all bodies stay where they are
+    index = get_inbox_index()
+    for email_id, saved in get_store().get_many(inbox.ids).items():
+        if any(inbox.field(email_id, name) != getattr(saved, name) for name in RESULT_FIELDS):
+            index.upsert(saved)
+    bump_inbox_revision()
+
+@st.fragment(run_every=2)
+def show_job_progress(job_id):
+    queue = get_job_worker().queue
+    progress = queue.progress(job_id)
+    if progress is None or progress.finished:
+        st.session_state.job_id = None
+        st.session_state.job_summary = progress
+        reload_from_store()
+        st.rerun()
+
+    handled = progress.done + progress.failed
+    eta = f", about {progress.eta_seconds:.0f}s left" if progress.eta_seconds is not None else ""
+    st.progress(
+        handled / max(1, progress.total),
+        text=f"Processing emails: {handled}/{progress.total} ({progress.throughput:.2f} emails/s{eta})"
+    )
+    if st.button("⏹ Cancel Processing"):
+        queue.cancel(job_id)
+
 # --- NEW: Build inbox context for general-agent chats ---
-def build_inbox_context(emails, max_items=20, max_body_chars=800):
+# Token budget for the inbox context sent with each General Inbox question
+INBOX_CONTEXT_TOKENS = int(get_setting("INBOX_CONTEXT_TOKENS", 3000))
+
+# Budget for the earlier turns of a chat (older turns get summarized), and for the emails added
+# to a General Inbox chat when a follow-up needs ones that were not sent yet
+CHAT_HISTORY_TOKENS = int(get_setting("CHAT_HISTORY_TOKENS", 1500))
+CHAT_FOLLOW_UP_CONTEXT_TOKENS = int(get_setting("CHAT_FOLLOW_UP_CONTEXT_TOKENS", 1000))
+
+def inbox_context_entries(emails, query, token_budget=INBOX_CONTEXT_TOKENS, max_body_chars=800,
+                          exclude=(), start=1, fallback=True):
     """
-    Create a text context summarizing the inbox for the LLM.
-    Limits number of emails and truncates bodies to avoid sending huge payloads.
+    (email id, entry) pairs of a text context for the LLM from the emails most
+    relevant to `query`, skipping the ids in `exclude`. A BM25 index kept in
+    the session is updated incrementally as emails change, and only as many
+    top hits as fit in `token_budget` are included.
     """
-    if not emails:
-        return "Inbox is empty."
-
-    parts = []
-    for i, e in enumerate(emails[:max_items], start=1):
-        sender = e.sender or "<unknown sender>"
-        subject = e.subject or "<no subject>"
-        category = e.category or "Uncategorized"
-        actions = "; ".join(e.action_items) if getattr(e, "action_items", None) else "None"
-        body = (e.body or "").replace("\n", " ").strip()
-        if len(body) > max_body_chars:
-            body = body[:max_body_chars] + " ...[truncated]"
-        parts.append(f"Email {i} | From: {sender} | Subject: {subject} | Category: {category} | Action Items: {actions} | Body: {body}")
-    return "\n\n".join(parts)
+    if "retrieval_index" not in st.session_state:
+        st.session_state.retrieval_index = BM25Index()
+    index = st.session_state.retrieval_index
+    index.sync(emails)
+
+    agent = st.session_state.get("agent")
+    return select_context(index, get_inbox_index().by_id, query, token_budget, max_body_chars,
+                          fallback=emails[:20] if fallback else None,
+                          preprocessor=agent.preprocessor if agent else None, exclude=exclude, start=start)
+
+def reset_chat(key):
+    """Starts a new conversation: frees the provider's cache of the old context and clears the history."""
+    session = st.session_state.pop("chat_session", None)
+    if session is not None:
+        session.close()
+    st.session_state.chat_key = key
+    st.session_state.chat_email_ids = set()
+    st.session_state.messages = []
+
+def start_chat_session(context, key):
+    session = st.session_state.llm_service.start_chat(context, key=key, history_tokens=CHAT_HISTORY_TOKENS)
+    st.session_state.chat_session = session
+    return session
+
+def stream_into(chunks, target, key):
+    """
+    Passes LLM chunks through to st.write_stream, keeping the text so far in
+    target[key]. Pressing a Stop button reruns the script, which closes this
+    generator and with it the request; the partial text is kept.
+    """
+    target[key] = ""
+    try:
+        for chunk in chunks:
+            target[key] += chunk
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
 
 # --- Sidebar Navigation ---
 with st.sidebar:
     st.title("Navigation")
-    nav = st.radio("", ["📥 Inbox", "🤖 Email Agent", "📝 Drafts", "🧠 Prompt Brain"])
+    nav = st.radio("", ["📥 Inbox", "🤖 Email Agent", "📝 Drafts", "🧠 Prompt Brain", "📊 Metrics"])
     st.session_state.current_page = nav
 
+    if isinstance(st.session_state.get("llm_service"), CachedLLMService):
+        cache_stats = st.session_state.llm_service.stats()
+        st.caption(f"LLM cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses, {cache_stats['entries']} entries")
+
 st.title("📧 Email Productivity Agent")
 page = st.session_state.get("current_page", "📥 Inbox")
 
@@ -108,42 +314,53 @@ if page == "📥 Inbox":
 
     with col2:
         if st.button("🔄 Fetch Emails"):
-            with st.spinner("Loading mock inbox..."):
-                st.session_state.emails = load_mock_inbox()
-                st.success("Loaded mock inbox!")
+            if st.session_state.gmail_service == "mock":
+                with st.spinner("Loading mock inbox..."):
+                    set_inbox(merge_with_saved(load_mock_inbox()))
+                    st.success("Loaded mock inbox!")
+            else:
+                with st.spinner("Syncing Gmail..."):
+                    try:
+                        st.session_state.gmail_service.sync(get_store())
+                        set_inbox(load_inbox())
+                    except Exception as e:
+                        st.error(f"Gmail sync failed: {e}")
             st.rerun()
 
         # ✅✅✅ FIX #1: SAFE BULK PROCESSING
-        if st.button("⚡ Process Inbox"):
+        # Runs as a background job: every email is saved as soon as it is done
+        if st.button("⚡ Process Inbox", disabled=bool(st.session_state.get("job_id"))):
             if not st.session_state.emails:
                 st.warning("No emails to process.")
             else:
-                with st.spinner("Processing emails with AI..."):
+                stale = st.session_state.agent.stale_emails(st.session_state.emails, st.session_state.prompts)
+                stale_ids = [e.id for e in stale]
+                if not stale_ids:
+                    st.success("All emails are already up to date.")
+                else:
                     try:
-                        processed_emails = st.session_state.agent.process_emails(
-                            st.session_state.emails,
-                            st.session_state.prompts
-                        )
-
-                        # ✅ BLOCK ERROR TEXT FROM BECOMING CATEGORY
-                        for email in processed_emails:
-                            if email.category and (
-                                "quota" in email.category.lower() or
-                                "error" in email.category.lower() or
-                                "429" in email.category or
-                                "rate limit" in email.category.lower() or
-                                "exceeded" in email.category.lower()
-                            ):
-                                email.category = None  # ✅ RESET TO UNCATEGORIZED
-
-                        st.session_state.emails = processed_emails
-                        save_inbox(st.session_state.emails)
-                        st.success("Processing Complete!")
-
+                        # Workers read the emails from the store and checkpoint results back into it
+                        save_emails(st.session_state.emails)
+                        queue = get_job_worker().queue
+                        thread_ids = {e.id: e.thread_id for e in stale if e.thread_id}
+                        st.session_state.job_id = queue.create_job(stale_ids, st.session_state.prompts,
+                                                                   thread_ids=thread_ids)
                     except Exception as e:
                         st.error(f"Processing failed: {e}")
+                    st.rerun()
 
-                st.rerun()
+    if st.session_state.get("job_id"):
+        show_job_progress(st.session_state.job_id)
+
+    job_summary = st.session_state.pop("job_summary", None)
+    if job_summary:
+        if job_summary.failed:
+            st.warning(f"Processing finished, {job_summary.failed} email(s) failed and were left unprocessed.")
+        elif job_summary.status == "cancelled":
+            st.info(f"Processing cancelled after {job_summary.done} email(s).")
+        else:
+            st.success(f"Processing Complete! ({job_summary.done} email(s) processed, "
+                       f"{job_summary.llm_calls_saved} AI request(s) saved by the local classifier and reused results)")
 
     # -------------------------
     # DISPLAY EMAIL TABLE
@@ -151,33 +368,56 @@ if page == "📥 Inbox":
     if not st.session_state.emails:
         st.info("Inbox is empty. Press Fetch Emails button above to get started")
     else:
-        data = []
-        for email in st.session_state.emails:
-            data.append({
-                "ID": email.id,
-                "Sender": email.sender,
-                "Subject": email.subject,
-                "Category": email.category or "Uncategorized",
-                "Action Items": ", ".join(email.action_items) if email.action_items else "-"
-            })
-
-        df = pd.DataFrame(data)
-
-        gb = GridOptionsBuilder.from_dataframe(df)
-        gb.configure_selection(selection_mode="single", use_checkbox=False)
-        gb.configure_column("ID", width=80)
-        gb.configure_column("Subject", width=400)
-        gb.configure_column("Category", width=150)
+        index = get_inbox_index()
+        category_counts = index.category_counts()
+
+        filter_col1, filter_col2 = st.columns([1, 2])
+        with filter_col1:
+            category_options = ["All"] + sorted(c for c in category_counts if c) + (["Uncategorized"] if None in category_counts else [])
+            category_filter = st.selectbox(
+                "Category",
+                category_options,
+                format_func=lambda c: f"{c} ({len(index) if c == 'All' else category_counts.get(None if c == 'Uncategorized' else c, 0)})"
+            )
+        with filter_col2:
+            search_text = st.text_input("Search", placeholder="Search subject and body")
+
+        # Back to the first page whenever the filters change
+        filters = (category_filter, search_text)
+        if st.session_state.get("inbox_filters") != filters:
+            st.session_state.inbox_filters = filters
+            st.session_state.inbox_page_number = 1
+        page_number = st.session_state.get("inbox_page_number", 1)
+
+        df, grid_options, total = inbox_page(index, category_filter, search_text, page_number)
+        page_count = max(1, -(-total // INBOX_PAGE_SIZE))
+        if page_number > page_count:
+            # The inbox shrank under the current page
+            page_number = st.session_state.inbox_page_number = page_count
+            df, grid_options, total = inbox_page(index, category_filter, search_text, page_number)
+
+        import pandas as pd
+        from st_aggrid import AgGrid, GridUpdateMode
 
         grid_response = AgGrid(
             df,
-            gridOptions=gb.build(),
+            gridOptions=grid_options,
             height=300,
             fit_columns_on_grid_load=True,
             allow_unsafe_jscode=True,
             update_mode=GridUpdateMode.SELECTION_CHANGED,
+            key="inbox_grid",
         )
 
+        if page_count > 1:
+            st.number_input(
+                f"Page (of {page_count}, {total} emails)",
+                min_value=1,
+                max_value=page_count,
+                step=1,
+                key="inbox_page_number"
+            )
+
         selected_rows = grid_response.get("selected_rows", [])
         selected_id = None
 
@@ -189,14 +429,23 @@ if page == "📥 Inbox":
         st.divider()
 
         if selected_id:
-            email = next((e for e in st.session_state.emails if e.id == selected_id), None)
+            email = index.get(selected_id)
 
             if email:
                 st.markdown(f"**From:** {email.sender}")
                 st.markdown(f"**Subject:** {email.subject}")
                 st.markdown(f"**Date:** {email.timestamp}")
                 st.markdown(f"**Category:** `{email.category}`")
+                thread = get_store().get_thread_state(email.thread_id) if email.thread_id else None
+                if thread is not None and thread.summary:
+                    with st.expander(f"Conversation ({len(thread.message_ids)} messages analyzed)"):
+                        st.write(thread.summary)
                 st.text_area("Body", email.body, height=200, disabled=True)
+                preprocessor = st.session_state.agent.preprocessor if "agent" in st.session_state else None
+                if preprocessor is not None:
+                    saved = preprocessor.tokens_saved(email)
+                    if saved:
+                        st.caption(f"Preprocessing removes about {saved} tokens (quoted text, signature, footers) before this email is sent to the AI.")
 
                 st.divider()
                 st.subheader("Actions")
@@ -205,7 +454,7 @@ if page == "📥 Inbox":
                     st.info("\n".join([f"- {item}" for item in email.action_items]))
 
                 # ✅✅✅ FIX #2: SAFE SINGLE EMAIL PROCESSING
-                if not email.category:
+                if st.session_state.agent.needs_processing(email, st.session_state.prompts):
                     if st.button("⚡ Process This Email", key=f"process_{email.id}"):
                         with st.spinner("Processing this email with AI..."):
                             try:
@@ -214,25 +463,21 @@ if page == "📥 Inbox":
                                     st.session_state.prompts
                                 )
 
-                                if processed_list:
+                                failure = st.session_state.agent.last_failures.get(email.id)
+                                if failure:
+                                    # Left unprocessed, so it can simply be retried
+                                    st.error(f"Processing failed: {failure}")
+                                elif processed_list:
                                     processed = processed_list[0]
 
-                                    # ✅ BLOCK ERROR CATEGORY
-                                    if processed.category and (
-                                        "quota" in processed.category.lower() or
-                                        "error" in processed.category.lower() or
-                                        "429" in processed.category or
-                                        "rate limit" in processed.category.lower() or
-                                        "exceeded" in processed.category.lower()
-                                    ):
-                                        processed.category = None
-
-                                    st.session_state.emails = [
-                                        (processed if e.id == processed.id else e)
-                                        for e in st.session_state.emails
-                                    ]
-
-                                    save_inbox(st.session_state.emails)
+                                    # Also updates st.session_state.emails, the index's store
+                                    index.upsert(processed)
+                                    # An ongoing inbox chat keeps going; it may send the updated email again
+                                    st.session_state.get("chat_email_ids", set()).discard(processed.id)
+
+                                    save_email(processed)
+                                    if st.session_state.agent.preclassifier is not None:
+                                        st.session_state.agent.preclassifier.save()
                                     st.success("Email processed individually.")
 
                                 else:
@@ -250,17 +495,19 @@ if page == "📥 Inbox":
                 draft_instructions = st.text_area("Draft Instructions (optional)", value="", key=draft_instr_key, height=80)
 
                 if st.button("Generate Quick Draft", key=f"quick_gen_{email.id}"):
-                    with st.spinner("Generating quick draft..."):
-                        try:
-                            draft_content = st.session_state.agent.generate_draft(
+                    st.button("⏹ Stop", key=f"quick_stop_{email.id}")
+                    try:
+                        st.write_stream(stream_into(
+                            st.session_state.agent.generate_draft_stream(
                                 email,
                                 st.session_state.prompts,
                                 draft_instructions
-                            )
-                            st.session_state[f"quick_draft_content_{email.id}"] = draft_content
-                            st.success("Quick draft generated. Preview below.")
-                        except Exception as e:
-                            st.error(f"Draft generation failed: {e}")
+                            ),
+                            st.session_state, f"quick_draft_content_{email.id}"
+                        ))
+                        st.success("Quick draft generated. Preview below.")
+                    except Exception as e:
+                        st.error(f"Draft generation failed: {e}")
 
                 preview_key = f"quick_draft_content_{email.id}"
                 if preview_key in st.session_state:
@@ -288,9 +535,21 @@ elif page == "🤖 Email Agent":
         if not st.session_state.emails:
              st.warning("No emails loaded.")
         else:
-            email_ids = [e.id for e in st.session_state.emails]
-            selected_chat_id = st.selectbox("Choose Email", options=email_ids, key="chat_email_select")
-            selected_email_for_chat = next((e for e in st.session_state.emails if e.id == selected_chat_id), None)
+            index = get_inbox_index()
+            selected_chat_id = st.selectbox("Choose Email", options=index.ids(), key="chat_email_select")
+            selected_email_for_chat = index.get(selected_chat_id)
+
+    # The conversation is about one email or one state of the inbox; it starts over when that changes
+    if chat_context_mode == "Selected Email" and selected_email_for_chat:
+        email_context = st.session_state.agent.email_context(selected_email_for_chat)
+        chat_key = ("email", selected_email_for_chat.id, email_context)
+    else:
+        chat_key = ("inbox", st.session_state.get("inbox_revision", 0))
+    if st.session_state.get("chat_key") != chat_key:
+        reset_chat(chat_key)
+    if st.session_state.messages and st.button("🧹 New conversation"):
+        reset_chat(chat_key)
+        st.rerun()
 
     # Display Chat
     for message in st.session_state.messages:
@@ -304,24 +563,38 @@ elif page == "🤖 Email Agent":
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                if chat_context_mode == "Selected Email" and selected_email_for_chat:
-                    response = st.session_state.agent.chat_with_email(selected_email_for_chat, prompt)
-                else:
-                    # --- UPDATED: build and pass full inbox context to the agent/LLM ---
-                    inbox_context = build_inbox_context(st.session_state.emails)
-                    # Prefer an agent-level inbox chat method if available
-                    if hasattr(st.session_state.agent, "chat_with_inbox"):
-                        try:
-                            response = st.session_state.agent.chat_with_inbox(inbox_context, prompt)
-                        except Exception:
-                            # fallback to llm_service
-                            response = st.session_state.llm_service.chat(inbox_context, prompt)
-                    else:
-                        response = st.session_state.llm_service.chat(inbox_context, prompt)
-                
-                st.markdown(response)
-                st.session_state.messages.append({"role": "assistant", "content": response})
+            # Appended up front so a stopped answer keeps what was streamed so far
+            reply = {"role": "assistant", "content": ""}
+            st.session_state.messages.append(reply)
+            st.button("⏹ Stop", key="chat_stop")
+
+            # The context is sent once per conversation; follow-ups only add the new turn
+            session = st.session_state.get("chat_session")
+            sent_ids = st.session_state.chat_email_ids
+            if chat_key[0] == "email":
+                session = session or start_chat_session(email_context, chat_key)
+                chunks = session.ask_stream(prompt)
+            elif session is None:
+                entries = inbox_context_entries(st.session_state.emails, prompt) if st.session_state.emails else []
+                sent_ids.update(email_id for email_id, _ in entries)
+                session = start_chat_session("\n\n".join(entry for _, entry in entries) or "Inbox is empty.", chat_key)
+                chunks = session.ask_stream(prompt)
+            else:
+                # Only emails relevant to the follow-up that were not sent yet
+                entries = inbox_context_entries(
+                    st.session_state.emails, prompt, CHAT_FOLLOW_UP_CONTEXT_TOKENS,
+                    exclude=sent_ids, start=len(sent_ids) + 1, fallback=False
+                ) if st.session_state.emails else []
+                sent_ids.update(email_id for email_id, _ in entries)
+                chunks = session.ask_stream(prompt, "\n\n".join(entry for _, entry in entries))
+
+            try:
+                st.write_stream(stream_into(chunks, reply, "content"))
+            except Exception as e:
+                st.error(f"Chat failed: {e}")
+
+        if session.summarized_turns:
+            st.caption(f"{session.summarized_turns} earlier exchange(s) summarized to keep follow-up questions small.")
 
 elif page == "📝 Drafts":
     # --- Tab 3: Drafts ---
@@ -330,19 +603,25 @@ elif page == "📝 Drafts":
     if not st.session_state.emails:
         st.warning("Fetch emails to generate drafts.")
     else:
-        draft_email_id = st.selectbox("Select Email to Reply To", options=[e.id for e in st.session_state.emails], key="draft_email_select")
+        index = get_inbox_index()
+        draft_email_id = st.selectbox("Select Email to Reply To", options=index.ids(), key="draft_email_select")
         draft_instructions = st.text_area("Additional Instructions (Optional)", placeholder="e.g., Be very polite, decline the offer...")
         
         if st.button("Generate Draft"):
-            email_to_reply = next((e for e in st.session_state.emails if e.id == draft_email_id), None)
+            email_to_reply = index.get(draft_email_id)
             if email_to_reply:
-                with st.spinner("Drafting..."):
-                    draft_content = st.session_state.agent.generate_draft(
-                        email_to_reply, 
-                        st.session_state.prompts, 
-                        draft_instructions
-                    )
-                    st.session_state.current_draft = draft_content
+                st.button("⏹ Stop", key="draft_stop")
+                try:
+                    st.write_stream(stream_into(
+                        st.session_state.agent.generate_draft_stream(
+                            email_to_reply,
+                            st.session_state.prompts,
+                            draft_instructions
+                        ),
+                        st.session_state, "current_draft"
+                    ))
+                except Exception as e:
+                    st.error(f"Draft generation failed: {e}")
         
         if "current_draft" in st.session_state:
             st.text_area("Draft Content", value=st.session_state.current_draft, height=300)
@@ -368,13 +647,99 @@ elif page == "🧠 Prompt Brain":
     new_cat_prompt = st.text_area("Categorization Prompt", value=st.session_state.prompts.categorization, height=150)
     new_action_prompt = st.text_area("Action Item Extraction Prompt", value=st.session_state.prompts.action_extraction, height=150)
     new_reply_prompt = st.text_area("Auto-Reply Prompt", value=st.session_state.prompts.auto_reply, height=150)
+    new_combined_prompt = st.text_area(
+        "Combined Analysis Prompt (categorize + extract in one request, leave empty to use the two prompts above)",
+        value=st.session_state.prompts.combined_analysis or "",
+        height=150
+    )
+    new_batch_prompt = st.text_area(
+        "Batch Analysis Prompt (several emails per request via {emails}, leave empty to disable batching)",
+        value=st.session_state.prompts.batch_analysis or "",
+        height=150
+    )
+    new_thread_prompt = st.text_area(
+        "Thread Analysis Prompt (messages of a conversation analyzed with its running {summary}, leave empty to analyze each email on its own)",
+        value=st.session_state.prompts.thread_analysis or "",
+        height=150
+    )
     
     if st.button("Save Prompts"):
         updated_prompts = PromptConfig(
             categorization=new_cat_prompt,
             action_extraction=new_action_prompt,
-            auto_reply=new_reply_prompt
+            auto_reply=new_reply_prompt,
+            combined_analysis=new_combined_prompt.strip() or None,
+            batch_analysis=new_batch_prompt.strip() or None,
+            thread_analysis=new_thread_prompt.strip() or None
         )
         st.session_state.prompts = updated_prompts
         save_prompts(updated_prompts)
         st.success("Prompts updated successfully!")
+
+elif page == "📊 Metrics":
+    # --- Tab 5: Metrics ---
+    st.subheader("📊 Service Calls")
+    telemetry = get_telemetry()
+    snapshot = telemetry.snapshot()
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("LLM tokens", f"{snapshot['total_tokens']:,}")
+    col2.metric("Estimated cost", f"${snapshot['total_cost_usd']:.4f}")
+    reuse = snapshot["cache"].get("near_duplicate", {"hits": 0, "misses": 0})
+    llm_cache = [counts for operation, counts in snapshot["cache"].items() if operation != "near_duplicate"]
+    cache_hits = sum(counts["hits"] for counts in llm_cache)
+    cache_lookups = cache_hits + sum(counts["misses"] for counts in llm_cache)
+    col3.metric("LLM cache hit rate", f"{cache_hits / cache_lookups:.0%}" if cache_lookups else "-")
+    reuse_lookups = reuse["hits"] + reuse["misses"]
+    col4.metric("Near-duplicate reuse rate", f"{reuse['hits'] / reuse_lookups:.0%}" if reuse_lookups else "-")
+
+    if "agent" in st.session_state and st.session_state.agent.preprocessor is not None:
+        preprocess_stats = st.session_state.agent.preprocessor.stats()
+        if preprocess_stats.emails:
+            st.caption(
+                f"Preprocessing: {preprocess_stats.tokens_saved:,} of {preprocess_stats.tokens_before:,} body tokens "
+                f"removed across {preprocess_stats.emails} email(s) "
+                f"({preprocess_stats.tokens_saved / max(1, preprocess_stats.tokens_before):.0%})"
+            )
+
+    if not snapshot["operations"]:
+        st.info("No calls recorded yet. Process the inbox or chat with the agent to collect metrics.")
+    else:
+        st.dataframe([
+            {
+                "Service": row["service"],
+                "Operation": row["operation"],
+                "Calls": row["calls"],
+                "Errors": row["errors"],
+                "Retries": row["retries"],
+                "Mean (s)": round(row["mean_s"], 3),
+                "p50 (s)": round(row["p50_s"], 3),
+                "p95 (s)": round(row["p95_s"], 3),
+                "p99 (s)": round(row["p99_s"], 3),
+                "First chunk p50 (s)": round(row["first_chunk_p50_s"], 3) if row["first_chunk_p50_s"] is not None else None,
+                "Input tokens": row["input_tokens"],
+                "Output tokens": row["output_tokens"],
+                "Cached input tokens": row["cached_tokens"],
+                "Cost (USD)": round(row["cost_usd"], 6),
+            }
+            for row in snapshot["operations"]
+        ], hide_index=True, use_container_width=True)
+
+    if snapshot["cache"]:
+        st.markdown("**LLM cache**")
+        st.dataframe([{"Operation": operation, "Hits": counts["hits"], "Misses": counts["misses"]}
+                      for operation, counts in snapshot["cache"].items()], hide_index=True)
+
+    if snapshot["errors"]:
+        st.markdown("**Errors**")
+        st.dataframe([{"Service": e["service"], "Operation": e["operation"], "Error": e["error"], "Count": e["count"]}
+                      for e in snapshot["errors"]], hide_index=True)
+
+    col1, col2, col3 = st.columns(3)
+    col1.download_button("⬇️ Prometheus metrics", telemetry.to_prometheus(), file_name="metrics.prom", mime="text/plain")
+    if col2.button(f"💾 Write {METRICS_FILE}"):
+        telemetry.write_prometheus()
+        st.success(f"Metrics written to {METRICS_FILE}")
+    if col3.button("Reset Metrics"):
+        telemetry.reset()
+        st.rerun()
@@ -0,0 +1,52 @@
+from backend.agent import EmailAgent
+from backend.models import Email, PromptConfig
+from backend.preprocess import EmailPreprocessor
+from benchmarks.fakes import FakeLLMService
+
+PROMPTS = PromptConfig(
+    categorization="Categorize this email.",
+    action_extraction="Extract tasks as JSON.",
+    auto_reply="Draft a reply.",
+    combined_analysis="Categorize this email and extract its tasks.",
+    batch_analysis="Categorize these emails and extract their tasks:\n{emails}",
+)
+
+
+def make_email(number: int) -> Email:
+    return Email(id=f"m{number}", sender="ann@example.com", subject=f"Invoice {number}",
+                 body=f"Your invoice number {number} is attached.", timestamp=f"2024-01-0{number + 1}T10:00:00")
+
+
+# --- Fingerprints ---
+
+def test_batch_prompt_only_counts_when_batching():
+    edited = PROMPTS.model_copy(update={"batch_analysis": "Analyze these emails:\n{emails}"})
+    single = EmailAgent(FakeLLMService())
+    assert single.prompt_fingerprints(edited) == single.prompt_fingerprints(PROMPTS)
+    batched = EmailAgent(FakeLLMService(), batch_size=10)
+    assert batched.prompt_fingerprints(edited) != batched.prompt_fingerprints(PROMPTS)
+
+
+def test_separate_prompts_count_when_batches_fall_back_to_them():
+    prompts = PROMPTS.model_copy(update={"combined_analysis": None})
+    edited = prompts.model_copy(update={"categorization": "Classify this email."})
+    batched = EmailAgent(FakeLLMService(), batch_size=10)
+    assert batched.prompt_fingerprints(edited) != batched.prompt_fingerprints(prompts)
+
+
+def test_body_budget_counts():
+    def fingerprints(preprocessor):
+        return EmailAgent(FakeLLMService(), preprocessor=preprocessor).prompt_fingerprints(PROMPTS)
+
+    assert fingerprints(EmailPreprocessor(max_tokens=256)) != fingerprints(EmailPreprocessor(max_tokens=512))
+    assert fingerprints(EmailPreprocessor(max_tokens=512)) == fingerprints(EmailPreprocessor(max_tokens=512))
+    assert fingerprints(None) != fingerprints(EmailPreprocessor(max_tokens=512))
+
+
+def test_processed_emails_stay_fresh_until_something_counted_changes():
+    agent = EmailAgent(FakeLLMService(), preprocessor=EmailPreprocessor(max_tokens=512))
+    processed = agent.process_emails([make_email(0), make_email(1)], PROMPTS)
+    edited = PROMPTS.model_copy(update={"batch_analysis": "Analyze these emails:\n{emails}"})
+    assert agent.stale_emails(processed, edited) == []
+    agent.preprocessor = EmailPreprocessor(max_tokens=128)
+    assert len(agent.stale_emails(processed, PROMPTS)) == 2
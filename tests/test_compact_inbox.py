@@ -0,0 +1,67 @@
+from backend.compact_inbox import CompactEmailMapping, CompactInbox
+from backend.inbox_index import InboxIndex
+from backend.models import Email
+
+
+def make_email(number: int, **fields) -> Email:
+    values = dict(id=f"m{number}", sender=f"user{number % 3}@example.com", subject=f"Subject {number}",
+                  body=f"Body of email {number} – café", timestamp=f"2024-01-{number + 1:02d}T10:00:00")
+    values.update(fields)
+    return Email(**values)
+
+
+EMAILS = [
+    make_email(0),
+    make_email(1, category="Work", action_items=["Send the report", "Book a room"], thread_id="t1",
+               simhash=2 ** 64 - 1, category_fingerprint="abc", actions_fingerprint="def", category_source="llm",
+               label_ids=["INBOX", "UNREAD"], read=True),
+    make_email(2, action_items=None, thread_id="", simhash=0, subject="", body=""),
+]
+
+
+# --- Round trip ---
+
+def test_emails_round_trip_unchanged():
+    inbox = CompactInbox(EMAILS)
+    assert [email.model_dump() for email in inbox] == [email.model_dump() for email in EMAILS]
+
+
+def test_none_and_empty_values_stay_apart():
+    inbox = CompactInbox(EMAILS)
+    assert inbox.get("m0").thread_id is None and inbox.get("m2").thread_id == ""
+    assert inbox.get("m0").simhash is None and inbox.get("m2").simhash == 0
+    assert inbox.get("m0").action_items == [] and inbox.get("m2").action_items is None
+
+
+def test_updates_and_removals_keep_the_other_rows():
+    inbox = CompactInbox(EMAILS)
+    updated = EMAILS[0].model_copy(update={"category": "Finance", "thread_id": "t2", "action_items": ["Pay"]})
+    inbox.upsert(updated)
+    inbox.upsert(EMAILS[1].model_copy(update={"thread_id": None, "simhash": None}))
+    inbox.remove("m0")
+    inbox.upsert(updated)
+
+    assert inbox.get("m0").model_dump() == updated.model_dump()
+    assert inbox.get("m1").thread_id is None and inbox.get("m1").simhash is None
+    assert inbox.get("m2").model_dump() == EMAILS[2].model_dump()
+    assert sorted(inbox.ids) == ["m0", "m1", "m2"]
+
+
+def test_field_reads_one_value():
+    inbox = CompactInbox(EMAILS)
+    assert inbox.field("m1", "action_items") == ["Send the report", "Book a room"]
+    assert inbox.field("m1", "label_ids") == ["INBOX", "UNREAD"]
+    assert inbox.field("m2", "body") == ""
+
+
+# --- Memory ---
+
+def test_memory_usage_counts_ids_columns_and_bodies():
+    emails = [make_email(number, action_items=[f"Task {number}"], simhash=number) for number in range(200)]
+    inbox = CompactInbox(emails)
+    usage = inbox.memory_usage()
+    assert usage["bodies_on_disk"] == sum(len(email.body.encode("utf-8")) for email in emails)
+    assert usage["ids"] > 0
+    # Distinct values of dictionary-encoded columns are counted too
+    assert usage["columns"] > sum(len(email.subject) + len(email.action_items[0]) for email in emails)
+    assert InboxIndex(store=CompactEmailMapping(inbox)).memory_usage() > 0
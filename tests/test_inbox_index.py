@@ -0,0 +1,92 @@
+import pytest
+
+from backend.compact_inbox import CompactEmailMapping, CompactInbox
+from backend.inbox_index import InboxIndex, parse_timestamp
+from backend.models import Email
+
+
+def make_email(number: int, category=None, sender="ann@example.com", subject=None, body="") -> Email:
+    return Email(id=f"m{number}", sender=sender, subject=subject or f"Subject {number}", body=body,
+                 timestamp=f"2024-01-{number + 1:02d}T10:00:00", category=category)
+
+
+EMAILS = [
+    make_email(0, "Work", subject="Quarterly report", body="Please review the budget."),
+    make_email(1, "Work", sender="Bob@Example.com", subject="Budget meeting", body="Budget review on Friday."),
+    make_email(2, "Finance", subject="Invoice", body="The invoice is attached."),
+    make_email(3, None, sender="bob@example.com", subject="Lunch?", body="Are you free?"),
+    make_email(4, "Work", subject="Deploy", body="The budget for servers."),
+]
+
+
+@pytest.fixture(params=["dict", "compact"])
+def index(request):
+    if request.param == "compact":
+        return InboxIndex(store=CompactEmailMapping(CompactInbox(EMAILS)))
+    return InboxIndex(EMAILS)
+
+
+def ids(result):
+    return [email.id for email in result.emails]
+
+
+# --- Filters ---
+
+def test_default_query_is_newest_first(index):
+    result = index.query()
+    assert ids(result) == ["m4", "m3", "m2", "m1", "m0"]
+    assert result.total == 5
+
+
+def test_filters_combine(index):
+    assert ids(index.query(category="Work")) == ["m4", "m1", "m0"]
+    assert ids(index.query(sender="BOB@example.com")) == ["m3", "m1"]
+    assert ids(index.query(text="budget review")) == ["m1", "m0"]
+    assert ids(index.query(category="Work", sender="bob@example.com", text="budget")) == ["m1"]
+    assert ids(index.query(uncategorized=True)) == ["m3"]
+
+
+def test_date_range_is_inclusive(index):
+    result = index.query(date_from=parse_timestamp("2024-01-02T10:00:00"),
+                         date_to=parse_timestamp("2024-01-04T10:00:00"))
+    assert ids(result) == ["m3", "m2", "m1"]
+
+
+def test_sort_and_paging(index):
+    assert ids(index.query(sort_by="subject", descending=False)) == ["m1", "m4", "m2", "m3", "m0"]
+    page = index.query(sort_by="subject", descending=False, offset=1, limit=2)
+    assert ids(page) == ["m4", "m2"] and page.total == 5
+    with pytest.raises(ValueError):
+        index.query(sort_by="size")
+
+
+# --- Facets ---
+
+def test_facets_ignore_the_category_filter(index):
+    result = index.query(category="Finance", text="budget")
+    assert result.total == 0 and result.facets == {"Work": 3}
+    result = index.query(category="Finance", sender="ann@example.com")
+    assert ids(result) == ["m2"]
+    assert result.facets == {"Work": 2, "Finance": 1}
+    assert index.category_counts() == {"Work": 3, "Finance": 1, None: 1}
+
+
+# --- Updates ---
+
+def test_changes_invalidate_built_sort_orders(index):
+    assert ids(index.query(sort_by="subject", descending=False, limit=1)) == ["m1"]
+    index.upsert(make_email(5, "Work", subject="Agenda"))
+    index.upsert(EMAILS[3].model_copy(update={"subject": "A lunch", "category": "Personal"}))
+    assert ids(index.query(sort_by="subject", descending=False, limit=3)) == ["m3", "m5", "m1"]
+    index.remove("m3")
+    assert ids(index.query(sort_by="subject", descending=False, limit=1)) == ["m5"]
+    assert index.query(uncategorized=True).total == 0
+    assert index.category_counts() == {"Work": 4, "Finance": 1}
+
+
+def test_updated_email_is_reindexed_under_its_new_words(index):
+    version = index.version
+    index.upsert(EMAILS[2].model_copy(update={"body": "Payment reminder."}))
+    assert index.version != version
+    assert ids(index.query(text="invoice attached")) == []
+    assert ids(index.query(text="payment")) == ["m2"]
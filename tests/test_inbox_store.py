@@ -0,0 +1,110 @@
+import json
+import sqlite3
+
+import pytest
+
+from backend.inbox_store import JSONInboxStore, SQLiteInboxStore, migrate_json_to_sqlite
+from backend.models import Email, ThreadState
+
+
+def make_email(number: int, timestamp: str, category=None, thread_id=None) -> Email:
+    return Email(id=f"m{number}", sender="ann@example.com", subject=f"Subject {number}", body=f"Body {number}",
+                 timestamp=timestamp, category=category, thread_id=thread_id)
+
+
+# Mixed RFC 2822 and ISO 8601 dates, whose text order differs from their time order
+EMAILS = [
+    make_email(0, "Tue, 02 Jan 2024 09:00:00 +0000", "Work", "t1"),
+    make_email(1, "2024-01-03T09:00:00+00:00", "Finance"),
+    make_email(2, "Mon, 01 Jan 2024 12:00:00 +0100", "Work", "t1"),
+    make_email(3, "2024-01-04T09:00:00", None),
+    make_email(4, "not a date", "Work"),
+]
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def store(request, tmp_path):
+    if request.param == "json":
+        return JSONInboxStore(str(tmp_path / "inbox.json"))
+    return SQLiteInboxStore(str(tmp_path / "inbox.sqlite3"))
+
+
+def ids(emails):
+    return [email.id for email in emails]
+
+
+# --- Writes ---
+
+def test_upsert_inserts_and_replaces(store):
+    store.upsert_many(EMAILS)
+    store.upsert(EMAILS[1].model_copy(update={"category": "Personal", "action_items": ["Call back"]}))
+    assert store.count() == 5
+    assert store.get("m1").category == "Personal"
+    assert store.get("m1").action_items == ["Call back"]
+    assert store.get("missing") is None
+    assert store.load_all()[1].model_dump() == store.get("m1").model_dump()
+
+
+def test_replace_all_and_delete(store):
+    store.upsert_many(EMAILS)
+    store.replace_all(EMAILS[:3])
+    store.delete(["m0", "missing"])
+    assert sorted(ids(store.load_all())) == ["m1", "m2"]
+    assert set(store.get_many(["m0", "m1", "m2"])) == {"m1", "m2"}
+
+
+# --- Queries ---
+
+def test_query_orders_by_parsed_time(store):
+    store.upsert_many(EMAILS)
+    # Unparseable dates sort as the oldest
+    assert ids(store.query()) == ["m3", "m1", "m0", "m2", "m4"]
+    assert ids(store.query(newest_first=False, limit=2)) == ["m4", "m2"]
+    assert ids(store.query(offset=1, limit=2)) == ["m1", "m0"]
+
+
+def test_query_and_count_by_category(store):
+    store.upsert_many(EMAILS)
+    assert ids(store.query(category="Work")) == ["m0", "m2", "m4"]
+    assert store.count("Work") == 3 and store.count("Spam") == 0
+
+
+def test_sort_time_follows_updated_timestamps(store):
+    store.upsert_many(EMAILS)
+    store.upsert(EMAILS[4].model_copy(update={"timestamp": "2024-02-01T00:00:00Z"}))
+    assert ids(store.query(limit=1)) == ["m4"]
+
+
+# --- Conversations ---
+
+def test_threads(store):
+    store.upsert_many(EMAILS)
+    assert sorted(ids(store.get_thread("t1"))) == ["m0", "m2"]
+    assert store.thread_sizes(["t1", "t2"]) == {"t1": 2}
+
+
+def test_thread_state_is_kept_in_sqlite(tmp_path):
+    store = SQLiteInboxStore(str(tmp_path / "inbox.sqlite3"))
+    store.save_thread_state(ThreadState(thread_id="t1", summary="So far", message_ids=["m2", "m0"]))
+    reopened = SQLiteInboxStore(str(tmp_path / "inbox.sqlite3"))
+    assert reopened.get_thread_state("t1").message_ids == ["m2", "m0"]
+    assert reopened.get_thread_state("t2") is None
+
+
+def test_sort_time_column_holds_epoch_seconds(tmp_path):
+    path = str(tmp_path / "inbox.sqlite3")
+    SQLiteInboxStore(path).upsert_many(EMAILS[:2])
+    rows = dict(sqlite3.connect(path).execute("SELECT id, sort_time FROM emails").fetchall())
+    assert rows == {"m0": 1704186000.0, "m1": 1704272400.0}
+
+
+# --- Migration ---
+
+def test_json_inbox_is_imported_once(tmp_path):
+    json_path = tmp_path / "inbox.json"
+    json_path.write_text(json.dumps([email.model_dump() for email in EMAILS]))
+    store = SQLiteInboxStore(str(tmp_path / "inbox.sqlite3"))
+    assert migrate_json_to_sqlite(str(json_path), store) == 5
+    store.delete(["m0"])
+    assert migrate_json_to_sqlite(str(json_path), store) == 0
+    assert store.count() == 4
@@ -0,0 +1,144 @@
+import random
+import time
+
+import pytest
+
+from backend.agent import EmailAgent
+from backend.inbox_store import SQLiteInboxStore
+from backend.jobs import JobQueue, JobWorker
+from backend.models import Email, PromptConfig
+from benchmarks.fakes import FakeLLMService
+
+PROMPTS = PromptConfig(
+    categorization="Categorize this email.",
+    action_extraction="Extract tasks as JSON.",
+    auto_reply="Draft a reply.",
+    thread_analysis="Summary so far:\n{summary}\n\nNewest message:\n",
+)
+
+
+def make_email(number: int, thread_id=None) -> Email:
+    return Email(id=f"m{number}", sender="ann@example.com", subject=f"Update {number}",
+                 body=f"Status update number {number}.", timestamp=f"2024-01-0{number + 1}T10:00:00",
+                 thread_id=thread_id)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteInboxStore(str(tmp_path / "inbox.sqlite3"))
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"))
+
+
+# --- Leases ---
+
+def test_emails_are_leased_in_order_and_once(queue):
+    job_id = queue.create_job(["a", "b", "c", "a"], PROMPTS)
+    assert queue.lease("w1", job_id, limit=2) == ["a", "b"]
+    assert queue.lease("w2", job_id, limit=2) == ["c"]
+    assert queue.lease("w3", job_id) == []
+    assert queue.progress(job_id).total == 3
+
+
+def test_expired_lease_is_handed_out_again_until_attempts_run_out(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), lease_seconds=-1, max_attempts=2)
+    job_id = queue.create_job(["a"], PROMPTS)
+    assert queue.lease("w1", job_id) == ["a"]
+    # The crashed worker's lease expired: someone else gets the email
+    assert queue.next_job() == job_id
+    assert queue.lease("w2", job_id) == ["a"]
+    # ... and only that worker can complete it
+    assert not queue.complete("w1", job_id, ["a"])
+    assert queue.lease("w3", job_id) == []
+    progress = queue.progress(job_id)
+    assert progress.status == "done" and progress.failed == 1
+    assert queue.errors(job_id) == {"a": "lease expired"}
+
+
+def test_complete_finishes_the_job(queue):
+    job_id = queue.create_job(["a", "b"], PROMPTS)
+    queue.lease("w1", job_id, limit=2)
+    assert not queue.complete("w1", job_id, ["a"], llm_calls_saved=2)
+    assert queue.complete("w1", job_id, ["b"])
+    progress = queue.progress(job_id)
+    assert (progress.status, progress.done, progress.pending, progress.llm_calls_saved) == ("done", 2, 0, 2)
+    assert progress.finished and progress.throughput > 0
+    assert queue.next_job() is None
+
+
+# --- Failures ---
+
+def test_failed_email_waits_out_a_backoff(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), retry_delay=60, max_retry_delay=600)
+    job_id = queue.create_job(["a"], PROMPTS)
+    queue.lease("w1", job_id)
+    assert not queue.fail("w1", job_id, {"a": "503 Service unavailable"})
+    assert queue.lease("w1", job_id) == []
+    assert queue.next_job() is None
+    assert 0 < queue.retry_wait() <= 120
+    assert queue.progress(job_id).pending == 1
+
+
+def test_failed_email_is_retried_then_given_up(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=2, retry_delay=0)
+    job_id = queue.create_job(["a"], PROMPTS)
+    queue.lease("w1", job_id)
+    queue.fail("w1", job_id, {"a": "first"})
+    assert queue.lease("w1", job_id) == ["a"]
+    assert queue.fail("w1", job_id, {"a": "second"})
+    assert queue.errors(job_id) == {"a": "second"}
+    assert queue.retry_wait() is None
+
+
+def test_cancel_stops_handing_out_emails(queue):
+    job_id = queue.create_job(["a", "b"], PROMPTS)
+    queue.lease("w1", job_id)
+    queue.cancel(job_id)
+    assert queue.lease("w1", job_id) == []
+    # A worker finishing its lease afterwards does not count
+    queue.complete("w1", job_id, ["a"])
+    progress = queue.progress(job_id)
+    assert progress.status == "cancelled" and progress.finished and progress.done == 0
+
+
+# --- Conversations ---
+
+def test_lease_hands_out_a_whole_conversation(queue):
+    job_id = queue.create_job(["a", "m0", "b", "m1"], PROMPTS, thread_ids={"m0": "t1", "m1": "t1"})
+    assert queue.lease("w1", job_id) == ["a"]
+    assert queue.lease("w1", job_id) == ["m0", "m1"]
+    assert queue.lease("w2", job_id) == ["b"]
+
+
+def test_workers_process_a_conversation_oldest_first(queue, store):
+    emails = [make_email(number, "t1") for number in range(6)]
+    random.Random(3).shuffle(emails)
+    store.upsert_many(emails)
+    agent = EmailAgent(FakeLLMService(), thread_store=store)
+    job_id = queue.create_job([e.id for e in emails], PROMPTS, thread_ids={e.id: e.thread_id for e in emails})
+
+    worker = JobWorker(queue, agent, store, threads=4, poll_interval=0.01)
+    worker.start()
+    try:
+        while not queue.progress(job_id).finished:
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+
+    assert queue.progress(job_id).done == 6
+    assert store.get_thread_state("t1").message_ids == [f"m{number}" for number in range(6)]
+
+
+def test_reprocessing_seeds_the_summary_from_older_messages_only(store):
+    emails = [make_email(number, "t1") for number in range(4)]
+    store.upsert_many(emails)
+    agent = EmailAgent(FakeLLMService(), thread_store=store)
+    agent.process_emails(emails, PROMPTS)
+    store.upsert_many(emails)
+
+    seed = agent._seed_summary("t1", [emails[2]])
+    assert "Update 0" in seed and "Update 1" in seed
+    assert "Update 3" not in seed
@@ -0,0 +1,82 @@
+import pytest
+
+from backend.llm_cache import CachedLLMService
+from backend.telemetry import Telemetry
+from benchmarks.fakes import FakeLLMService
+
+PROMPT = "Categorize this email."
+
+
+@pytest.fixture
+def llm():
+    return FakeLLMService()
+
+
+def cached(llm, tmp_path, **limits) -> CachedLLMService:
+    return CachedLLMService(llm, path=str(tmp_path / "llm_cache.sqlite3"), telemetry=Telemetry(), **limits)
+
+
+# --- Hits ---
+
+def test_repeated_prompts_are_served_from_the_cache(llm, tmp_path):
+    cache = cached(llm, tmp_path)
+    first = cache.categorize_email("Your invoice is attached.", PROMPT)
+    assert cache.categorize_email("Your invoice is attached.", PROMPT) == first
+    cache.categorize_email("Your invoice is attached.", "Classify this email.")
+    assert llm.requests["categorize"] == 2
+    assert cache.stats()["hits"] == 1 and cache.stats()["entries"] == 2
+
+
+def test_entries_survive_a_restart(llm, tmp_path):
+    cached(llm, tmp_path).chat("Inbox summary", "What is due today?")
+    reopened = cached(llm, tmp_path)
+    reopened.chat("Inbox summary", "What is due today?")
+    assert llm.requests["chat"] == 1 and reopened.hits == 1
+
+
+def test_streams_share_entries_with_blocking_calls(llm, tmp_path):
+    cache = cached(llm, tmp_path)
+    reply = cache.generate_reply("Can we meet on Friday?", "Draft a reply.")
+    assert list(cache.generate_reply_stream("Can we meet on Friday?", "Draft a reply.")) == [reply]
+    assert llm.requests["reply"] == 1
+
+
+def test_invalid_results_are_not_stored(tmp_path):
+    class BlankLLM(FakeLLMService):
+        def generate_reply(self, email_content, prompt_template):
+            super().generate_reply(email_content, prompt_template)
+            return "  "
+
+    llm = BlankLLM()
+    cache = cached(llm, tmp_path)
+    cache.generate_reply("Hello", "Draft a reply.")
+    cache.generate_reply("Hello", "Draft a reply.")
+    assert llm.requests["reply"] == 2 and cache.stats()["entries"] == 0
+
+
+# --- Eviction ---
+
+def test_least_recently_used_entries_are_evicted_first(llm, tmp_path):
+    cache = cached(llm, tmp_path, max_entries=2)
+    cache.categorize_email("Email 1", PROMPT)
+    cache.categorize_email("Email 2", PROMPT)
+    # Reading email 1 makes email 2 the least recently used
+    cache.categorize_email("Email 1", PROMPT)
+    cache.categorize_email("Email 3", PROMPT)
+    assert cache.stats()["entries"] == 2 and cache.evictions == 1
+
+    cache.categorize_email("Email 1", PROMPT)
+    cache.categorize_email("Email 2", PROMPT)
+    assert llm.requests["categorize"] == 4
+
+
+def test_size_limit_evicts_until_entries_fit(llm, tmp_path):
+    cache = cached(llm, tmp_path, max_bytes=100)
+    for number in range(10):
+        cache.chat("Inbox summary", f"Question {number}")
+    stats = cache.stats()
+    assert 0 < stats["bytes"] <= 100
+    assert stats["entries"] + stats["evictions"] == 10
+    # The newest answer is always kept
+    cache.chat("Inbox summary", "Question 9")
+    assert llm.requests["chat"] == 10
@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+
+from backend.llm_errors import LLMRequestError
+from backend.openai_compat_service import OpenAICompatibleLLMService
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fakes import FakeLLMService
+
+EMAIL = "From: ann@example.com\nSubject: Invoice\n\nPlease pay the invoice by Friday."
+HISTORY = [{"role": "user", "content": "Any invoices?"}, {"role": "assistant", "content": "One, from Ann."}]
+
+
+@pytest.fixture
+def server():
+    with FakeOpenAIServer() as server:
+        yield server
+
+
+@pytest.fixture
+def flaky_server():
+    # Half of the requests fail with a 429 (Retry-After) or a 503
+    with FakeOpenAIServer(FakeLLMService(rate_limit_rate=0.25, error_rate=0.25)) as server:
+        yield server
+
+
+def make_llm(server, **options):
+    llm = OpenAICompatibleLLMService(server.url, "fake-llm", timeout=10.0, **options)
+    llm.scheduler.base_delay = 0.01
+    return llm
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+# --- Calls ---
+
+def test_sync_calls(server):
+    llm = make_llm(server)
+    assert llm.categorize_email(EMAIL, "Categorize:\n") == "Finance"
+    assert llm.analyze_email(EMAIL, "Analyze:\n")["category"] == "Finance"
+    assert "summary" in llm.analyze_thread_message(EMAIL, "Analyze the thread:\n")
+    assert llm.chat_turn("context", HISTORY, "Who sent it?")
+    assert llm.last_usage()["input_tokens"] > 0
+
+
+def test_async_calls_match_sync_calls(server):
+    llm = make_llm(server)
+
+    async def calls():
+        try:
+            return (await llm.acategorize_email(EMAIL, "Categorize:\n"),
+                    await llm.aanalyze_email(EMAIL, "Analyze:\n"),
+                    await llm.aanalyze_thread_message(EMAIL, "Analyze the thread:\n"),
+                    await llm.achat_turn("context", HISTORY, "Who sent it?"))
+        finally:
+            await llm.aclose()
+
+    assert run(calls()) == (llm.categorize_email(EMAIL, "Categorize:\n"),
+                            llm.analyze_email(EMAIL, "Analyze:\n"),
+                            llm.analyze_thread_message(EMAIL, "Analyze the thread:\n"),
+                            llm.chat_turn("context", HISTORY, "Who sent it?"))
+
+
+def test_client_errors_are_not_retried(server):
+    # A misconfigured base URL: the server answers 404
+    llm = OpenAICompatibleLLMService(server.url.replace("/v1", "/v2"), "fake-llm", timeout=10.0)
+    with pytest.raises(LLMRequestError, match="404"):
+        llm.categorize_email(EMAIL, "Categorize:\n")
+    assert llm.scheduler.retries == 0
+
+
+# --- Retries ---
+
+def test_rate_limits_and_server_errors_are_retried(flaky_server):
+    llm = make_llm(flaky_server, max_retries=20)
+    answers = [llm.categorize_email(EMAIL, "Categorize:\n") for _ in range(20)]
+    assert answers == ["Finance"] * 20
+    failures = flaky_server.stats()["llm"]["failures"]
+    assert failures.get("rate_limit") and failures.get("server_error")
+    assert llm.scheduler.retries == sum(failures.values())
+
+
+def test_async_rate_limits_and_server_errors_are_retried(flaky_server):
+    llm = make_llm(flaky_server, max_retries=20)
+
+    async def calls():
+        try:
+            return await asyncio.gather(*(llm.acategorize_email(EMAIL, "Categorize:\n") for _ in range(20)))
+        finally:
+            await llm.aclose()
+
+    assert run(calls()) == ["Finance"] * 20
+    failures = flaky_server.stats()["llm"]["failures"]
+    assert failures.get("rate_limit") and failures.get("server_error")
+
+
+# --- Streaming ---
+
+def test_stream_matches_complete_answer(server):
+    llm = make_llm(server)
+    chunks = list(llm.generate_reply_stream(EMAIL, "Draft a reply:\n"))
+    assert len(chunks) > 1
+    assert "".join(chunks).strip() == llm.generate_reply(EMAIL, "Draft a reply:\n")
+    assert list(llm.chat_turn_stream("context", HISTORY, "Who sent it?"))
+    assert llm.last_usage()["output_tokens"] > 0
+
+
+def test_async_stream_matches_sync_stream(server):
+    llm = make_llm(server)
+
+    async def streams():
+        try:
+            return (await collect(llm.agenerate_reply_stream(EMAIL, "Draft a reply:\n")),
+                    await collect(llm.achat_turn_stream("context", HISTORY, "Who sent it?")))
+        finally:
+            await llm.aclose()
+
+    reply, chat = run(streams())
+    assert reply == list(llm.generate_reply_stream(EMAIL, "Draft a reply:\n"))
+    assert chat == list(llm.chat_turn_stream("context", HISTORY, "Who sent it?"))
+
+
+def test_stream_start_is_retried(flaky_server):
+    llm = make_llm(flaky_server, max_retries=20)
+    expected = flaky_server.llm._reply(EMAIL)
+
+    async def streams():
+        try:
+            return [await collect(llm.agenerate_reply_stream(EMAIL, "Draft a reply:\n")) for _ in range(5)]
+        finally:
+            await llm.aclose()
+
+    for _ in range(5):
+        assert "".join(llm.generate_reply_stream(EMAIL, "Draft a reply:\n")).strip() == expected
+    assert all("".join(chunks).strip() == expected for chunks in run(streams()))
+    assert sum(flaky_server.stats()["llm"]["failures"].values()) > 0
+
+
+# --- Connection pool ---
+
+def test_sequential_requests_reuse_one_connection(server):
+    llm = make_llm(server)
+    for _ in range(20):
+        llm.categorize_email(EMAIL, "Categorize:\n")
+    list(llm.chat_stream("context", "Any invoices?"))
+    assert server.stats()["connections"] == 1
+
+
+def test_concurrent_async_requests_stay_within_pool(server):
+    llm = make_llm(server, max_connections=4)
+
+    async def calls():
+        try:
+            await asyncio.gather(*(llm.acategorize_email(EMAIL, "Categorize:\n") for _ in range(40)),
+                                 *(collect(llm.achat_stream("context", "Any invoices?")) for _ in range(10)))
+        finally:
+            await llm.aclose()
+
+    run(calls())
+    stats = server.stats()
+    assert sum(stats["requests"].values()) == 50
+    assert stats["connections"] <= 4
@@ -0,0 +1,51 @@
+from backend.preprocess import preprocess_body, strip_quoted, strip_signature
+
+
+# --- Content that must survive ---
+
+def test_sign_off_followed_by_sentences_is_kept():
+    body = "Thanks!\n\nCan you also send the invoice by Friday?\nThe deadline is firm."
+    assert preprocess_body(body) == body
+
+
+def test_sentences_after_sign_off_are_kept():
+    body = "Hi Bob,\nThanks.\nPlease review the contract by Monday.\nAlso send the budget.\nJohn"
+    assert "Also send the budget." in strip_signature(body)
+
+
+def test_attribution_without_quoted_text_is_kept():
+    body = "On the launch, John wrote:\nwe ship on Monday.\nQA starts Tuesday."
+    assert strip_quoted(body) == body
+
+
+def test_underline_row_is_not_a_quote_separator():
+    body = "Agenda\n____________\n1. Budget\n2. Hiring"
+    assert preprocess_body(body) == body
+
+
+# --- Boilerplate that is removed ---
+
+def test_reply_attribution_with_quoted_lines_is_removed():
+    body = "Sounds good.\n\nOn Mon, Jan 1, 2024 at 10:00 AM Ann <ann@example.com>\nwrote:\n> See you there\n> Ann"
+    assert strip_quoted(body).strip() == "Sounds good."
+
+
+def test_outlook_header_block_and_separator_are_removed():
+    body = "See below.\n\n________________________________\nFrom: Ann\nSent: Monday\nTo: Bob\nSubject: Hi\n\nOld text"
+    assert strip_quoted(body) == "See below."
+
+
+def test_original_message_header_is_removed():
+    body = "FYI\n\n-----Original Message-----\nFrom: Ann\nSent: Monday\nSubject: Hi\n\nOld text"
+    assert strip_quoted(body).strip() == "FYI"
+
+
+def test_contact_block_after_sign_off_is_removed():
+    body = ("Please send it.\n\nBest regards,\nJohn Smith\nSenior Engineer, Acme Inc.\n"
+            "+1 555 123 4567\nwww.acme.com")
+    assert strip_signature(body) == "Please send it.\n\nBest regards,\nJohn Smith"
+
+
+def test_signature_delimiter_and_mobile_footer_are_removed():
+    assert strip_signature("Ok.\n-- \nJohn\nAcme") == "Ok."
+    assert strip_signature("Ok, will do.\n\nSent from my iPhone").strip() == "Ok, will do."
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from backend.llm_errors import LLMRequestError, RateLimitError, TransientLLMError, parse_retry_after
+from backend.rate_limiter import RateLimiter, RequestScheduler, TokenBucket, backoff_delay
+
+
+def failing(*errors, result="ok"):
+    """A request that raises `errors` one by one, then returns `result`; counts its calls."""
+    remaining = list(errors)
+
+    def request():
+        request.calls += 1
+        if remaining:
+            raise remaining.pop(0)
+        return result
+
+    request.calls = 0
+    return request
+
+
+# --- Budgets ---
+
+def test_bucket_spreads_requests_over_time():
+    bucket = TokenBucket(60, capacity=1)
+    assert bucket.reserve(1) == 0
+    # The next ones queue up a second apart
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.05)
+    assert bucket.reserve(1) == pytest.approx(2, abs=0.05)
+
+
+def test_oversized_request_only_waits_for_a_full_bucket():
+    bucket = TokenBucket(600, capacity=10)
+    assert bucket.reserve(50) == 0
+    # ...but still pay for all of it: the next request waits out the 40 tokens of debt plus its own
+    assert bucket.reserve(1) == pytest.approx(41 / 10, abs=0.05)
+
+
+def test_limiter_without_limits_never_waits():
+    limiter = RateLimiter()
+    assert all(limiter.reserve(10 ** 6) == 0 for _ in range(100))
+
+
+def test_pause_holds_off_every_caller():
+    limiter = RateLimiter(tokens_per_minute=10 ** 6)
+    limiter.pause(30)
+    assert limiter.reserve(1) == pytest.approx(30, abs=0.5)
+
+
+def test_backoff_is_capped_and_honors_retry_after():
+    assert all(0 <= backoff_delay(attempt, base=1, cap=8) <= 8 for attempt in range(20))
+    assert all(backoff_delay(0, base=1, retry_after=5) >= 5 for _ in range(20))
+
+
+def test_retry_after_is_read_from_messages():
+    assert parse_retry_after("429 Quota exceeded. Please retry in 12.5s.") == 12.5
+    assert parse_retry_after("retry_delay { seconds: 7 }") == 7
+    assert parse_retry_after("500 Internal error") is None
+
+
+# --- Retries ---
+
+def test_transient_errors_are_retried():
+    scheduler = RequestScheduler(max_retries=3, base_delay=0.001)
+    request = failing(TransientLLMError("503"), TransientLLMError("timeout"))
+    assert scheduler.run(request) == "ok"
+    assert request.calls == 3 and scheduler.retries == 2
+
+
+def test_rate_limit_pauses_the_limiter_instead_of_sleeping():
+    scheduler = RequestScheduler(max_retries=1, base_delay=0.001)
+    request = failing(RateLimitError("429", retry_after=0.05))
+    assert scheduler.run(request) == "ok"
+    assert scheduler.limiter.paused_until > 0
+
+
+def test_gives_up_after_max_retries():
+    scheduler = RequestScheduler(max_retries=2, base_delay=0.001)
+    request = failing(*[TransientLLMError(f"503 #{i}") for i in range(5)])
+    with pytest.raises(TransientLLMError, match="#2"):
+        scheduler.run(request)
+    assert request.calls == 3
+
+
+def test_permanent_errors_are_not_retried():
+    scheduler = RequestScheduler(max_retries=5, base_delay=0.001)
+    request = failing(LLMRequestError("400 invalid key"))
+    with pytest.raises(LLMRequestError):
+        scheduler.run(request)
+    assert request.calls == 1 and scheduler.retries == 0
+
+
+def test_async_requests_are_retried():
+    scheduler = RequestScheduler(max_retries=3, base_delay=0.001)
+    request = failing(TransientLLMError("503"), RateLimitError("429", retry_after=0.01))
+
+    async def attempt():
+        return request()
+
+    assert asyncio.run(scheduler.run_async(attempt)) == "ok"
+    assert request.calls == 3 and scheduler.retries == 2